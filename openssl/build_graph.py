@@ -0,0 +1,450 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Measures how much parallelism the build graph of the OpenSSL Makefiles allows.
+
+Builds a DAG from the targets and prerequisites of every Makefile parsed by
+MakefileInfo, following recursive $(MAKE) invocations into the Makefiles they
+run, and reports:
+
+- jobs: the number of recipes run to build the goal, counting one compile per
+  object file built by a suffix rule
+- critical path: the largest number of those recipes that must run one after
+  another
+- max width: the largest number of recipes that could run at once
+- parallelism: jobs / critical path, the most make -j could speed up the build
+- recursive makes: the number of $(MAKE) invocations run to build the goal
+
+Every job is assumed to take the same time. A recursive $(MAKE) can't start
+on its targets until the previous one in the same recipe has finished, so the
+goals of each are chained together in order.
+
+update_makefiles.py --build_graph prints these statistics before and after
+each stage. To analyze the tree as it stands, run from the top of the OpenSSL
+source tree:
+
+  $ python build_graph.py --critical_path
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import update_makefiles
+import variable_expansion
+
+import argparse
+import collections
+import json
+import os
+import os.path
+import re
+
+MAKE_PATTERN = re.compile(r'\$[({]MAKE[)}]')
+QUOTED_PATTERN = re.compile(r'\'[^\']*\'|"[^"]*"')
+SHELL_ASSIGNMENT_PATTERN = re.compile(r'(?:^|[\s;@(])(\w+)=([^\s;]*)')
+SHELL_VAR_PATTERN = re.compile(r'\$\$(?:(\w+)|\{(\w+)\})')
+FOR_LOOP_PATTERN = re.compile(r'\bfor\s+(\w+)\s+in\s+([^;]*);')
+CD_PATTERN = re.compile(r'\bcd\s+([^\s;&|)]+)')
+COMMAND_END_PATTERN = re.compile(r'[;&|)]')
+TOP_REFERENCE_PATTERN = re.compile(r'\$[({]TOP(?:_\w+)?[)}]')
+
+
+def MakefileRoot(makefile):
+  """Returns the directory relative to which makefile's paths are written.
+
+  Makefiles are run from their own directory, using TOP to refer to the top
+  of the tree, until UpdateMakefilesStage2() removes TOP and makes every path
+  relative to the top of the tree instead.
+  """
+  if ('TOP' in makefile.variables or
+      'TOP%s' % makefile.suffix in makefile.variables):
+    return makefile.mfdir
+  for v in makefile.variables.itervalues():
+    if TOP_REFERENCE_PATTERN.search(v.definition):
+      return makefile.mfdir
+  for t in makefile.targets.itervalues():
+    if (TOP_REFERENCE_PATTERN.search(t.prerequisites) or
+        TOP_REFERENCE_PATTERN.search(t.recipe)):
+      return makefile.mfdir
+  return ''
+
+
+def DefaultGoal(makefile):
+  """Returns the first target in makefile, as make would, or 'all'."""
+  first = None
+  for target in makefile.targets.itervalues():
+    if target.name.startswith('.') or not target.spans:
+      continue
+    if first is None or target.spans[0].start < first.spans[0].start:
+      first = target
+  return first and first.name.split()[0] or 'all'
+
+
+
+def ParseRecursiveMakes(command):
+  """Finds the recursive $(MAKE) invocations in a recipe command.
+
+  Understands the forms used by the OpenSSL Makefiles:
+
+    (cd ..; $(MAKE) DIRS=crypto SDIRS=$(DIR) sub_all)
+    @dir=crypto; target=all; (cd $$dir && $(MAKE) -e $$target)
+    @for i in $(SDIRS); do (cd $$i && $(MAKE) -e all) || exit 1; done
+    $(MAKE) -C apps all
+
+  Args:
+    command: recipe command with its variables expanded and continuation
+      lines joined
+  Returns:
+    list of (directory, list of targets) for each invocation, in the order
+      in which they run; directory is relative to the one in which the
+      command runs, or None if it couldn't be determined
+  """
+  command = QUOTED_PATTERN.sub('', command)
+  invocations = []
+  for match in MAKE_PATTERN.finditer(command):
+    prefix = command[:match.start()]
+    shell_vars = dict(SHELL_ASSIGNMENT_PATTERN.findall(prefix))
+    loops = FOR_LOOP_PATTERN.findall(prefix)
+    loop_var, loop_words = loops and loops[-1] or (None, '')
+    dirs = CD_PATTERN.findall(prefix)
+    directory = dirs and dirs[-1] or os.curdir
+
+    args = command[match.end():]
+    end = COMMAND_END_PATTERN.search(args)
+    words = (end and args[:end.start()] or args).split()
+    targets = []
+    while words:
+      word = words.pop(0)
+      if word == '-C' and words:
+        directory = os.path.normpath(os.path.join(directory, words.pop(0)))
+      elif not word.startswith('-') and '=' not in word:
+        targets.append(word)
+
+    def Substitute(s, loop_word):
+      """Replaces the shell variables in s with their values."""
+      def Replace(var_match):
+        name = var_match.group(1) or var_match.group(2)
+        if name == loop_var and loop_word is not None:
+          return loop_word
+        return shell_vars.get(name, var_match.group(0))
+      return SHELL_VAR_PATTERN.sub(Replace, s)
+
+    referenced = set(a or b for a, b in SHELL_VAR_PATTERN.findall(
+        ' '.join([directory] + targets)))
+    for loop_word in loop_var in referenced and loop_words.split() or [None]:
+      d = Substitute(directory, loop_word)
+      invocations.append(('$' not in d and d or None,
+                          [Substitute(t, loop_word) for t in targets]))
+  return invocations
+
+
+class _TreeExpander(variable_expansion.VariableExpander):
+  """Expands variables as the Makefiles see them once they are combined.
+
+  Once their paths are relative to the top of the tree, Makefiles will be
+  included by a single top-level Makefile, so they share variables; any not
+  defined by the Makefile itself or configure.mk are looked up in the others.
+  """
+
+  def __init__(self, all_makefiles, roots):
+    config = all_makefiles.get('configure.mk.org')
+    super(_TreeExpander, self).__init__(config and config.variables)
+    self.roots = roots
+    self.shared_variables = {}
+    for path in sorted(all_makefiles, reverse=True):
+      if roots[path] == '':
+        self.shared_variables.update(all_makefiles[path].variables)
+
+  def Scopes(self, makefile):
+    scopes = super(_TreeExpander, self).Scopes(makefile)
+    if self.roots[makefile.makefile] == '':
+      scopes.append(self.shared_variables)
+    return scopes
+
+
+class BuildGraph(object):
+  """Graph of the targets in every Makefile in the tree.
+
+  Each node is a (Makefile path, target path) tuple, where the target path is
+  relative to the top of the tree. Each Makefile is still run by its own make
+  invocation, so the same name in different Makefiles is a different target,
+  and the edges only connect targets within the same Makefile. Recipes that
+  run a recursive $(MAKE) refer to the Makefile and goals it builds instead.
+
+  Attributes:
+    makefiles: hash of Makefile path -> Makefile
+    roots: hash of Makefile path -> MakefileRoot() of the Makefile
+    expander: VariableExpander for the targets and recipes
+    prerequisites: hash of node -> set of nodes it depends on
+    jobs: set of nodes whose recipes do work, including compiles of object
+      files built by suffix rules
+    sub_makes: hash of node -> list of the recursive $(MAKE)s run by its
+      recipe, in order, each a list of goal nodes, or None if the Makefile
+      or one of its goals couldn't be found
+  """
+
+  def __init__(self, all_makefiles):
+    """Builds the graph.
+
+    Args:
+      all_makefiles: MakefileInfo.all_makefiles
+    """
+    self.makefiles = all_makefiles
+    self.roots = dict((path, MakefileRoot(makefile))
+                      for path, makefile in all_makefiles.iteritems())
+    self.prerequisites = collections.defaultdict(set)
+    self.jobs = set()
+    self.sub_makes = {}
+    self.expander = _TreeExpander(all_makefiles, self.roots)
+
+    for path in sorted(all_makefiles):
+      if path != 'configure.mk.org':
+        self._AddMakefile(path)
+    self._ResolveSubMakes()
+
+    # Objects without recipes of their own are compiled by a suffix rule.
+    for node, prerequisites in self.prerequisites.items():
+      for object_node in [node] + list(prerequisites):
+        if object_node[1].endswith('.o'):
+          self.jobs.add(object_node)
+
+  def Node(self, makefile_path, name):
+    """Returns the node for target name in the Makefile at makefile_path."""
+    return (makefile_path, os.path.normpath(os.path.join(
+        self.roots[makefile_path], name)))
+
+  def _Names(self, makefile, s):
+    """Returns the names in s, excluding any that couldn't be expanded."""
+    return [name for name in
+            self.expander.Expand(makefile, s.replace('\\\n', ' ')).split()
+            if '$' not in name]
+
+  def _AddMakefile(self, makefile_path):
+    """Adds the targets in the Makefile at makefile_path to the graph."""
+    makefile = self.makefiles[makefile_path]
+    for target in makefile.targets.itervalues():
+      names = [n for n in self._Names(makefile, target.name)
+               if not n.startswith('.') and '%' not in n]
+      if not names:
+        continue
+      prerequisites = [self.Node(makefile_path, p) for p in
+                       self._Names(makefile, target.prerequisites)]
+      sub_makes = self._FindSubMakes(makefile_path, target.recipe)
+
+      for name in names:
+        node = self.Node(makefile_path, name)
+        self.prerequisites[node].update(prerequisites)
+        if sub_makes:
+          self.sub_makes.setdefault(node, []).extend(sub_makes)
+        if target.recipe.strip():
+          self.jobs.add(node)
+
+  def _FindSubMakes(self, makefile_path, recipe):
+    """Returns the recursive $(MAKE)s in a recipe, as described for
+    self.sub_makes.
+
+    Args:
+      makefile_path: path of the Makefile containing the recipe
+      recipe: Target.recipe
+    """
+    # Recursive makes still cd into each directory, whichever way the paths
+    # in the Makefile are written.
+    cwd = self.makefiles[makefile_path].mfdir
+    sub_makes = []
+    for command in recipe.replace('\\\n', ' ').split('\n'):
+      command = self.expander.Expand(self.makefiles[makefile_path], command)
+      if not MAKE_PATTERN.search(command):
+        continue
+      for directory, targets in ParseRecursiveMakes(command):
+        sub_path = directory is not None and os.path.normpath(
+            os.path.join(cwd, directory, 'Makefile'))
+        if sub_path not in self.makefiles:
+          sub_makes.append(None)
+          continue
+        sub_makes.append([self.Node(sub_path, t) for t in
+                          targets or [DefaultGoal(self.makefiles[sub_path])]])
+    return sub_makes
+
+  def _ResolveSubMakes(self):
+    """Marks the recursive $(MAKE)s of goals without rules as unresolved.
+
+    Called once every Makefile has been added, since the goals may be in
+    Makefiles added later.
+    """
+    for sub_makes in self.sub_makes.itervalues():
+      for i, goals in enumerate(sub_makes):
+        if goals is not None and any(
+            g not in self.prerequisites for g in goals):
+          sub_makes[i] = None
+
+  def DefaultGoal(self):
+    """Returns the node for the default goal of the top-level Makefile."""
+    return self.Node('Makefile', DefaultGoal(self.makefiles['Makefile']))
+
+  def Analyze(self, goal=None):
+    """Computes the statistics described in the module docstring.
+
+    Schedules every job as soon as its prerequisites have finished, given as
+    many processors as needed. Each recursive $(MAKE) is a separate
+    invocation that starts once the previous one in the same recipe has
+    finished, and builds its own copy of the targets it needs.
+
+    Args:
+      goal: node to build; defaults to DefaultGoal()
+    Returns:
+      hash of statistic name -> value; 'critical_path_nodes' lists the jobs
+        on the critical path in the order in which they run, 'unresolved_makes'
+        is the number of recursive $(MAKE)s whose Makefile or goals couldn't
+        be found, and 'cycles' is the number of dependency cycles broken
+    """
+    if goal is None:
+      goal = self.DefaultGoal()
+    state = _Schedule()
+    self._Build(goal, 0, 0, None, state, set())
+
+    critical_path = state.finish[(0, goal)]
+    path = []
+    key = (0, goal)
+    while key is not None:
+      if key[1] in self.jobs:
+        path.append('%s:%s' % key[1])
+      key = state.via[key]
+
+    return {
+        'jobs': sum(state.widths.values()),
+        'critical_path': critical_path,
+        'max_width': max(state.widths.values() or [0]),
+        'parallelism': critical_path and (
+            float(sum(state.widths.values())) / critical_path),
+        'recursive_makes': state.recursive_makes,
+        'unresolved_makes': state.unresolved_makes,
+        'cycles': state.cycles,
+        'critical_path_nodes': list(reversed(path)),
+        }
+
+  def _Build(self, node, invocation, start, start_via, state, active):
+    """Schedules node and everything it depends on.
+
+    Args:
+      node: node to build
+      invocation: id of the make invocation building node
+      start: time at which the invocation started
+      start_via: key of the job that had to finish before the invocation
+        started, or None
+      state: _Schedule being built
+      active: set of the (Makefile path, goals) of the enclosing invocations
+    Returns:
+      the time at which node finishes
+    """
+    key = (invocation, node)
+    if key in state.finish:
+      return state.finish[key]
+    if key in state.visiting:
+      state.cycles += 1
+      return start
+    state.visiting.add(key)
+
+    finish, via = start, start_via
+    for prerequisite in sorted(self.prerequisites.get(node, ())):
+      prerequisite_finish = self._Build(
+          prerequisite, invocation, start, start_via, state, active)
+      if prerequisite_finish > finish:
+        finish, via = prerequisite_finish, (invocation, prerequisite)
+
+    for goals in self.sub_makes.get(node, ()):
+      state.recursive_makes += 1
+      if goals is None:
+        state.unresolved_makes += 1
+        continue
+      sub_make = (goals[0][0], tuple(goals))
+      if sub_make in active:
+        state.cycles += 1
+        continue
+      state.invocations += 1
+      sub_invocation = state.invocations
+      active.add(sub_make)
+      sub_start, sub_via = finish, via
+      for goal in goals:
+        goal_finish = self._Build(
+            goal, sub_invocation, sub_start, sub_via, state, active)
+        if goal_finish > finish:
+          finish, via = goal_finish, (sub_invocation, goal)
+      active.remove(sub_make)
+
+    if node in self.jobs:
+      finish += 1
+      state.widths[finish] += 1
+    state.visiting.remove(key)
+    state.finish[key] = finish
+    state.via[key] = via
+    return finish
+
+
+class _Schedule(object):
+  """State of BuildGraph.Analyze().
+
+  Attributes:
+    finish: hash of (invocation, node) -> the time at which it finishes
+    via: hash of (invocation, node) -> the key of the job that had to finish
+      before it could start, or None
+    visiting: set of the keys being scheduled, to detect cycles
+    widths: hash of time -> number of jobs finishing at that time
+    invocations: number of make invocations so far
+    recursive_makes: number of recursive $(MAKE)s
+    unresolved_makes: number of recursive $(MAKE)s whose Makefile or goals
+      couldn't be found
+    cycles: number of dependency cycles broken
+  """
+
+  def __init__(self):
+    self.finish = {}
+    self.via = {}
+    self.visiting = set()
+    self.widths = collections.Counter()
+    self.invocations = 0
+    self.recursive_makes = 0
+    self.unresolved_makes = 0
+    self.cycles = 0
+
+
+def FormatStats(stats):
+  """Returns the output of BuildGraph.Analyze() as a single line."""
+  line = ('%(jobs)d jobs, critical path %(critical_path)d, max width '
+          '%(max_width)d, parallelism %(parallelism).2fx, %(recursive_makes)d '
+          'recursive makes' % stats)
+  if stats['unresolved_makes']:
+    line += ' (%d unresolved)' % stats['unresolved_makes']
+  if stats['cycles']:
+    line += ', %d cycles broken' % stats['cycles']
+  return line
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--critical_path',
+        help='Also print the jobs on the critical path',
+        action='store_true')
+  parser.add_argument('--json',
+        help='Print the statistics as JSON',
+        action='store_true')
+  parser.add_argument('--parse_cache',
+        help='See update_makefiles.py --parse_cache')
+  args = parser.parse_args()
+
+  parse_cache = None
+  if args.parse_cache:
+    parse_cache = update_makefiles.ParseCache(args.parse_cache)
+    parse_cache.Load()
+  info = update_makefiles.MakefileInfo(parse_cache)
+  info.Init()
+  stats = BuildGraph(info.all_makefiles).Analyze()
+  if not args.critical_path:
+    del stats['critical_path_nodes']
+
+  if args.json:
+    print json.dumps(stats, indent=2, sort_keys=True)
+  else:
+    print FormatStats(stats)
+    for node in stats.get('critical_path_nodes', []):
+      print '  %s' % node
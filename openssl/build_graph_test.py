@@ -0,0 +1,167 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Unit tests for build_graph.py.
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import build_graph
+import update_makefiles
+
+import unittest
+
+TOP_MAKEFILE = """TOP= .
+DIRS= crypto ssl
+BUILD_CMD=  if [ -d "$$dir" ]; then \\
+\t    (\tcd $$dir && echo "making $$target in $$dir..." && \\
+\t\t$(MAKE) -e TOP=.. DIR=$$dir $$target \\
+\t    ) || exit 1; \\
+\t    fi
+BUILD_ONE_CMD=\\
+\tif expr " $(DIRS) " : ".* $$dir " >/dev/null 2>&1; then \\
+\t\t$(BUILD_CMD); \\
+\tfi
+
+all: build_libs
+
+build_libs: build_crypto build_ssl
+
+build_crypto:
+\t@dir=crypto; target=all; $(BUILD_ONE_CMD)
+
+build_ssl: build_crypto
+\t@dir=ssl; target=all; $(BUILD_ONE_CMD)
+"""
+
+CRYPTO_MAKEFILE = """TOP= ..
+SDIRS= aes sha
+LIBOBJ= cryptlib.o mem.o
+RECURSIVE_MAKE=\t[ -z "$(SDIRS)" ] || for i in $(SDIRS) ; do \\
+\t    (cd $$i && echo "making $$target in $(DIR)/$$i..." && \\
+\t    $(MAKE) -e TOP=../.. DIR=$$i INCLUDES='$(INCLUDES)' $$target ) || \\
+\t    exit 1; \\
+\tdone;
+
+all: lib subdirs
+
+subdirs:
+\t@target=all; $(RECURSIVE_MAKE)
+
+lib: $(LIBOBJ)
+\t$(AR) $(LIB) $(LIBOBJ)
+"""
+
+SUBDIR_MAKEFILE = """TOP= ../..
+LIBSRC= %s
+LIBOBJ= $(LIBSRC:.c=.o)
+
+all: lib
+
+lib: $(LIBOBJ)
+\t$(AR) $(LIB) $(LIBOBJ)
+"""
+
+
+def Parse(makefiles):
+  """Returns a hash of path -> Makefile parsed from a hash of path -> content.
+  """
+  return dict((path, update_makefiles.ParseMakefileContent(content, path))
+              for path, content in makefiles.iteritems())
+
+
+class ParseRecursiveMakesTest(unittest.TestCase):
+
+  def testCd(self):
+    self.assertEqual(
+        [('..', ['sub_all'])], build_graph.ParseRecursiveMakes(
+            '(cd ..; $(MAKE) DIRS=crypto SDIRS=aes sub_all)'))
+
+  def testShellVariables(self):
+    self.assertEqual(
+        [('crypto', ['all'])], build_graph.ParseRecursiveMakes(
+            '@dir=crypto; target=all; (cd $$dir && $(MAKE) -e $$target)'))
+
+  def testForLoop(self):
+    self.assertEqual(
+        [('aes', ['all']), ('sha', ['all'])],
+        build_graph.ParseRecursiveMakes(
+            '@for i in aes sha; do (cd $$i && '
+            '$(MAKE) -e INCLUDES=\'-I.. -I$(TOP)\' all) || exit 1; done'))
+
+  def testDirectoryOption(self):
+    self.assertEqual(
+        [('apps', ['all']), ('.', [])], build_graph.ParseRecursiveMakes(
+            '$(MAKE) -C apps all && ${MAKE}'))
+
+  def testUnresolvedDirectory(self):
+    self.assertEqual([(None, [])],
+                     build_graph.ParseRecursiveMakes('cd $$unknown; $(MAKE)'))
+
+
+class BuildGraphTest(unittest.TestCase):
+
+  def setUp(self):
+    self.makefiles = Parse({
+        'Makefile': TOP_MAKEFILE,
+        'crypto/Makefile': CRYPTO_MAKEFILE,
+        'crypto/aes/Makefile': SUBDIR_MAKEFILE % 'aes_core.c aes_cbc.c',
+        'crypto/sha/Makefile': SUBDIR_MAKEFILE % 'sha1.c',
+        'ssl/Makefile': SUBDIR_MAKEFILE.replace('../..', '..') % 's3_lib.c',
+        })
+
+  def testRecursiveMakesRunInSequence(self):
+    stats = build_graph.BuildGraph(self.makefiles).Analyze()
+    self.assertEqual([
+        'crypto/aes/Makefile:crypto/aes/aes_cbc.o',
+        'crypto/aes/Makefile:crypto/aes/lib',
+        'crypto/sha/Makefile:crypto/sha/sha1.o',
+        'crypto/sha/Makefile:crypto/sha/lib',
+        'crypto/Makefile:crypto/subdirs',
+        'Makefile:build_crypto',
+        'ssl/Makefile:ssl/s3_lib.o',
+        'ssl/Makefile:ssl/lib',
+        'Makefile:build_ssl',
+        ], stats['critical_path_nodes'])
+    self.assertEqual(9, stats['critical_path'])
+    # crypto: 2 objects + lib + subdirs; aes: 2 + lib; sha: 1 + lib;
+    # ssl: 1 + lib; plus build_crypto and build_ssl.
+    self.assertEqual(13, stats['jobs'])
+    # Both crypto objects, and both aes objects, at once.
+    self.assertEqual(4, stats['max_width'])
+    self.assertEqual(4, stats['recursive_makes'])
+    self.assertEqual(0, stats['unresolved_makes'])
+    self.assertEqual(0, stats['cycles'])
+
+  def testTopRelativePaths(self):
+    self.makefiles['crypto/aes/Makefile'] = Parse({
+        'crypto/aes/Makefile':
+            'OBJ= crypto/aes/aes_core.o\n\nall: all_aes\n\nall_aes: $(OBJ)\n',
+        })['crypto/aes/Makefile']
+    graph = build_graph.BuildGraph(self.makefiles)
+    self.assertEqual('', build_graph.MakefileRoot(
+        self.makefiles['crypto/aes/Makefile']))
+    self.assertEqual(
+        set([('crypto/aes/Makefile', 'crypto/aes/aes_core.o')]),
+        graph.prerequisites[('crypto/aes/Makefile', 'all_aes')])
+    self.assertIn(('crypto/aes/Makefile', 'crypto/aes/aes_core.o'),
+                  graph.jobs)
+
+  def testUnresolvedMakesAndCycles(self):
+    self.makefiles['crypto/sha/Makefile'] = Parse({
+        'crypto/sha/Makefile':
+            'TOP= ../..\n\nall: lib\n\nlib: all\n\t$(MAKE) -C asm\n',
+        })['crypto/sha/Makefile']
+    stats = build_graph.BuildGraph(self.makefiles).Analyze()
+    self.assertEqual(1, stats['unresolved_makes'])
+    self.assertEqual(1, stats['cycles'])
+    self.assertEqual(
+        '12 jobs, critical path 8, max width 4, parallelism 1.50x, '
+        '5 recursive makes (1 unresolved), 1 cycles broken',
+        build_graph.FormatStats(stats))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,402 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Indexes the .d dependency files generated by the compiler's -MMD -MP flags.
+
+UpdateMakefilesStage0() replaces the makedepend output in each Makefile with
+-include $(SRC:.c=.d) in the GNUmakefile and a .sinclude loop in the
+BSDmakefile. This script reads every .d file in the tree back into a single
+header -> object inverted index, answering which objects will be rebuilt if a
+given file changes, and reports .d files that are missing or stale. Run from
+the top of the OpenSSL source tree after a build:
+
+  $ python dependency_index.py --cache .dependency_index --check
+  $ python dependency_index.py --rebuilds include/openssl/aes.h
+
+With --cache, only the .d files that have changed since the previous run are
+read again, so it's cheap enough to run after every build.
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import update_makefiles
+
+import argparse
+import array
+import cPickle
+import os
+import os.path
+import re
+import sys
+import time
+
+# Separates the targets of a .d file rule from its prerequisites. Requiring
+# whitespace after the ':' leaves Windows drive letters intact.
+RULE_SEPARATOR_PATTERN = re.compile(r':(?:\s|$)')
+
+# Matches a single path in a .d file, in which spaces may be escaped.
+DEPENDENCY_TOKEN_PATTERN = re.compile(r'(?:\\.|[^\s\\])+')
+ESCAPED_CHAR_PATTERN = re.compile(r'\\(.)')
+
+
+def SplitDependencyTokens(s):
+  """Splits the targets or prerequisites of a .d file rule into paths.
+
+  Undoes the escaping the compiler applies to spaces and '#' with '\\', and to
+  '$' with '$$'.
+  """
+  return [ESCAPED_CHAR_PATTERN.sub(r'\1', token).replace('$$', '$')
+          for token in DEPENDENCY_TOKEN_PATTERN.findall(s)]
+
+
+def ReadDependencyRules(infile, dirname):
+  """Reads the rules in a .d file one at a time.
+
+  Continuation lines are joined, and the empty rules emitted for every header
+  by -MP are skipped. Relative paths are relative to dirname, the directory
+  in which the compiler ran, and are converted to be relative to the top of
+  the tree.
+
+  Args:
+    infile: .d file to read
+    dirname: directory containing the .d file, relative to the top of the tree
+  Yields:
+    (list of target paths, list of prerequisite paths) for each rule
+  """
+  def Normalize(path):
+    return os.path.normpath(os.path.join(dirname, path))
+
+  lines = []
+  for line in infile:
+    if update_makefiles.Continues(line):
+      lines.append(line[:-2])
+      continue
+    lines.append(line)
+    rule = ' '.join(lines)
+    lines = []
+
+    separator = RULE_SEPARATOR_PATTERN.search(rule)
+    if separator is None:
+      continue
+    prerequisites = SplitDependencyTokens(rule[separator.end():])
+    if prerequisites:
+      yield ([Normalize(t) for t in
+              SplitDependencyTokens(rule[:separator.start()])],
+             [Normalize(p) for p in prerequisites])
+
+
+class DependencyIndex(object):
+  """Inverted index from every prerequisite in the tree's .d files to the
+  objects that depend on it.
+
+  Every path is stored once, in paths, and referred to everywhere else by its
+  position in that list. The rules read from each .d file are kept in an
+  array of those ids, so that Refresh() only needs to reread the .d files
+  that have changed. The inverted index is built from those arrays on demand,
+  as a pair of arrays in compressed sparse row form: the ids of the objects
+  depending on the path with id i are dependents[offsets[i]:offsets[i + 1]].
+
+  Paths stop being referenced as .d files change or are removed. Compact()
+  drops them and renumbers the rest; Save() always compacts, and Refresh()
+  does once more than MAX_DEAD_FRACTION of paths are unreferenced.
+
+  Like ParseCache, the mtime of a .d file modified within RACY_SECS of being
+  read isn't trusted, so that a second write within the same timestamp
+  granularity isn't missed.
+
+  Attributes:
+    paths: list of every target and prerequisite path
+    path_ids: hash of path -> index into paths
+    files: hash of .d file path -> (size, mtime, rules), where mtime is None
+      if the file was modified too recently to trust, and rules is an
+      array('i') holding, for each rule with prerequisites, the id of each of
+      its targets followed by the number of prerequisites and their ids; see
+      _IterRules()
+    tree: update_makefiles.TreeSnapshot used to find .d and object files
+    modified: True if files has changed since the index was loaded
+  """
+
+  VERSION = 1
+  RACY_SECS = 2
+  MAX_DEAD_FRACTION = 0.5
+
+  def __init__(self):
+    self.paths = []
+    self.path_ids = {}
+    self.files = {}
+    self.tree = update_makefiles.TreeSnapshot()
+    self.modified = False
+    self._offsets = None
+    self._dependents = None
+
+  def _PathId(self, path):
+    """Returns the id of path, adding it to self.paths if necessary."""
+    path_id = self.path_ids.get(path)
+    if path_id is None:
+      path_id = len(self.paths)
+      self.paths.append(path)
+      self.path_ids[path] = path_id
+    return path_id
+
+  @staticmethod
+  def _IterRules(rules):
+    """Yields (target id, prerequisite ids) for every target in rules."""
+    i = 0
+    while i != len(rules):
+      target = rules[i]
+      num_prerequisites = rules[i + 1]
+      i += 2
+      yield target, rules[i:i + num_prerequisites]
+      i += num_prerequisites
+
+  def Compact(self, max_dead_fraction=0):
+    """Drops the paths no longer referenced by self.files.
+
+    The remaining paths keep their order but are renumbered, so every rules
+    array is rewritten.
+
+    Args:
+      max_dead_fraction: fraction of self.paths which may be unreferenced
+        before they are dropped
+    Returns:
+      the number of paths dropped
+    """
+    live = set()
+    for _, _, rules in self.files.itervalues():
+      for target, prerequisites in DependencyIndex._IterRules(rules):
+        live.add(target)
+        live.update(prerequisites)
+    num_dead = len(self.paths) - len(live)
+    if not num_dead or num_dead <= len(self.paths) * max_dead_fraction:
+      return 0
+
+    live = sorted(live)
+    new_ids = array.array('i', [-1]) * len(self.paths)
+    for new_id, old_id in enumerate(live):
+      new_ids[old_id] = new_id
+    for dep_path, (size, mtime, rules) in self.files.iteritems():
+      renumbered = array.array('i')
+      for target, prerequisites in DependencyIndex._IterRules(rules):
+        renumbered.append(new_ids[target])
+        renumbered.append(len(prerequisites))
+        renumbered.extend(new_ids[p] for p in prerequisites)
+      self.files[dep_path] = (size, mtime, renumbered)
+    self.paths = [self.paths[i] for i in live]
+    self.path_ids = dict((p, i) for i, p in enumerate(self.paths))
+    self._offsets = None
+    self._dependents = None
+    return num_dead
+
+  def Load(self, path):
+    """Reads a previously saved index from path, if it exists and is valid."""
+    try:
+      with open(path, 'rb') as index_file:
+        version, paths, files = cPickle.load(index_file)
+    except (IOError, EOFError, ValueError, TypeError,
+            cPickle.UnpicklingError):
+      return
+    if version == DependencyIndex.VERSION:
+      self.paths = paths
+      self.path_ids = dict((p, i) for i, p in enumerate(paths))
+      self.files = files
+      self.modified = False
+      self._offsets = None
+
+  def Save(self, path):
+    """Writes the index to path if it has changed since Load()."""
+    if not self.modified:
+      return
+    self.Compact()
+    updated_name = '%s.updated' % path
+    with open(updated_name, 'wb') as index_file:
+      cPickle.dump((DependencyIndex.VERSION, self.paths, self.files),
+          index_file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(updated_name, path)
+    self.modified = False
+
+  def ListDependencyFiles(self):
+    """Returns the sorted paths of every .d file in the tree.
+
+    Directories whose names end in .d (e.g. conf.d) are skipped, since the
+    tree's entries don't distinguish them from files.
+    """
+    dep_paths = (os.path.normpath(os.path.join(dirpath, name))
+                 for dirpath, names in self.tree.entries.iteritems()
+                 for name in names if name.endswith('.d'))
+    return sorted(p for p in dep_paths if os.path.isfile(p))
+
+  def ReadFile(self, dep_path):
+    """Reads the rules from dep_path into an array of path ids.
+
+    Args:
+      dep_path: path of a .d file relative to the top of the tree
+    Returns:
+      array('i') in the format described for self.files
+    """
+    rules = array.array('i')
+    with open(dep_path) as infile:
+      for targets, prerequisites in ReadDependencyRules(
+          infile, os.path.dirname(dep_path)):
+        prerequisite_ids = [self._PathId(p) for p in prerequisites]
+        for target in targets:
+          rules.append(self._PathId(target))
+          rules.append(len(prerequisite_ids))
+          rules.extend(prerequisite_ids)
+    return rules
+
+  def Refresh(self):
+    """Rereads every .d file created or modified since the last call.
+
+    Returns:
+      the set of paths of the .d files that were read or removed
+    """
+    self.tree.Refresh()
+    dep_paths = self.ListDependencyFiles()
+    changed = set(self.files).difference(dep_paths)
+    for dep_path in changed:
+      del self.files[dep_path]
+
+    for dep_path in dep_paths:
+      stat = os.stat(dep_path)
+      entry = self.files.get(dep_path)
+      if (entry is not None and entry[0] == stat.st_size and
+          entry[1] == stat.st_mtime):
+        continue
+      mtime = stat.st_mtime
+      if mtime > time.time() - DependencyIndex.RACY_SECS:
+        mtime = None
+      self.files[dep_path] = (stat.st_size, mtime, self.ReadFile(dep_path))
+      changed.add(dep_path)
+
+    if changed:
+      self.modified = True
+      self._offsets = None
+      self.Compact(DependencyIndex.MAX_DEAD_FRACTION)
+    return changed
+
+  def _BuildInvertedIndex(self):
+    """Builds self._offsets and self._dependents from self.files."""
+    offsets = array.array('i', [0]) * (len(self.paths) + 1)
+    for _, _, rules in self.files.itervalues():
+      for _, prerequisites in DependencyIndex._IterRules(rules):
+        for prerequisite in prerequisites:
+          offsets[prerequisite + 1] += 1
+    for i in xrange(len(self.paths)):
+      offsets[i + 1] += offsets[i]
+
+    dependents = array.array('i', [0]) * offsets[-1]
+    next_slot = offsets[:-1]
+    for _, _, rules in self.files.itervalues():
+      for target, prerequisites in DependencyIndex._IterRules(rules):
+        for prerequisite in prerequisites:
+          dependents[next_slot[prerequisite]] = target
+          next_slot[prerequisite] += 1
+    self._offsets = offsets
+    self._dependents = dependents
+
+  def Dependents(self, path):
+    """Returns the sorted list of objects depending directly on path.
+
+    Args:
+      path: path relative to the top of the tree
+    """
+    path_id = self.path_ids.get(os.path.normpath(path))
+    if path_id is None:
+      return []
+    if self._offsets is None:
+      self._BuildInvertedIndex()
+    ids = self._dependents[self._offsets[path_id]:self._offsets[path_id + 1]]
+    return sorted(set(self.paths[i] for i in ids))
+
+  def Rebuilds(self, paths):
+    """Returns the sorted list of objects rebuilt if any of paths change."""
+    objects = set()
+    for path in paths:
+      objects.update(self.Dependents(path))
+    return sorted(objects)
+
+  def Check(self):
+    """Finds objects without .d files, and .d files that are out of date.
+
+    Only objects compiled from C sources are expected to have .d files;
+    assembler sources don't produce them. Refresh() must be called first.
+
+    A .d file is stale if:
+    - the object it describes no longer exists
+    - one of its prerequisites no longer exists
+    - the object was compiled after its source last changed, but the .d file
+      wasn't regenerated at the same time
+
+    Returns:
+      sorted list of (path, description of the problem) tuples
+    """
+    def MTime(path):
+      try:
+        return os.stat(path).st_mtime
+      except OSError:
+        return None
+
+    problems = []
+    for dirpath, names in self.tree.entries.iteritems():
+      for name in names:
+        stem = name[:-2]
+        if (name.endswith('.o') and '%s.c' % stem in names and
+            '%s.d' % stem not in names):
+          problems.append((os.path.normpath(os.path.join(dirpath, name)),
+                           'no .d file'))
+
+    missing = {}
+    for dep_path, (_, _, rules) in self.files.iteritems():
+      dep_mtime = MTime(dep_path)
+      for target, prerequisites in DependencyIndex._IterRules(rules):
+        target_path = self.paths[target]
+        target_mtime = MTime(target_path)
+        if target_mtime is None:
+          problems.append((dep_path, 'object %s is missing' % target_path))
+          continue
+        for prerequisite in prerequisites:
+          if prerequisite not in missing:
+            missing[prerequisite] = not self.tree.Exists(
+                self.paths[prerequisite])
+          if missing[prerequisite]:
+            problems.append((dep_path, 'prerequisite %s is missing' %
+                             self.paths[prerequisite]))
+        # The compiler always lists the source file first.
+        source_path = self.paths[prerequisites[0]]
+        source_mtime = MTime(source_path)
+        if (source_mtime is not None and dep_mtime < source_mtime and
+            source_mtime <= target_mtime):
+          problems.append((dep_path, 'older than %s' % source_path))
+    return sorted(problems)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--cache',
+        help='File in which to save the index between runs, so that only '
+        'changed .d files are read again')
+  parser.add_argument('--rebuilds',
+        help='Print the objects rebuilt if any of these files change',
+        nargs='+', default=[])
+  parser.add_argument('--check',
+        help='Report objects without .d files and stale .d files; exits '
+        'nonzero if there are any',
+        action='store_true')
+  args = parser.parse_args()
+
+  index = DependencyIndex()
+  if args.cache:
+    index.Load(args.cache)
+  index.Refresh()
+  if args.cache:
+    index.Save(args.cache)
+
+  for path in index.Rebuilds(args.rebuilds):
+    print path
+
+  problems = args.check and index.Check() or []
+  for path, problem in problems:
+    print >>sys.stderr, '%s: %s' % (path, problem)
+  sys.exit(problems and 1 or 0)
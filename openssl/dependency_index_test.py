@@ -0,0 +1,179 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Unit tests for dependency_index.py.
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import dependency_index
+
+import os
+import os.path
+import shutil
+import StringIO
+import tempfile
+import time
+import unittest
+
+AES_CORE_D = """aes_core.o: aes_core.c ../../include/openssl/aes.h \\
+ ../../include/openssl/opensslconf.h aes_locl.h
+../../include/openssl/aes.h:
+../../include/openssl/opensslconf.h:
+aes_locl.h:
+"""
+
+AES_CBC_D = """aes_cbc.o: aes_cbc.c ../../include/openssl/aes.h \\
+ ../modes/modes.h
+../../include/openssl/aes.h:
+../modes/modes.h:
+"""
+
+
+class ReadDependencyRulesTest(unittest.TestCase):
+
+  def Read(self, content, dirname='crypto/aes'):
+    return list(dependency_index.ReadDependencyRules(
+        StringIO.StringIO(content), dirname))
+
+  def testJoinsContinuationLinesAndSkipsPhonyRules(self):
+    self.assertEqual(
+        [(['crypto/aes/aes_core.o'],
+          ['crypto/aes/aes_core.c', 'include/openssl/aes.h',
+           'include/openssl/opensslconf.h', 'crypto/aes/aes_locl.h'])],
+        self.Read(AES_CORE_D))
+
+  def testEscapedCharacters(self):
+    self.assertEqual(
+        [(['my obj.o'], ['my src.c', '/usr/include/$dollar.h', 'a#b.h'])],
+        self.Read('my\\ obj.o: my\\ src.c /usr/include/$$dollar.h a\\#b.h\n',
+                  ''))
+
+  def testMultipleTargets(self):
+    self.assertEqual([(['a.o', 'a.s'], ['a.c'])], self.Read('a.o a.s: a.c\n',
+                                                            ''))
+
+
+class DependencyIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.orig_dir = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    os.makedirs('crypto/aes')
+    os.makedirs('crypto/modes')
+    os.makedirs('include/openssl')
+    for path in ['include/openssl/aes.h', 'include/openssl/opensslconf.h',
+                 'crypto/aes/aes_locl.h', 'crypto/modes/modes.h',
+                 'crypto/aes/aes_core.c', 'crypto/aes/aes_cbc.c',
+                 'crypto/aes/aes-x86_64.s']:
+      self.WriteFile(path, '', -20)
+    for path in ['crypto/aes/aes_core.o', 'crypto/aes/aes_cbc.o',
+                 'crypto/aes/aes-x86_64.o']:
+      self.WriteFile(path, '', -10)
+    self.WriteFile('crypto/aes/aes_core.d', AES_CORE_D, -10)
+    self.WriteFile('crypto/aes/aes_cbc.d', AES_CBC_D, -10)
+    self.index = dependency_index.DependencyIndex()
+    self.index.Refresh()
+
+  def tearDown(self):
+    os.chdir(self.orig_dir)
+    shutil.rmtree(self.tmpdir)
+
+  def WriteFile(self, path, content, age):
+    with open(path, 'w') as f:
+      f.write(content)
+    mtime = time.time() + age
+    os.utime(path, (mtime, mtime))
+
+  def testDependents(self):
+    self.assertEqual(['crypto/aes/aes_cbc.o', 'crypto/aes/aes_core.o'],
+                     self.index.Dependents('include/openssl/aes.h'))
+    self.assertEqual(['crypto/aes/aes_cbc.o'],
+                     self.index.Dependents('./crypto/modes/modes.h'))
+    self.assertEqual([], self.index.Dependents('include/openssl/sha.h'))
+    self.assertEqual(['crypto/aes/aes_cbc.o', 'crypto/aes/aes_core.o'],
+                     self.index.Rebuilds(['crypto/aes/aes_locl.h',
+                                          'crypto/modes/modes.h']))
+
+  def testRefreshRereadsOnlyChangedFiles(self):
+    self.assertEqual(set(), self.index.Refresh())
+    self.WriteFile('crypto/aes/aes_cbc.d', 'aes_cbc.o: aes_cbc.c\n', -5)
+    self.assertEqual(set(['crypto/aes/aes_cbc.d']), self.index.Refresh())
+    self.assertEqual(['crypto/aes/aes_core.o'],
+                     self.index.Dependents('include/openssl/aes.h'))
+
+    os.remove('crypto/aes/aes_core.d')
+    self.assertEqual(set(['crypto/aes/aes_core.d']), self.index.Refresh())
+    self.assertEqual([], self.index.Dependents('include/openssl/aes.h'))
+
+  def testRefreshSkipsDirectories(self):
+    os.makedirs('crypto/aes/conf.d')
+    self.assertEqual(set(), self.index.Refresh())
+    self.assertEqual(['crypto/aes/aes_cbc.d', 'crypto/aes/aes_core.d'],
+                     self.index.ListDependencyFiles())
+
+  def testSaveAndLoad(self):
+    cache_path = os.path.join(self.tmpdir, 'index.cache')
+    self.index.Save(cache_path)
+    loaded = dependency_index.DependencyIndex()
+    loaded.Load(cache_path)
+    self.assertEqual(set(), loaded.Refresh())
+    self.assertEqual(self.index.Dependents('include/openssl/aes.h'),
+                     loaded.Dependents('include/openssl/aes.h'))
+
+  def testCompactDropsUnreferencedPaths(self):
+    num_paths = len(self.index.paths)
+    self.WriteFile('crypto/aes/aes_cbc.d', 'aes_cbc.o: aes_cbc.c\n', -5)
+    self.index.Refresh()
+    # Only crypto/modes/modes.h is no longer referenced.
+    self.assertEqual(num_paths, len(self.index.paths))
+
+    cache_path = os.path.join(self.tmpdir, 'index.cache')
+    self.index.Save(cache_path)
+    self.assertEqual(num_paths - 1, len(self.index.paths))
+    self.assertNotIn('crypto/modes/modes.h', self.index.path_ids)
+    loaded = dependency_index.DependencyIndex()
+    loaded.Load(cache_path)
+    for index in [self.index, loaded]:
+      self.assertEqual(['crypto/aes/aes_core.o'],
+                       index.Dependents('include/openssl/aes.h'))
+      self.assertEqual(['crypto/aes/aes_cbc.o'],
+                       index.Dependents('crypto/aes/aes_cbc.c'))
+      self.assertEqual([], index.Dependents('crypto/modes/modes.h'))
+
+    # Removing most of the paths compacts without waiting for Save().
+    os.remove('crypto/aes/aes_core.d')
+    self.index.Refresh()
+    self.assertEqual(['crypto/aes/aes_cbc.c', 'crypto/aes/aes_cbc.o'],
+                     sorted(self.index.paths))
+    self.assertEqual(['crypto/aes/aes_cbc.o'],
+                     self.index.Dependents('crypto/aes/aes_cbc.c'))
+
+  def testCheck(self):
+    self.assertEqual([], self.index.Check())
+
+    os.remove('crypto/aes/aes_cbc.d')
+    os.remove('crypto/modes/modes.h')
+    self.WriteFile('crypto/aes/aes_core.c', '', -5)
+    self.WriteFile('crypto/aes/aes_core.o', '', 0)
+    self.index.Refresh()
+    self.assertEqual(
+        [('crypto/aes/aes_cbc.o', 'no .d file'),
+         ('crypto/aes/aes_core.d', 'older than crypto/aes/aes_core.c')],
+        self.index.Check())
+
+    self.WriteFile('crypto/aes/aes_cbc.d', AES_CBC_D, 0)
+    os.remove('crypto/aes/aes_core.o')
+    self.index.Refresh()
+    self.assertEqual(
+        [('crypto/aes/aes_cbc.d',
+          'prerequisite crypto/modes/modes.h is missing'),
+         ('crypto/aes/aes_core.d', 'object crypto/aes/aes_core.o is missing')],
+        self.index.Check())
+
+
+if __name__ == '__main__':
+  unittest.main()
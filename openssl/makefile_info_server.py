@@ -0,0 +1,259 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Resident server answering update_makefiles.py --print_common and
+--print_makefile queries.
+
+Parsing every Makefile in the tree dominates the time taken by each of those
+queries. The server parses them once, keeps the resulting MakefileInfo in
+memory, and reparses only the Makefiles that have changed since the previous
+query. Run from the top of the OpenSSL source tree:
+
+  $ python makefile_info_server.py --serve &
+  $ python makefile_info_server.py --print_common
+  $ python makefile_info_server.py --print_makefile crypto/aes/Makefile
+  $ python makefile_info_server.py --stop
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import update_makefiles
+
+import argparse
+import errno
+import os
+import os.path
+import socket
+import SocketServer
+import StringIO
+import sys
+
+# Default path of the server's Unix socket, relative to the top of the tree.
+SOCKET_PATH = '.makefile_info.sock'
+
+
+class MakefileInfoServer(object):
+  """Keeps a MakefileInfo up to date with the tree and answers queries.
+
+  Attributes:
+    info: update_makefiles.MakefileInfo for the current directory
+    watcher: update_makefiles.PollingWatcher for every Makefile in info
+  """
+
+  def __init__(self, parse_cache=None):
+    self.info = update_makefiles.MakefileInfo(parse_cache)
+    self.info.Init()
+    self.info.tree.Refresh()
+    self.watcher = update_makefiles.PollingWatcher(self._ListMakefiles())
+
+  def _ListMakefiles(self):
+    """Returns the paths of the Makefiles MakefileInfo.Init() would parse."""
+    paths = set(['configure.mk.org'])
+    for dirname, names in self.info.tree.entries.iteritems():
+      if 'Makefile' in names:
+        paths.add(os.path.normpath(os.path.join(dirname, 'Makefile')))
+    return sorted(paths)
+
+  def Invalidate(self):
+    """Reparses the Makefiles created, modified or removed since the last call.
+
+    If a Makefile can't be parsed, self.info and self.watcher are left as they
+    were, so that the same Makefiles are reparsed by the next call.
+
+    Returns:
+      the set of paths of the Makefiles that changed
+    Raises:
+      UpdateMakefilesException if a changed Makefile can't be parsed
+    """
+    self.info.tree.Refresh()
+    stats = self.watcher.stats
+    changed = self.watcher.Poll()
+    paths = self._ListMakefiles()
+    watcher = self.watcher
+    if paths != watcher.paths:
+      changed.update(set(paths).symmetric_difference(watcher.paths))
+      watcher = update_makefiles.PollingWatcher(paths)
+    if changed:
+      try:
+        self.info.Refresh(sorted(changed))
+      except update_makefiles.UpdateMakefilesException:
+        self.watcher.stats = stats
+        raise
+    self.watcher = watcher
+    return changed
+
+  def Query(self, request):
+    """Answers a single query after bringing self.info up to date.
+
+    Args:
+      request: 'print_common', or 'print_makefile' followed by a Makefile path
+    Returns:
+      (ok, output): ok is False if the request couldn't be answered, in which
+        case output is an error message
+    """
+    command, _, arg = request.strip().partition(' ')
+    try:
+      self.Invalidate()
+    except update_makefiles.UpdateMakefilesException, e:
+      return False, '%s\n' % e
+
+    orig_stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+      if command == 'print_common':
+        self.info.PrintCommonVarsAndTargets()
+      elif command == 'print_makefile':
+        makefile = self.info.all_makefiles.get(os.path.normpath(arg))
+        if makefile is None:
+          return False, 'Unknown Makefile: %s\n' % arg
+        print makefile
+      else:
+        return False, 'Unknown request: %s\n' % request.strip()
+      return True, sys.stdout.getvalue()
+    finally:
+      sys.stdout = orig_stdout
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+  """Reads one request line and writes 'OK' or 'ERROR' plus the output."""
+
+  def handle(self):
+    request = self.rfile.readline()
+    if not request:
+      # A connection probe, e.g. from RemoveStaleSocket().
+      return
+    if request.strip() == 'stop':
+      self.server.stopped = True
+      ok, output = True, ''
+    else:
+      ok, output = self.server.info_server.Query(request)
+    self.wfile.write('%s\n%s' % (ok and 'OK' or 'ERROR', output))
+
+
+def RemoveStaleSocket(socket_path):
+  """Removes socket_path if no server is listening on it.
+
+  Raises:
+    UpdateMakefilesException if a server is already listening on socket_path
+  """
+  if not os.path.exists(socket_path):
+    return
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except socket.error, e:
+    if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+      raise
+    os.remove(socket_path)
+    return
+  finally:
+    sock.close()
+  raise update_makefiles.UpdateMakefilesException(
+      'A server is already listening on %s' % socket_path)
+
+
+def Serve(info_server, socket_path=SOCKET_PATH):
+  """Answers requests on socket_path until a 'stop' request arrives.
+
+  Requests are handled one at a time, since MakefileInfo isn't thread-safe.
+
+  Args:
+    info_server: MakefileInfoServer answering the queries
+    socket_path: path of the Unix socket on which to listen
+  """
+  RemoveStaleSocket(socket_path)
+  server = SocketServer.UnixStreamServer(socket_path, _RequestHandler)
+  server.info_server = info_server
+  server.stopped = False
+  try:
+    while not server.stopped:
+      server.handle_request()
+  finally:
+    server.server_close()
+    os.remove(socket_path)
+
+
+def SendRequest(request, socket_path=SOCKET_PATH):
+  """Sends request to the server listening on socket_path.
+
+  Args:
+    request: request line, as accepted by MakefileInfoServer.Query()
+    socket_path: path of the server's Unix socket
+  Returns:
+    (ok, output), as returned by MakefileInfoServer.Query()
+  Raises:
+    UpdateMakefilesException if no server is listening on socket_path
+  """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    try:
+      sock.connect(socket_path)
+    except socket.error, e:
+      raise update_makefiles.UpdateMakefilesException(
+          'No server listening on %s (%s); start one with --serve' %
+          (socket_path, e.strerror))
+    sock.sendall('%s\n' % request)
+    sock.shutdown(socket.SHUT_WR)
+    chunks = []
+    while True:
+      chunk = sock.recv(65536)
+      if not chunk:
+        break
+      chunks.append(chunk)
+  finally:
+    sock.close()
+
+  status, _, output = ''.join(chunks).partition('\n')
+  return status == 'OK', output
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--serve',
+        help='Parse the Makefiles and answer queries until stopped',
+        action='store_true')
+  parser.add_argument('--stop',
+        help='Stop the running server',
+        action='store_true')
+  parser.add_argument('--print_common',
+        help='Print common targets and vars',
+        action='store_true')
+  parser.add_argument('--print_makefile',
+        help='Print the specified Makefile object')
+  parser.add_argument('--socket',
+        help='Path of the server\'s Unix socket',
+        default=SOCKET_PATH)
+  parser.add_argument('--parse_cache',
+        help='Used by --serve; see update_makefiles.py --parse_cache')
+  args = parser.parse_args()
+
+  try:
+    if args.serve:
+      parse_cache = None
+      if args.parse_cache:
+        parse_cache = update_makefiles.ParseCache(args.parse_cache)
+        parse_cache.Load()
+      info_server = MakefileInfoServer(parse_cache)
+      print 'Listening on %s' % args.socket
+      sys.stdout.flush()
+      Serve(info_server, args.socket)
+      sys.exit(0)
+
+    if args.stop:
+      request = 'stop'
+    elif args.print_common:
+      request = 'print_common'
+    elif args.print_makefile:
+      request = 'print_makefile %s' % args.print_makefile
+    else:
+      parser.error('one of --serve, --stop, --print_common or '
+                   '--print_makefile is required')
+    ok, output = SendRequest(request, args.socket)
+  except update_makefiles.UpdateMakefilesException, e:
+    print >>sys.stderr, e
+    sys.exit(1)
+
+  (ok and sys.stdout or sys.stderr).write(output)
+  sys.exit(not ok and 1 or 0)
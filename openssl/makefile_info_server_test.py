@@ -0,0 +1,121 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Unit tests for makefile_info_server.py.
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import makefile_info_server
+import update_makefiles
+
+import os
+import os.path
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+
+class MakefileInfoServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.orig_dir = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    for d in ['aes', 'sha']:
+      os.mkdir(d)
+    self.WriteFile('Makefile', 'DIRS= aes sha\n')
+    self.WriteFile('aes/Makefile', 'LIB= libcrypto.a\n\nall: lib\n')
+    self.WriteFile('sha/Makefile', 'SHA= sha1.o\n\nall: lib\n')
+    sys.stdout = StringIO.StringIO()
+    self.server = makefile_info_server.MakefileInfoServer()
+    sys.stdout = sys.__stdout__
+
+  def tearDown(self):
+    sys.stdout = sys.__stdout__
+    os.chdir(self.orig_dir)
+    shutil.rmtree(self.tmpdir)
+
+  def WriteFile(self, path, content):
+    with open(path, 'w') as f:
+      f.write(content)
+    # Make sure the size or mtime changes even within the same timestamp tick.
+    mtime = time.time() + len(content)
+    os.utime(path, (mtime, mtime))
+
+  def Query(self, request):
+    ok, output = self.server.Query(request)
+    self.assertTrue(ok, output)
+    return output
+
+  def testPrintMakefile(self):
+    output = self.Query('print_makefile aes/Makefile')
+    self.assertIn('LIB', output)
+
+  def testUnknownRequestsAndMakefiles(self):
+    self.assertEqual((False, 'Unknown Makefile: ssl/Makefile\n'),
+                     self.server.Query('print_makefile ssl/Makefile'))
+    self.assertEqual((False, 'Unknown request: print_everything\n'),
+                     self.server.Query('print_everything'))
+
+  def testInvalidatesModifiedMakefiles(self):
+    self.assertNotIn('SHA_ASM', self.Query('print_makefile sha/Makefile'))
+    self.WriteFile('sha/Makefile', 'SHA= sha1.o\nSHA_ASM= sha1-586.o\n')
+    self.assertIn('SHA_ASM', self.Query('print_makefile sha/Makefile'))
+
+  def testInvalidatesCreatedAndRemovedMakefiles(self):
+    self.assertNotIn('LIB', self.Query('print_common'))
+    os.mkdir('ssl')
+    self.WriteFile('ssl/Makefile', 'LIB= libssl.a\n')
+    self.assertEqual(set(['ssl/Makefile']), self.server.Invalidate())
+    self.assertIn('LIB', self.Query('print_common'))
+
+    os.remove('ssl/Makefile')
+    self.assertEqual(set(['ssl/Makefile']), self.server.Invalidate())
+    self.assertNotIn('LIB', self.Query('print_common'))
+    self.assertEqual(set(), self.server.Invalidate())
+
+  def testInvalidMakefileIsReparsedOnceFixed(self):
+    os.mkdir('ssl')
+    self.WriteFile('ssl/Makefile', 'LIB= libssl.a\n')
+    self.WriteFile('sha/Makefile', 'all: lib\n\techo\nall: lib\n\techo\n')
+    ok, output = self.server.Query('print_common')
+    self.assertFalse(ok)
+    self.assertIn('duplicate recipes for all', output)
+    self.assertEqual((False, output), self.server.Query('print_common'))
+
+    self.WriteFile('sha/Makefile', 'SHA= sha1.o\nSHA_ASM= sha1-586.o\n')
+    self.assertIn('SHA_ASM', self.Query('print_makefile sha/Makefile'))
+    self.assertIn('LIB', self.Query('print_common'))
+
+  def testServeAndSendRequest(self):
+    socket_path = os.path.join(self.tmpdir, 'test.sock')
+    server_thread = threading.Thread(target=makefile_info_server.Serve,
+                                     args=(self.server, socket_path))
+    server_thread.start()
+    try:
+      while not os.path.exists(socket_path):
+        time.sleep(0.01)
+      self.assertEqual(self.server.Query('print_makefile aes/Makefile'),
+          makefile_info_server.SendRequest('print_makefile aes/Makefile',
+                                           socket_path))
+      self.assertRaises(update_makefiles.UpdateMakefilesException,
+                        makefile_info_server.RemoveStaleSocket, socket_path)
+    finally:
+      self.assertEqual((True, ''),
+          makefile_info_server.SendRequest('stop', socket_path))
+      server_thread.join()
+    self.assertFalse(os.path.exists(socket_path))
+    self.assertRaises(update_makefiles.UpdateMakefilesException,
+                      makefile_info_server.SendRequest, 'print_common',
+                      socket_path)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -23,68 +23,57 @@ import os.path
 def MoveDcleanActionsToCleanTarget(infile, outfile, makefile):
   """Moves all dclean actions to clean targets, then removes dclean targets.
 
+  The clean and dclean rules are located by the Spans that
+  update_makefiles.ParseMakefileContent() records for them, and the edits are
+  spliced into the original content with update_makefiles.SpliceMakefile().
+
   Args:
     infile: Makefile to read
     outfile: Makefile to write
     makefile: update_makefiles.Makefile object containing current variable and
       target info
   """
-  clean_target = 'clean' in makefile.targets and makefile.targets['clean']
-  dclean_target = 'dclean' in makefile.targets and makefile.targets['dclean']
-  updated_clean_target = False
-  deleted_dclean_target = False
-  skip_if_followed_by_blank = False
-  skip_lines = 0
-  for line in infile:
-    if skip_lines:
-      skip_lines -= 1
-      continue
-    if skip_if_followed_by_blank:
-      skip_if_followed_by_blank = False
-      if line == '\n':
-        continue
-
-    target_match = update_makefiles.TARGET_PATTERN.match(line)
-    if target_match:
-      target_name = target_match.group(1)
-
-      if target_name == 'clean' and dclean_target:
-        prerequisites = [clean_target.prerequisites.rstrip()]
-        prerequisites.append(dclean_target.prerequisites.rstrip())
-        prerequisites = ' '.join([p for p in prerequisites if p])
-
-        recursive_clean = '\t@target=clean; $(RECURSIVE_MAKE)\n'
-        recursive_dclean = '\t@target=dclean; $(RECURSIVE_MAKE)\n'
-
-        has_recursive_clean = recursive_clean in clean_target.recipe
-        clean_recipe = clean_target.recipe.replace(recursive_clean, '')
-        recipe = [clean_target.recipe.rstrip()]
-
-        dclean_recipe = dclean_target.recipe.replace(recursive_dclean, '')
-        recipe.append(dclean_recipe.rstrip())
-        if has_recursive_clean:
-          recipe.append(recursive_clean.rstrip())
-        recipe = '\n'.join([r for r in recipe if r])
-
-        updated_clean = 'clean:%s\n%s' % (prerequisites, recipe)
-        skip_lines = clean_target.num_lines - 1
-        print >>outfile, updated_clean
-        updated_clean_target = True
-        continue
-
-      elif target_name == 'dclean':
-        skip_lines = dclean_target.num_lines - 1
-        deleted_dclean_target = True
-        skip_if_followed_by_blank = True
-        continue
-
-    print >>outfile, line,
-
-  assert (updated_clean_target and deleted_dclean_target) or not (
-          updated_clean_target or deleted_dclean_target)
-
-  if updated_clean_target:
-    print '%s: moved dclean actions to clean target' % infile.name
+  content = infile.read()
+  clean_target = makefile.targets.get('clean')
+  dclean_target = makefile.targets.get('dclean')
+  if dclean_target is None:
+    outfile.write(content)
+    return
+  assert clean_target is not None, '%s: dclean without clean' % infile.name
+
+  prerequisites = [clean_target.prerequisites.rstrip()]
+  prerequisites.append(dclean_target.prerequisites.rstrip())
+  prerequisites = ' '.join([p for p in prerequisites if p])
+
+  recursive_clean = '\t@target=clean; $(RECURSIVE_MAKE)\n'
+  recursive_dclean = '\t@target=dclean; $(RECURSIVE_MAKE)\n'
+
+  # The recursive clean moves after the dclean actions, so that they run in
+  # this directory before its subdirectories are cleaned.
+  has_recursive_clean = recursive_clean in clean_target.recipe
+  clean_recipe = clean_target.recipe.replace(recursive_clean, '')
+  recipe = [clean_recipe.rstrip()]
+
+  dclean_recipe = dclean_target.recipe.replace(recursive_dclean, '')
+  recipe.append(dclean_recipe.rstrip())
+  if has_recursive_clean:
+    recipe.append(recursive_clean.rstrip())
+  recipe = '\n'.join([r for r in recipe if r])
+
+  def Removal(span):
+    """Removes span along with the blank line following it, if any."""
+    if content[span.end:span.end + 1] == '\n':
+      span = span._replace(end=span.end + 1)
+    return span, ''
+
+  parsed = update_makefiles.ParseMakefileContent(content, infile.name)
+  clean_spans = parsed.targets['clean'].spans
+  edits = [(clean_spans[0], 'clean:%s\n%s\n' % (prerequisites, recipe))]
+  # Any further clean rules only add prerequisites, which are merged above.
+  edits.extend([Removal(span) for span in clean_spans[1:]])
+  edits.extend([Removal(span) for span in parsed.targets['dclean'].spans])
+  outfile.write(update_makefiles.SpliceMakefile(content, edits))
+  print '%s: moved dclean actions to clean target' % infile.name
 
 
 def UpdateMakefile(makefile_info, dirname, fnames):
@@ -97,7 +86,7 @@ def UpdateMakefile(makefile_info, dirname, fnames):
   """
   if 'Makefile' not in fnames: return
   makefile_path = os.path.join(dirname, 'Makefile')
-  makefile = info.all_makefiles[makefile_path]
+  makefile = makefile_info.all_makefiles[makefile_path]
 
   def MoveDcleanActionsToCleanTargetBinder(infile, outfile):
     """Binds the local Makefile to MoveDcleanActionsToCleanTarget()."""
@@ -0,0 +1,90 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Unit tests for move_dclean_to_clean.py.
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import move_dclean_to_clean
+import update_makefiles
+
+import StringIO
+import sys
+import unittest
+
+
+class MoveDcleanActionsToCleanTargetTest(unittest.TestCase):
+
+  def Move(self, content):
+    makefile = update_makefiles.ParseMakefileContent(
+        content, 'crypto/aes/Makefile', strict=True)
+    infile = StringIO.StringIO(content)
+    infile.name = 'crypto/aes/Makefile'
+    outfile = StringIO.StringIO()
+    sys.stdout = StringIO.StringIO()
+    try:
+      move_dclean_to_clean.MoveDcleanActionsToCleanTarget(
+          infile, outfile, makefile)
+    finally:
+      sys.stdout = sys.__stdout__
+    return outfile.getvalue()
+
+  def testMovesDcleanRecipe(self):
+    orig = (
+"""DIR= aes
+
+clean:
+\trm -f *.o *.obj lib tags core .pure .nfs* *.old *.bak fluff
+
+dclean:
+\t$(PERL) -pe 'if (/^# DO NOT DELETE THIS LINE/) {print; exit(0);}' $(MAKEFILE) >Makefile.new
+\tmv -f Makefile.new $(MAKEFILE)
+
+# DO NOT DELETE THIS LINE -- make depend depends on it.
+""")
+    expected = (
+"""DIR= aes
+
+clean:
+\trm -f *.o *.obj lib tags core .pure .nfs* *.old *.bak fluff
+\t$(PERL) -pe 'if (/^# DO NOT DELETE THIS LINE/) {print; exit(0);}' $(MAKEFILE) >Makefile.new
+\tmv -f Makefile.new $(MAKEFILE)
+
+# DO NOT DELETE THIS LINE -- make depend depends on it.
+""")
+    self.assertMultiLineEqual(expected, self.Move(orig))
+
+  def testRecursiveCleanRunsLastAndOnce(self):
+    orig = (
+"""dclean: bar
+\trm -f *.d
+\t@target=dclean; $(RECURSIVE_MAKE)
+
+clean: foo
+\trm -f *.o
+\t@target=clean; $(RECURSIVE_MAKE)
+
+clean: baz
+
+all: lib
+""")
+    expected = (
+"""clean: foo  baz  bar
+\trm -f *.o
+\trm -f *.d
+\t@target=clean; $(RECURSIVE_MAKE)
+
+all: lib
+""")
+    self.assertMultiLineEqual(expected, self.Move(orig))
+
+  def testNoDcleanTarget(self):
+    orig = 'clean:\n\trm -f *.o\n\nall: lib\n'
+    self.assertEqual(orig, self.Move(orig))
+
+
+if __name__ == '__main__':
+  unittest.main()
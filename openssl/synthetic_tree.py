@@ -0,0 +1,337 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Generates synthetic OpenSSL-like source trees for exercising
+update_makefiles.py.
+
+Each generated Makefile follows the layout of the OpenSSL 1.0.x Makefiles and
+contains the constructs update_makefiles.py rewrites: variables common to
+several Makefiles, multiline definitions with continuation lines, $(TOP)
+references, recursive $(MAKE) invocations, and a makedepend tail. Every
+source file the Makefiles name is created as well, since some updates check
+that the files they refer to exist.
+
+  $ python synthetic_tree.py --dirs 100 --depend_lines 200 /tmp/tree
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import update_makefiles
+
+import argparse
+import os
+import os.path
+
+CONFIGURE_MK = """PLATFORM=dist
+CC= cc
+CFLAG= -O
+DEPFLAG=
+MAKEDEPPROG= makedepend
+PERL= perl
+RANLIB= ranlib
+AR= ar $(ARFLAGS) r
+ARFLAGS=
+"""
+
+TOP_MAKEFILE = """VERSION=1.0.2
+PLATFORM=dist
+CC= cc
+CFLAG= -O
+TOP= .
+DIRS=   %(dirs)s
+SHLIBDIRS= crypto ssl
+LIBS=   libcrypto.a libssl.a
+
+all: build_all
+
+build_all: build_libs
+
+build_libs: build_crypto build_ssl
+
+build_crypto:
+\t@dir=crypto; target=all; $(BUILD_ONE_CMD)
+
+build_ssl:
+\t@dir=ssl; target=all; $(BUILD_ONE_CMD)
+
+clean:
+\trm -f *.o *.obj lib tags core .pure .nfs* *.old *.bak fluff
+
+files:
+\t$(PERL) $(TOP)/util/files.pl Makefile > $(TOP)/MINFO
+"""
+
+# Makefile.org is the template for the top-level Makefile.
+MAKEFILE_ORG = """VERSION=
+PLATFORM=dist
+CC= cc
+TOP= .
+
+all: build_all
+
+build_all:
+\t@echo build
+"""
+
+MAKEFILE_FIPS = """VERSION=
+PLATFORM=dist
+CC= cc
+"""
+
+MAKEFILE_SHARED = """CC=cc
+LIBNAME=
+"""
+
+SUBDIR_MAKEFILE = """#
+# OpenSSL/%(path)s
+#
+
+DIR=\t%(name)s
+TOP=\t%(top)s
+CC=\tcc
+CPP=\t$(CC) -E
+INCLUDES= -I.. -I$(TOP) -I../../include
+CFLAG=-g
+MAKEFILE=\tMakefile
+AR=\t\tar r
+%(vars)s
+CFLAGS= $(INCLUDES) $(CFLAG)
+ASFLAGS= $(INCLUDES) $(ASFLAG)
+AFLAGS= $(ASFLAGS)
+
+GENERAL=Makefile
+TEST=
+APPS=
+
+LIB=$(TOP)/libcrypto.a
+LIBSRC=%(srcs)s
+LIBOBJ=%(objs)s
+
+SRC= $(LIBSRC)
+
+EXHEADER= %(name)s.h
+HEADER=\t$(EXHEADER)
+
+ALL=    $(GENERAL) $(SRC) $(HEADER)
+
+top:
+\t(cd %(top)s; $(MAKE) DIRS=%(parent)s SDIRS=$(DIR) sub_all)
+
+all:\tlib
+
+lib:\t$(LIBOBJ)
+\t$(AR) $(LIB) $(LIBOBJ)
+\t$(RANLIB) $(LIB) || echo Never mind.
+\t@touch lib
+
+files:
+\t$(PERL) $(TOP)/util/files.pl Makefile >> $(TOP)/MINFO
+
+links:
+\t@$(PERL) $(TOP)/util/mklink.pl %(top)s/include/openssl $(EXHEADER)
+%(top_refs)s
+install:
+\t@[ -n "$(INSTALLTOP)" ] # should be set by top Makefile...
+\t@headerlist="$(EXHEADER)"; for i in $$headerlist ; \\
+\tdo  \\
+\t(cp $$i $(INSTALL_PREFIX)$(INSTALLTOP)/include/openssl/$$i; \\
+\tchmod 644 $(INSTALL_PREFIX)$(INSTALLTOP)/include/openssl/$$i ); \\
+\tdone;
+
+tags:
+\tctags $(SRC)
+
+tests:
+
+lint:
+\tlint -DLINT $(INCLUDES) $(SRC)>fluff
+%(targets)s
+depend:
+\t@[ -n "$(MAKEDEPEND)" ] # should be set by upper Makefile...
+\t$(MAKEDEPEND) -- $(CFLAG) $(INCLUDES) $(DEPFLAG) -- $(PROGS) $(LIBSRC)
+
+dclean:
+\t$(PERL) -pe 'if (/^# DO NOT DELETE THIS LINE/) {print; exit(0);}' \
+$(MAKEFILE) >Makefile.new
+\tmv -f Makefile.new $(MAKEFILE)
+
+clean:
+\trm -f *.s *.o *.obj lib tags core .pure .nfs* *.old *.bak fluff
+
+%(make_depend_line)s
+%(depend)s"""
+
+
+def WriteFile(root, path, content):
+  """Writes content to root/path, creating its directory if necessary."""
+  path = os.path.join(root, path)
+  dirname = os.path.dirname(path)
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  with open(path, 'w') as outfile:
+    outfile.write(content)
+
+
+def ListSubdirs(num_dirs):
+  """Returns the relative paths of num_dirs directories containing Makefiles.
+
+  As in OpenSSL, most are crypto subdirectories, plus crypto itself and the
+  ssl, apps and test directories.
+  """
+  subdirs = ['crypto', 'ssl', 'apps', 'test'][:num_dirs]
+  subdirs.extend(['crypto/sub%d' % i for i in range(num_dirs - len(subdirs))])
+  return subdirs
+
+
+def ContinuedWords(words, continuation_lines):
+  """Joins words into continuation_lines + 1 backslash-continued lines.
+
+  There are fewer lines if there are fewer words than lines.
+  """
+  num_lines = min(continuation_lines + 1, len(words))
+  lines = [' '.join(words[i * len(words) / num_lines:
+                          (i + 1) * len(words) / num_lines])
+           for i in range(num_lines)]
+  return ' \\\n\t'.join(lines)
+
+
+def SubdirMakefile(path, num_vars, num_targets, continuation_lines, top_refs,
+                   depend_lines):
+  """Returns the content of a synthetic Makefile and the sources it names.
+
+  Args:
+    path: path of the Makefile relative to the top of the tree
+    num_vars: number of extra variables; half have names common to every
+      Makefile, and half are unique to this one
+    num_targets: number of extra targets; half have common names
+    continuation_lines: number of continuation lines in each multiline
+      variable definition
+    top_refs: number of recipe lines containing $(TOP) references
+    depend_lines: number of lines after the makedepend line
+  Returns:
+    (Makefile content, list of source file names)
+  """
+  dirname = os.path.dirname(path)
+  name = os.path.basename(dirname)
+  top = '/'.join(['..'] * len(dirname.split('/')))
+  parent = os.path.dirname(dirname) or dirname
+  srcs = ['%s_%d.c' % (name, i) for i in range(continuation_lines + 2)]
+  objs = [s.replace('.c', '.o') for s in srcs]
+
+  variables = []
+  for i in range(num_vars):
+    var_name = i % 2 and '%s_VAR%d' % (name.upper(), i) or 'COMMON_VAR%d' % i
+    variables.append('%s= %s\n' % (var_name, ContinuedWords(
+        objs + ['$(CFLAG)'], i % 3 and continuation_lines or 0)))
+
+  targets = []
+  for i in range(num_targets):
+    target = i % 2 and '%s_target%d' % (name, i) or 'common_target%d' % i
+    targets.append('\n%s: %s\n\t$(CC) $(CFLAGS) -o $@ %s\n' % (
+        target, objs[i % len(objs)], objs[i % len(objs)]))
+
+  recipe = ['\t$(PERL) $(TOP)/util/files.pl -I$(TOP) $(TOP)/include/%s.h' %
+            name for i in range(top_refs)]
+  top_refs_target = top_refs and '\ntop_refs:\n%s\n' % '\n'.join(recipe) or ''
+
+  depend = []
+  for i in range(depend_lines):
+    depend.append('%s: %s/include/openssl/%s.h %s\n' % (
+        objs[i % len(objs)], top, name, srcs[i % len(srcs)]))
+
+  content = SUBDIR_MAKEFILE % {
+      'path': path,
+      'name': name,
+      'top': top,
+      'parent': parent,
+      'vars': ''.join(variables),
+      'srcs': ContinuedWords(srcs, continuation_lines),
+      'objs': ContinuedWords(objs, continuation_lines),
+      'top_refs': top_refs_target,
+      'targets': ''.join(targets),
+      'make_depend_line': update_makefiles.MAKE_DEPEND_LINE,
+      'depend': ''.join(depend),
+      }
+  return content, srcs
+
+
+def GenerateTree(root, num_dirs=20, num_vars=10, num_targets=10,
+                 continuation_lines=2, top_refs=4, depend_lines=50):
+  """Generates a synthetic OpenSSL-like source tree.
+
+  Args:
+    root: directory in which to generate the tree; created if necessary
+    num_dirs: number of directories below root containing a Makefile
+    num_vars: see SubdirMakefile()
+    num_targets: see SubdirMakefile()
+    continuation_lines: see SubdirMakefile()
+    top_refs: see SubdirMakefile()
+    depend_lines: see SubdirMakefile()
+  Returns:
+    the list of the directories containing Makefiles, relative to root
+  """
+  subdirs = ListSubdirs(num_dirs)
+  top_dirs = [d for d in subdirs if '/' not in d]
+  WriteFile(root, 'configure.mk.org', CONFIGURE_MK)
+  WriteFile(root, 'Makefile', TOP_MAKEFILE % {'dirs': ' '.join(top_dirs)})
+  WriteFile(root, 'Makefile.org', MAKEFILE_ORG)
+  WriteFile(root, 'Makefile.fips', MAKEFILE_FIPS)
+  WriteFile(root, 'Makefile.shared', MAKEFILE_SHARED)
+  WriteFile(root, 'util/files.pl', '#!/usr/bin/perl\n')
+  WriteFile(root, 'util/mklink.pl', '#!/usr/bin/perl\n')
+
+  for dirname in subdirs:
+    path = '%s/Makefile' % dirname
+    content, srcs = SubdirMakefile(path, num_vars, num_targets,
+                                   continuation_lines, top_refs, depend_lines)
+    WriteFile(root, path, content)
+    for src in srcs:
+      WriteFile(root, os.path.join(dirname, src), '/* %s */\n' % src)
+    WriteFile(root, 'include/openssl/%s.h' % os.path.basename(dirname),
+              '/* %s.h */\n' % os.path.basename(dirname))
+  return subdirs
+
+
+def AddTreeArguments(parser):
+  """Adds the GenerateTree() parameters to an argparse.ArgumentParser."""
+  parser.add_argument('--dirs',
+        help='Number of directories containing Makefiles',
+        default=20, type=int)
+  parser.add_argument('--vars',
+        help='Number of extra variables per Makefile',
+        default=10, type=int)
+  parser.add_argument('--targets',
+        help='Number of extra targets per Makefile',
+        default=10, type=int)
+  parser.add_argument('--continuation_lines',
+        help='Number of continuation lines per multiline definition',
+        default=2, type=int)
+  parser.add_argument('--top_refs',
+        help='Number of recipe lines containing $(TOP) per Makefile',
+        default=4, type=int)
+  parser.add_argument('--depend_lines',
+        help='Number of lines in each makedepend tail',
+        default=50, type=int)
+
+
+def TreeParams(args):
+  """Returns the GenerateTree() keyword arguments from parsed arguments."""
+  return {
+      'num_dirs': args.dirs,
+      'num_vars': args.vars,
+      'num_targets': args.targets,
+      'continuation_lines': args.continuation_lines,
+      'top_refs': args.top_refs,
+      'depend_lines': args.depend_lines,
+      }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('root', help='Directory in which to generate the tree')
+  AddTreeArguments(parser)
+  args = parser.parse_args()
+  dirs = GenerateTree(args.root, **TreeParams(args))
+  print 'Generated %d Makefiles in %s' % (len(dirs), args.root)
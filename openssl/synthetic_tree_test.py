@@ -0,0 +1,76 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Unit tests for synthetic_tree.py.
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import synthetic_tree
+import update_makefiles
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+
+class GenerateTreeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def Parse(self, path):
+    with open(os.path.join(self.tmpdir, path)) as infile:
+      return update_makefiles.ParseMakefile(infile)
+
+  def testGeneratesRequestedConstructs(self):
+    dirs = synthetic_tree.GenerateTree(
+        self.tmpdir, num_dirs=6, num_vars=4, num_targets=2,
+        continuation_lines=3, top_refs=5, depend_lines=7)
+    self.assertEqual(['crypto', 'ssl', 'apps', 'test', 'crypto/sub0',
+                      'crypto/sub1'], dirs)
+    for f in ['configure.mk.org', 'Makefile', 'Makefile.org',
+              'Makefile.fips', 'Makefile.shared']:
+      self.assertTrue(os.path.exists(os.path.join(self.tmpdir, f)), f)
+
+    makefile = self.Parse('crypto/sub1/Makefile')
+    for name in ['COMMON_VAR0', 'SUB1_VAR1', 'COMMON_VAR2', 'SUB1_VAR3']:
+      self.assertIn(name, makefile.variables)
+    self.assertIn('common_target0', makefile.targets)
+    self.assertIn('sub1_target1', makefile.targets)
+    self.assertEqual(3, makefile.variables['LIBSRC'].definition.count('\\\n'))
+    self.assertEqual(15, makefile.targets['top_refs'].recipe.count('$(TOP)'))
+    for src in makefile.variables['LIBSRC'].definition.split():
+      if src.endswith('.c'):
+        self.assertTrue(
+            os.path.exists(os.path.join(self.tmpdir, 'crypto/sub1', src)))
+
+    with open(os.path.join(self.tmpdir, 'crypto/sub1/Makefile')) as infile:
+      content = infile.read()
+    tail = content[content.index(update_makefiles.MAKE_DEPEND_LINE):]
+    self.assertEqual(7, tail.count('../../include/openssl/sub1.h'))
+
+  def testCommonNames(self):
+    synthetic_tree.GenerateTree(self.tmpdir, num_dirs=3, num_vars=2,
+                                num_targets=2)
+    orig_dir = os.getcwd()
+    os.chdir(self.tmpdir)
+    try:
+      info = update_makefiles.MakefileInfo()
+      info.Init()
+    finally:
+      os.chdir(orig_dir)
+    self.assertEqual(3, len(info.all_vars['COMMON_VAR0']))
+    self.assertEqual(1, len(info.all_vars['SSL_VAR1']))
+    self.assertEqual(3, len(info.all_targets['common_target0']))
+
+
+if __name__ == '__main__':
+  unittest.main()
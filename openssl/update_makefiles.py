@@ -27,18 +27,79 @@ License: Creative Commons Attribution 4.0 International (CC By 4.0)
 """
 
 import argparse
+import collections
+import cPickle
+import difflib
+import hashlib
+import json
+import multiprocessing
 import os
 import os.path
 import re
 import shutil
+import StringIO
+import subprocess
 import sys
+import tempfile
+import time
+
+try:
+  # On Python 2, os.walk() calls stat() on every directory entry; the scandir
+  # module gets the same information from the directory listing itself.
+  from scandir import walk as WalkTree
+except ImportError:
+  WalkTree = os.walk
+
+try:
+  # Used by --watch if available; otherwise it falls back to polling.
+  import pyinotify
+except ImportError:
+  pyinotify = None
 
 MAKE_DEPEND_LINE = '# DO NOT DELETE THIS LINE -- make depend depends on it.\n'
 VAR_DEFINITION_PATTERN = re.compile('([^# \t=]+) *=')
 CONFIG_VARS = {}
+# Paths of files actually changed by UpdateFile() during this run.
+MODIFIED_FILES = set()
+# Workspace holding the files being updated in memory, or None if UpdateFile()
+# should update files on disk directly.
+WORKSPACE = None
+# TransformProfile recording the cost of every update, or None; see
+# --profile_json.
+PROFILE = None
+# Directory in which --transactional stages the updated tree; see ShadowTree.
+SHADOW_TREE_DIR = '.update_makefiles_shadow'
 TARGET_PATTERN = re.compile('([^#\t=]+):')
 MULTILINE_TARGET_PATTERN = re.compile('([\t ]*[^#\t=]+):')
 SPACE = ' \t\n\x0b\x0c\r'
+WHITESPACE_SPLIT_PATTERN = re.compile('[%s]+|[^%s]+' % (SPACE, SPACE))
+# Memo for SplitPreservingWhitespace(), shared by all Makefiles, since many
+# definitions are repeated across Makefiles. It's cleared whenever it reaches
+# SPLIT_MEMO_MAX_ENTRIES, so that it can't grow without bound in long-running
+# processes such as --watch and makefile_info_server.py.
+SPLIT_MEMO = {}
+SPLIT_MEMO_MAX_ENTRIES = 50000
+
+# Location of a variable or target definition within a Makefile, as recorded by
+# ParseMakefile(): the first and last line numbers (1-based, inclusive) and the
+# start and end byte offsets (end exclusive).
+Span = collections.namedtuple('Span', ['first_line', 'last_line', 'start',
+                                       'end'])
+
+# The files updated in each directory containing a Makefile.
+MAKEFILE_NAMES = ('Makefile', 'GNUmakefile', 'BSDmakefile')
+
+# Top-level files whose changes can affect the updates to every Makefile.
+GLOBAL_INPUTS = frozenset([
+    'configure.mk.org',
+    'Makefile',
+    'Makefile.org',
+    'Makefile.fips',
+    'Makefile.shared',
+    ])
+
+# We need to update TOP and SRC everywhere, including the {GNU,BSD}makefiles.
+ALWAYS_COMMON_VARS = frozenset(['TOP', 'SRC'])
 
 DEFAULT_RULE_TARGETS = set([
     ".c.o",
@@ -113,7 +174,13 @@ def CreateNewMakefile(dirname, makefile_name, content):
   TOP_PATTERN = re.compile('[^.%s]+' % os.path.sep)
   makefile_path = os.path.join(dirname, makefile_name)
 
-  if not os.path.exists(makefile_path):
+  if WORKSPACE is not None:
+    if not WORKSPACE.Exists(makefile_path):
+      print '%s: created' % makefile_path
+      WORKSPACE.Create(makefile_path, '%s\n' % (content % (
+          makefile_path, TOP_PATTERN.sub('..', dirname))))
+
+  elif not os.path.exists(makefile_path):
     print '%s: created' % makefile_path
     with open(makefile_path, 'w') as makefile:
       print >>makefile, content % (
@@ -342,6 +409,557 @@ def CatConfigureAndMakefileShared(infile, outfile):
     print >>outfile, line,
 
 
+class ComparingWriter(object):
+  """File-like object that compares output to an existing file as it writes.
+
+  Attributes:
+    outfile: file object to which all output is written
+    orig: file object containing the content to compare against
+    identical: False once the output has diverged from the content of orig
+  """
+
+  def __init__(self, outfile, orig):
+    self.outfile = outfile
+    self.orig = orig
+    self.identical = True
+    # Used by the print statement.
+    self.softspace = 0
+
+  def write(self, s):
+    """Writes s to outfile, comparing it to the next len(s) bytes of orig."""
+    self.outfile.write(s)
+    if self.identical and self.orig.read(len(s)) != s:
+      self.identical = False
+
+  def IsIdentical(self):
+    """Returns True if everything written so far matches all of orig."""
+    return self.identical and not self.orig.read(1)
+
+
+class Workspace(object):
+  """In-memory copies of the files updated during a run.
+
+  Each file is read from disk at most once, the first time it is updated, and
+  every later update works on its MakefileDocument in memory. Commit() then
+  writes each file whose content has changed exactly once.
+
+  Attributes:
+    documents: hash of path -> MakefileDocument
+    originals: hash of path -> content of the file on disk, or None if the
+      file was created during the run
+    created_elsewhere: set of paths created in the workspace of the parent
+      process, for which a RunStage() worker holds no documents
+  """
+
+  def __init__(self):
+    self.documents = {}
+    self.originals = {}
+    self.created_elsewhere = set()
+
+  def Exists(self, path):
+    """Returns True if path exists either in the workspace or on disk."""
+    path = os.path.normpath(path)
+    return (path in self.documents or path in self.created_elsewhere or
+            os.path.exists(path))
+
+  def IsCreated(self, path):
+    """Returns True if path was created in the workspace and not yet written.
+    """
+    path = os.path.normpath(path)
+    if path in self.created_elsewhere:
+      return True
+    return path in self.originals and self.originals[path] is None
+
+  def CreatedPaths(self):
+    """Returns the set of paths for which IsCreated() is True."""
+    return self.created_elsewhere.union(
+        [p for p, original in self.originals.iteritems() if original is None])
+
+  def Document(self, path):
+    """Returns the MakefileDocument for path, reading it if necessary."""
+    path = os.path.normpath(path)
+    if path not in self.documents:
+      with open(path) as infile:
+        content = infile.read()
+      self.documents[path] = MakefileDocument(path, content)
+      self.originals[path] = content
+    return self.documents[path]
+
+  def Create(self, path, content):
+    """Adds a new file to the workspace."""
+    path = os.path.normpath(path)
+    self.documents[path] = MakefileDocument(path, content)
+    self.originals[path] = None
+
+  def IsChanged(self, path):
+    """Returns True if path differs from its content on disk."""
+    path = os.path.normpath(path)
+    return (path in self.documents and
+            self.documents[path].text != self.originals[path])
+
+  def ChangedPaths(self):
+    """Returns a sorted list of the paths that differ from their disk content.
+    """
+    return sorted([p for p in self.documents if self.IsChanged(p)])
+
+  def Update(self, path, update_func):
+    """Applies update_func() to path; see UpdateFile().
+
+    Returns:
+      True if the content was modified, False otherwise
+    """
+    document = self.Document(path)
+    infile = StringIO.StringIO(document.text)
+    infile.name = path
+    outfile = StringIO.StringIO()
+    try:
+      ApplyUpdate(update_func, infile, outfile)
+    except UpdateMakefilesException, e:
+      unused_type, unused_value, traceback = sys.exc_info()
+      raise UpdateMakefilesException, '%s: %s' % (path, e), traceback
+
+    updated = outfile.getvalue()
+    if updated == document.text:
+      return False
+    document.SetText(updated)
+    MODIFIED_FILES.add(path)
+    return True
+
+  def UpdateDocument(self, path, update_func):
+    """Applies update_func() to the MakefileDocument for path.
+
+    See UpdateDocument().
+
+    Returns:
+      True if the content was modified, False otherwise
+    """
+    document = self.Document(path)
+    version = document.version
+    try:
+      ApplyDocumentUpdate(update_func, document)
+    except UpdateMakefilesException, e:
+      unused_type, unused_value, traceback = sys.exc_info()
+      raise UpdateMakefilesException, '%s: %s' % (path, e), traceback
+
+    if document.version == version:
+      return False
+    MODIFIED_FILES.add(path)
+    return True
+
+  def Export(self, dirname=None):
+    """Returns the contents of the workspace in a picklable form.
+
+    Used to pass the workspace between RunStage() processes.
+
+    Args:
+      dirname: if not None, export only the files directly within dirname
+    Returns:
+      a list of (path, original content, current content) tuples that can be
+        passed to Import()
+    """
+    if dirname is not None:
+      dirname = os.path.normpath(dirname)
+    return [(path, self.originals[path], document.text)
+            for path, document in self.documents.iteritems()
+            if dirname is None or os.path.dirname(path) == dirname]
+
+  def Import(self, entries):
+    """Adds the output of Export() to the workspace."""
+    for path, original, content in entries:
+      self.documents[path] = MakefileDocument(path, content)
+      self.originals[path] = original
+
+  def UnifiedDiff(self, path):
+    """Returns a unified diff of the changes to path as a list of lines."""
+    original = self.originals[path]
+    fromfile = original is None and '/dev/null' or 'a/%s' % path
+    diff = difflib.unified_diff(
+        (original or '').splitlines(True),
+        self.documents[path].text.splitlines(True), fromfile, 'b/%s' % path)
+    lines = []
+    for line in diff:
+      if not line.endswith('\n'):
+        line = '%s\n\\ No newline at end of file\n' % line
+      lines.append(line)
+    return lines
+
+  def DiffStat(self, path):
+    """Returns (lines added, lines removed) for the changes to path."""
+    added = removed = 0
+    for line in self.UnifiedDiff(path)[2:]:
+      if line.startswith('+'):
+        added += 1
+      elif line.startswith('-'):
+        removed += 1
+    return added, removed
+
+  def PrintChanges(self, diff_format):
+    """Prints the changes to every file rather than writing them.
+
+    Args:
+      diff_format: 'diff' to print a unified diff of each file, or 'stat' to
+        print the number of lines added and removed per file
+    """
+    changed = self.ChangedPaths()
+    if diff_format == 'diff':
+      for path in changed:
+        sys.stdout.write(''.join(self.UnifiedDiff(path)))
+      return
+
+    total_added = total_removed = 0
+    for path in changed:
+      added, removed = self.DiffStat(path)
+      total_added += added
+      total_removed += removed
+      print ' %s | +%d -%d' % (path, added, removed)
+    print ' %d files changed, %d insertions(+), %d deletions(-)' % (
+        len(changed), total_added, total_removed)
+
+  def Commit(self, shadow_dir=None):
+    """Writes every changed file to disk.
+
+    Args:
+      shadow_dir: if not None, the files are committed all at once via a
+        ShadowTree in this directory; otherwise each is written and renamed
+        into place in turn
+    """
+    changed = self.ChangedPaths()
+    if shadow_dir is not None:
+      ShadowTree(shadow_dir).Commit(
+          [(path, self.originals[path], self.documents[path].text)
+           for path in changed])
+    else:
+      for path in changed:
+        updated_name = '%s.updated' % path
+        with open(updated_name, 'w') as updated:
+          updated.write(self.documents[path].text)
+        os.rename(updated_name, path)
+
+    for path in changed:
+      self.originals[path] = self.documents[path].text
+
+
+def FsyncDirectory(dirname):
+  """Flushes the entries of dirname (e.g. renames into it) to disk."""
+  fd = os.open(dirname or os.curdir, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+class ShadowTree(object):
+  """Applies a batch of file updates to the tree all at once, or not at all.
+
+  Commit() first writes every updated file into a shadow copy of the tree
+  under root, alongside a hard link to each original and a journal of the
+  paths involved. After validating the shadow files, and that no original
+  has changed on disk since it was read, each shadow file is renamed over
+  its original, followed by a single fsync of each affected directory.
+
+  If anything fails before the renames, the tree is untouched; if a rename
+  fails, the originals are restored from their links. If the process dies
+  during the renames, Recover() restores the originals on the next run.
+
+  Attributes:
+    root: directory containing the shadow tree
+  """
+
+  JOURNAL = 'journal'
+  COMMITTING = 'committing'
+
+  def __init__(self, root):
+    self.root = root
+
+  def _NewPath(self, path):
+    return os.path.join(self.root, 'new', path)
+
+  def _OldPath(self, path):
+    return os.path.join(self.root, 'old', path)
+
+  def _WriteFile(self, path, content):
+    """Writes content to path and flushes it to disk."""
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    with open(path, 'w') as outfile:
+      outfile.write(content)
+      outfile.flush()
+      os.fsync(outfile.fileno())
+
+  def Prepare(self, files):
+    """Writes the shadow tree, original links, and journal.
+
+    Args:
+      files: list of (path, original content or None if the file is new,
+        updated content) tuples
+    """
+    for path, original, content in files:
+      self._WriteFile(self._NewPath(path), content)
+      if original is not None:
+        old_path = self._OldPath(path)
+        if not os.path.isdir(os.path.dirname(old_path)):
+          os.makedirs(os.path.dirname(old_path))
+        try:
+          os.link(path, old_path)
+        except OSError:
+          # The file system doesn't support hard links.
+          shutil.copy2(path, old_path)
+    self._WriteFile(os.path.join(self.root, ShadowTree.JOURNAL),
+                    cPickle.dumps([(path, original is None)
+                                   for path, original, _ in files]))
+
+  def Validate(self, files):
+    """Raises UpdateMakefilesException if the shadow tree can't be committed.
+
+    Args:
+      files: the same list passed to Prepare()
+    """
+    for path, original, content in files:
+      with open(self._NewPath(path)) as shadow_file:
+        if shadow_file.read() != content:
+          raise UpdateMakefilesException(
+              '%s: shadow copy differs from update' % path)
+      if original is None:
+        if os.path.exists(path):
+          raise UpdateMakefilesException('%s: created by another process' %
+                                         path)
+      else:
+        with open(self._OldPath(path)) as old_file:
+          if old_file.read() != original:
+            raise UpdateMakefilesException(
+                '%s: changed on disk since it was read' % path)
+
+  def Swap(self, files):
+    """Renames every shadow file over its original."""
+    self._WriteFile(os.path.join(self.root, ShadowTree.COMMITTING), '')
+    for path, _, _ in files:
+      os.rename(self._NewPath(path), path)
+    for dirname in set([os.path.dirname(path) for path, _, _ in files]):
+      FsyncDirectory(dirname)
+
+  def RollBack(self, journal):
+    """Restores the originals of the files listed in journal.
+
+    Args:
+      journal: list of (path, True if the file was created) tuples
+    """
+    for path, created in journal:
+      if created:
+        if os.path.exists(path) and not os.path.exists(self._NewPath(path)):
+          os.remove(path)
+      elif os.path.exists(self._OldPath(path)):
+        os.rename(self._OldPath(path), path)
+    for dirname in set([os.path.dirname(path) for path, _ in journal]):
+      FsyncDirectory(dirname)
+
+  def Remove(self):
+    """Deletes the shadow tree."""
+    if os.path.exists(self.root):
+      shutil.rmtree(self.root)
+
+  def Recover(self):
+    """Rolls back a commit interrupted by the death of its process.
+
+    Returns:
+      True if a shadow tree was left over from an earlier run
+    """
+    if not os.path.exists(self.root):
+      return False
+    if os.path.exists(os.path.join(self.root, ShadowTree.COMMITTING)):
+      with open(os.path.join(self.root, ShadowTree.JOURNAL)) as journal:
+        self.RollBack(cPickle.load(journal))
+    self.Remove()
+    return True
+
+  def Commit(self, files):
+    """Applies every update in files, or none of them.
+
+    Args:
+      files: list of (path, original content or None if the file is new,
+        updated content) tuples
+    Raises:
+      UpdateMakefilesException if validation fails, in which case the tree is
+        unchanged
+    """
+    if not files:
+      return
+    os.mkdir(self.root)
+    try:
+      self.Prepare(files)
+      self.Validate(files)
+    except:
+      self.Remove()
+      raise
+
+    try:
+      self.Swap(files)
+    except:
+      self.RollBack([(path, original is None)
+                     for path, original, _ in files])
+      self.Remove()
+      raise
+    self.Remove()
+
+
+class TransformProfile(object):
+  """Records the cost of every update function applied to every file.
+
+  Update functions are recorded by ApplyUpdate() and ApplyDocumentUpdate(),
+  which are used everywhere update functions are applied, and stages by
+  RunStage(), RunProfiledStep() and FinishRun().
+
+  Attributes:
+    stage: name of the stage currently running, or None
+    records: hash of (stage, transform, path) -> list of [calls, wall
+      seconds, CPU seconds, bytes read, bytes written, lines read, lines
+      written, number of calls that changed the content]
+    stages: list of (stage, number of directories, wall seconds) tuples
+    start: time at which the profile was created
+  """
+
+  FIELDS = ('calls', 'wall_secs', 'cpu_secs', 'bytes_read', 'bytes_written',
+            'lines_read', 'lines_written', 'changed')
+
+  def __init__(self):
+    self.stage = None
+    self.records = {}
+    self.stages = []
+    self.start = time.time()
+
+  def Record(self, update_func, path, wall, cpu, content, updated):
+    """Adds the cost of a single update function call.
+
+    Args:
+      update_func: the update function; a trailing 'Binder' is dropped from
+        its name
+      path: path of the file updated
+      wall: wall time taken by update_func, in seconds
+      cpu: CPU time taken by update_func, in seconds
+      content: content of the file before update_func
+      updated: content of the file after update_func
+    """
+    name = update_func.__name__
+    if name.endswith('Binder'):
+      name = name[:-len('Binder')]
+    key = (self.stage, name, os.path.normpath(path))
+    self.Merge({key: [1, wall, cpu, len(content), len(updated),
+                      content.count('\n'), updated.count('\n'),
+                      int(content != updated)]})
+
+  def Merge(self, records):
+    """Adds records from another TransformProfile, e.g. in a worker process.
+    """
+    for key, values in records.iteritems():
+      totals = self.records.get(key)
+      if totals is None:
+        self.records[key] = list(values)
+      else:
+        for i, value in enumerate(values):
+          totals[i] += value
+
+  def RecordStage(self, stage, num_dirs, wall):
+    """Adds the wall time taken by a stage."""
+    self.stages.append((stage, num_dirs, wall))
+
+  def _Summarize(self, key_func, top_n=None):
+    """Sums the records grouped by key_func(stage, transform, path).
+
+    Returns:
+      a list of (group, hash of field -> total) tuples, in descending order
+        of wall time, limited to the first top_n groups if top_n is set
+    """
+    totals = {}
+    for key, values in self.records.iteritems():
+      group = key_func(*key)
+      group_totals = totals.setdefault(group, [0] * len(values))
+      for i, value in enumerate(values):
+        group_totals[i] += value
+    summary = sorted(totals.iteritems(), key=lambda item: -item[1][1])
+    return [(group, dict(zip(TransformProfile.FIELDS, values)))
+            for group, values in summary[:top_n]]
+
+  def Report(self, top_n=10):
+    """Returns the profile as a hash suitable for conversion to JSON.
+
+    Args:
+      top_n: number of entries in each of the top_* lists
+    """
+    def Entries(name, summary):
+      return [dict(values, **{name: group}) for group, values in summary]
+
+    by_stage = dict(self._Summarize(lambda stage, t, p: stage))
+    stages = []
+    for stage, num_dirs, wall in self.stages:
+      totals = by_stage.get(stage, {})
+      entry = dict(totals, stage=stage, dirs=num_dirs, wall_secs=wall)
+      entry['transform_wall_secs'] = totals.get('wall_secs', 0)
+      stages.append(entry)
+
+    return {
+        'wall_secs': time.time() - self.start,
+        'stages': stages,
+        'transforms': Entries('transform', self._Summarize(
+            lambda s, transform, p: transform)),
+        'top_files': Entries('file', self._Summarize(
+            lambda s, t, path: path, top_n)),
+        'top_directories': Entries('directory', self._Summarize(
+            lambda s, t, path: os.path.dirname(path) or os.curdir, top_n)),
+        'top_transform_files': [
+            dict(values, transform=transform, file=path)
+            for (transform, path), values in self._Summarize(
+                lambda s, transform, path: (transform, path), top_n)],
+        'records': [
+            dict(zip(TransformProfile.FIELDS, values), stage=stage,
+                 transform=transform, file=path)
+            for (stage, transform, path), values in sorted(
+                self.records.iteritems())],
+        }
+
+  def Write(self, path, top_n=10):
+    """Writes the output of Report() to path as JSON."""
+    with open(path, 'w') as outfile:
+      json.dump(self.Report(top_n), outfile, indent=2, sort_keys=True)
+      outfile.write('\n')
+
+
+def ApplyUpdate(update_func, infile, outfile):
+  """Calls update_func(infile, outfile), recording its cost in PROFILE.
+
+  When PROFILE is set, infile is read into memory and the output buffered so
+  that their sizes can be recorded. Functions produced by ComposeUpdates()
+  aren't recorded themselves, since they record each of their updates.
+  """
+  if PROFILE is None or getattr(update_func, 'is_composed', False):
+    update_func(infile, outfile)
+    return
+
+  content = infile.read()
+  profiled_infile = StringIO.StringIO(content)
+  profiled_infile.name = infile.name
+  profiled_outfile = StringIO.StringIO()
+  wall, cpu = time.time(), time.clock()
+  update_func(profiled_infile, profiled_outfile)
+  wall, cpu = time.time() - wall, time.clock() - cpu
+  updated = profiled_outfile.getvalue()
+  outfile.write(updated)
+  PROFILE.Record(update_func, infile.name, wall, cpu, content, updated)
+
+
+def ApplyDocumentUpdate(update_func, document):
+  """Calls update_func(document), recording its cost in PROFILE."""
+  if PROFILE is None:
+    update_func(document)
+    return
+
+  content = document.text
+  wall, cpu = time.time(), time.clock()
+  update_func(document)
+  wall, cpu = time.time() - wall, time.clock() - cpu
+  PROFILE.Record(update_func, document.path, wall, cpu, content,
+                 document.text)
+
+
 def UpdateFile(orig_name, update_func):
   """Applies update_func() to a Makefile.
 
@@ -350,30 +968,261 @@ def UpdateFile(orig_name, update_func):
     outfile: the Makefile to write
 
   If update_func() finishes successfully (i.e. raises no exceptions), the
-  original Makefile will be overwritten by the updated version.
+  original Makefile will be overwritten by the updated version. If the updated
+  version is byte-for-byte identical to the original, the original is left
+  untouched so that its modification time doesn't change.
+
+  If WORKSPACE is set, the update is applied to its in-memory copy of the
+  Makefile instead, which is written by Workspace.Commit().
 
   Args:
     orig_name: path to the Makefile to update
     update_func: function to transform the Makefile content
+  Returns:
+    True if the Makefile was modified, False otherwise
   Raises:
     UpdateMakefilesException if an error occurs
   """
+  if WORKSPACE is not None:
+    return WORKSPACE.Update(orig_name, update_func)
+
   updated_name = '%s.updated' % orig_name
   try:
     with open(orig_name, 'r') as orig:
-      with open(updated_name, 'w') as updated:
-        update_func(orig, updated)
+      with open(orig_name, 'r') as orig_copy:
+        with open(updated_name, 'w') as updated:
+          writer = ComparingWriter(updated, orig_copy)
+          ApplyUpdate(update_func, orig, writer)
+        identical = writer.IsIdentical()
+
+    if identical:
+      os.remove(updated_name)
+      return False
     os.rename(updated_name, orig_name)
+    MODIFIED_FILES.add(orig_name)
+    return True
 
   except UpdateMakefilesException, e:
     unused_type, unused_value, traceback = sys.exc_info()
     raise UpdateMakefilesException, '%s: %s' % (orig_name, e), traceback
 
 
+def ComposeUpdates(*update_funcs):
+  """Chains a series of update functions into a single update function.
+
+  The output of each function is buffered in memory and becomes the input of
+  the next function, so a series of updates applied via UpdateFile() costs
+  only one read of the original Makefile and one write of the updated
+  version, rather than a read, write, and rename per update function.
+
+  Args:
+    update_funcs: functions taking (infile, outfile) arguments, as described
+      in the docstring for UpdateFile()
+  Returns:
+    a function taking (infile, outfile) arguments that applies each of
+      update_funcs in order
+  """
+  def ComposedUpdate(infile, outfile):
+    """Applies each of update_funcs in order, passing results in memory."""
+    current = infile
+    for update_func in update_funcs[:-1]:
+      updated = StringIO.StringIO()
+      ApplyUpdate(update_func, current, updated)
+      current = StringIO.StringIO(updated.getvalue())
+      current.name = infile.name
+    ApplyUpdate(update_funcs[-1], current, outfile)
+  ComposedUpdate.is_composed = True
+  return ComposedUpdate
+
+
+def FilterDocument(infile, outfile, update_func, *args):
+  """Applies a MakefileDocument update function as a text update function.
+
+  Args:
+    infile: Makefile to read
+    outfile: Makefile to write
+    update_func: function taking a MakefileDocument, followed by args
+    args: additional arguments to update_func
+  """
+  document = MakefileDocument(infile.name, infile.read())
+  update_func(document, *args)
+  outfile.write(document.text)
+
+
+def DocumentFilter(update_func):
+  """Converts a MakefileDocument update function into a text update function.
+
+  Args:
+    update_func: function taking a MakefileDocument
+  Returns:
+    a function taking (infile, outfile) arguments, with the same name as
+      update_func
+  """
+  def ApplyToDocument(infile, outfile):
+    """Applies update_func() to the content of infile."""
+    FilterDocument(infile, outfile, update_func)
+  ApplyToDocument.__name__ = update_func.__name__
+  return ApplyToDocument
+
+
+def UpdateDocument(orig_name, update_func, cache=None, context=()):
+  """Applies update_func() to a MakefileDocument for a Makefile.
+
+  The counterpart to UpdateFile() for updates that edit MakefileDocument.Nodes
+  rather than filtering lines. When WORKSPACE is set, the update edits the
+  workspace's document directly, without serializing or parsing it again.
+
+  Args:
+    orig_name: path to the Makefile to update
+    update_func: function taking a MakefileDocument
+    cache: if not None, a TransformCache through which to apply update_func
+    context: passed to CachedUpdate() along with cache
+  Returns:
+    True if the Makefile was modified, False otherwise
+  Raises:
+    UpdateMakefilesException if an error occurs
+  """
+  if cache is not None:
+    return UpdateFile(
+        orig_name, CachedUpdate(cache, DocumentFilter(update_func), context))
+  if WORKSPACE is not None:
+    return WORKSPACE.UpdateDocument(orig_name, update_func)
+  return UpdateFile(orig_name, DocumentFilter(update_func))
+
+
+class TransformCache(object):
+  """Persistent, content-addressed cache of update function results.
+
+  Each entry holds the output of an update function along with everything it
+  printed, keyed by a digest of:
+    - the name of the update function
+    - the version, i.e. the digest of this script, so that any change to the
+      script invalidates every entry
+    - the digest of the input content
+    - the context: the path of the Makefile, the names in CONFIG_VARS, and
+      any values bound to the update function, e.g. a Makefile's target map
+
+  Since the key covers all of the input, identical Makefiles in different
+  branches and working copies share entries. Entries are written atomically,
+  so a cache directory may be shared by concurrent processes.
+
+  Only update functions whose output depends on nothing but the key are
+  suitable, which excludes those which consult the file system or modify
+  the MakefileInfo.
+
+  Attributes:
+    directory: directory containing the cache entries
+    version: digest of this script
+    hits: number of updates served from the cache
+    misses: number of updates computed and added to the cache
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    with open('%s.py' % os.path.splitext(__file__)[0]) as script:
+      self.version = hashlib.md5(script.read()).hexdigest()
+    self.hits = 0
+    self.misses = 0
+
+  def Key(self, name, path, content, context):
+    """Returns the cache key for an update function's input.
+
+    Args:
+      name: name of the update function
+      path: path of the Makefile being updated
+      content: content of the Makefile being updated
+      context: tuple of other values the update function depends on; must
+        have a deterministic repr(), e.g. sorted lists rather than hashes
+    """
+    return hashlib.sha1(repr((
+        name, self.version, hashlib.md5(content).hexdigest(), path,
+        sorted(CONFIG_VARS), context))).hexdigest()
+
+  def _EntryPath(self, key):
+    return os.path.join(self.directory, key[:2], key[2:])
+
+  def Get(self, key):
+    """Returns (output, messages) for key, or None if there is no entry."""
+    try:
+      with open(self._EntryPath(key), 'rb') as entry:
+        return cPickle.load(entry)
+    except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+      return None
+
+  def Put(self, key, output, messages):
+    """Adds an entry for key."""
+    entry_path = self._EntryPath(key)
+    entry_dir = os.path.dirname(entry_path)
+    if not os.path.isdir(entry_dir):
+      try:
+        os.makedirs(entry_dir)
+      except OSError:
+        # Another process created it first.
+        pass
+    fd, tmp_path = tempfile.mkstemp(dir=entry_dir)
+    with os.fdopen(fd, 'wb') as entry:
+      cPickle.dump((output, messages), entry, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, entry_path)
+
+  def Apply(self, update_func, context, infile, outfile):
+    """Applies update_func() to infile via the cache.
+
+    Args:
+      update_func: function taking (infile, outfile) arguments
+      context: see Key()
+      infile: Makefile to read
+      outfile: Makefile to write
+    """
+    content = infile.read()
+    key = self.Key(update_func.__name__, infile.name, content, context)
+    entry = self.Get(key)
+    if entry is not None:
+      self.hits += 1
+    else:
+      self.misses += 1
+      cached_infile = StringIO.StringIO(content)
+      cached_infile.name = infile.name
+      output = StringIO.StringIO()
+      messages = StringIO.StringIO()
+      saved_stdout = sys.stdout
+      sys.stdout = messages
+      try:
+        update_func(cached_infile, output)
+      finally:
+        sys.stdout = saved_stdout
+      entry = (output.getvalue(), messages.getvalue())
+      self.Put(key, *entry)
+
+    output, messages = entry
+    sys.stdout.write(messages)
+    outfile.write(output)
+
+
+def CachedUpdate(cache, update_func, context=()):
+  """Wraps update_func() so that it's applied via a TransformCache.
+
+  Args:
+    cache: TransformCache, or None
+    update_func: function taking (infile, outfile) arguments
+    context: see TransformCache.Key()
+  Returns:
+    update_func if cache is None, otherwise a function taking (infile,
+      outfile) arguments that applies update_func via cache
+  """
+  if cache is None:
+    return update_func
+
+  def CachedUpdateFunc(infile, outfile):
+    """Applies update_func() via cache."""
+    cache.Apply(update_func, context, infile, outfile)
+  CachedUpdateFunc.__name__ = update_func.__name__
+  return CachedUpdateFunc
+
+
 def UpdateMakefilesStage0(config, dirname, fnames):
   """Applies a series of updates to dirname/Makefile (if it exists).
 
-  Passed to os.path.walk() to process all the Makefiles in the OpenSSL source
+  Passed to RunStage() to process all the Makefiles in the OpenSSL source
   tree.
 
   Args:
@@ -383,21 +1232,29 @@ def UpdateMakefilesStage0(config, dirname, fnames):
   """
   if 'Makefile' not in fnames: return
   makefile_name = os.path.join(dirname, 'Makefile')
-  UpdateFile(makefile_name, AddSrcVarIfNeeded)
-  UpdateFile(makefile_name, AddDependencyFilesToCleanTargets)
+  updates = [AddSrcVarIfNeeded, AddDependencyFilesToCleanTargets]
   if config.gnu_only:
-    UpdateFile(makefile_name, AddGnuIncludeDirectivesToMakefile)
+    updates.append(AddGnuIncludeDirectivesToMakefile)
   else:
     CreateGnuMakefile(dirname)
     CreateBsdMakefile(dirname)
-  UpdateFile(makefile_name, AddTopToFilesTarget)
-  UpdateFile(makefile_name, RemoveConfigureVars)
-  UpdateFile(makefile_name, RemoveOldMakeDependOutput)
-  UpdateFile(makefile_name, RemoveDependTarget)
-  UpdateFile(makefile_name, CatConfigureAndMakefileShared)
+  updates.extend([
+      AddTopToFilesTarget,
+      RemoveConfigureVars,
+      RemoveOldMakeDependOutput,
+      RemoveDependTarget,
+      CatConfigureAndMakefileShared,
+      ])
+  updates = [CachedUpdate(config.transform_cache, u) for u in updates]
+
+  if config.pipeline:
+    UpdateFile(makefile_name, ComposeUpdates(*updates))
+  else:
+    for update_func in updates:
+      UpdateFile(makefile_name, update_func)
 
 
-def SplitPreservingWhitespace(s):
+def SplitPreservingWhitespace(s, memo=None):
   """Splits s into both its whitespace and nonwhitespace components.
 
   Used instead of split() to ensure that directory name replacement doesn't
@@ -405,28 +1262,21 @@ def SplitPreservingWhitespace(s):
 
   Args:
     s: string to split
+    memo: optional hash of string -> tuple of tokens, used to look up and
+      store the results for s; cleared once it holds SPLIT_MEMO_MAX_ENTRIES
   Returns:
     a list of strings containing all-whitespace and all-nonwhitespace tokens
       from s
   """
-  current = []
-  result = []
-  parse_space = s and s[0] in SPACE
-  for i, c in enumerate(s):
-    if parse_space:
-      if c not in SPACE:
-        result.append(''.join(current))
-        current = []
-        parse_space = False
-    else:
-      if c in SPACE:
-        result.append(''.join(current))
-        current = []
-        parse_space = True
-    current.append(c)
-  if current:
-    result.append(''.join(current))
-  return result
+  if memo is None:
+    return WHITESPACE_SPLIT_PATTERN.findall(s)
+  tokens = memo.get(s)
+  if tokens is None:
+    if len(memo) >= SPLIT_MEMO_MAX_ENTRIES:
+      memo.clear()
+    tokens = memo[s] = tuple(WHITESPACE_SPLIT_PATTERN.findall(s))
+  # Callers update the list in place, so each needs a copy of its own.
+  return list(tokens)
 
 
 def EliminateTop(s):
@@ -440,27 +1290,29 @@ def EliminateTop(s):
     UpdateMakefilesException if an error occurs
   """
   TOP = '$(TOP'
+  l = []
+  begin_unreplaced_segment = 0
   start_pos = s.find(TOP)
-  result = s
 
   while start_pos != -1:
-    end_pos = result.find(')', start_pos)
+    end_pos = s.find(')', start_pos)
     if end_pos == -1:
       raise UpdateMakefilesException('Malformed $(TOP) instance: %s' % s)
 
     end_pos += 1
-    if end_pos != len(result) and result[end_pos] == '/':
+    if end_pos != len(s) and s[end_pos] == '/':
       end_pos += 1
 
-    prefix = result[:start_pos]
-    suffix = result[end_pos:]
+    l.append(s[begin_unreplaced_segment:start_pos])
+    if end_pos == len(s) or s[end_pos] in SPACE:
+      l.append('.')
+    begin_unreplaced_segment = end_pos
+    start_pos = s.find(TOP, end_pos)
 
-    if not suffix or result[end_pos] in SPACE:
-      result = '%s.%s' % (prefix, suffix)
-    else:
-      result = '%s%s' % (prefix, suffix)
-    start_pos = result.find(TOP, start_pos)
-  return result
+  if not l:
+    return s
+  l.append(s[begin_unreplaced_segment:])
+  return ''.join(l)
 
 
 def NormalizeRelativeDirectory(value, prefix, makefile_path):
@@ -486,6 +1338,129 @@ def NormalizeRelativeDirectory(value, prefix, makefile_path):
   return '%s%s' % (prefix, EliminateTop(s))
 
 
+class TreeSnapshot(object):
+  """Snapshot of the contents of every directory in the source tree.
+
+  Answers os.path.exists() queries for paths relative to the current
+  directory without a stat() call per query. The tree is walked once, the
+  first time it's needed. Refresh() brings the snapshot up to date by
+  relisting only those directories whose modification times have changed,
+  which picks up files created or deleted by earlier stages.
+
+  Paths that fall outside the tree, or inside a directory that wasn't walked
+  (i.e. one reached through a symlink, or one of SKIP_DIRS), are passed
+  through to os.path.exists(). So are symlinks, since whether they exist
+  depends on their targets.
+
+  Attributes:
+    entries: hash of directory path -> set of names within the directory, or
+      None if the tree hasn't been walked yet
+    links: hash of directory path -> set of the names within the directory
+      that are symlinks
+    dir_mtimes: hash of directory path -> modification time when it was
+      listed, or None if it was modified too recently to trust
+  """
+
+  SKIP_DIRS = frozenset(['.git', '.hg', '.svn'])
+  RACY_SECS = 2
+
+  def __init__(self):
+    self.entries = None
+    self.links = {}
+    self.dir_mtimes = {}
+
+  @staticmethod
+  def _FindLinks(dirpath, names):
+    """Returns the set of names in dirpath that are symlinks."""
+    return set(n for n in names if os.path.islink(os.path.join(dirpath, n)))
+
+  def _ListTree(self, top):
+    """Adds top and all of the directories below it to the snapshot."""
+    for dirpath, dirnames, filenames in WalkTree(top):
+      dirpath = os.path.normpath(dirpath)
+      self.entries[dirpath] = set(dirnames + filenames)
+      self.links[dirpath] = TreeSnapshot._FindLinks(
+          dirpath, dirnames + filenames)
+      self._RecordMtime(dirpath)
+      dirnames[:] = [d for d in dirnames if d not in TreeSnapshot.SKIP_DIRS]
+
+  def _RecordMtime(self, dirpath):
+    """Records the current modification time of dirpath."""
+    mtime = os.stat(dirpath).st_mtime
+    if mtime > time.time() - TreeSnapshot.RACY_SECS:
+      mtime = None
+    self.dir_mtimes[dirpath] = mtime
+
+  def _RemoveTree(self, top):
+    """Removes top and all of the directories below it from the snapshot."""
+    prefix = '%s%s' % (top, os.path.sep)
+    for dirpath in self.entries.keys():
+      if dirpath == top or dirpath.startswith(prefix):
+        del self.entries[dirpath]
+        del self.links[dirpath]
+        del self.dir_mtimes[dirpath]
+
+  def Refresh(self):
+    """Walks the tree if necessary, else relists any modified directories."""
+    if self.entries is None:
+      self.entries = {}
+      self._ListTree('.')
+      return
+
+    for dirpath, mtime in self.dir_mtimes.items():
+      if dirpath not in self.entries:
+        # Already removed along with a parent directory.
+        continue
+      try:
+        if mtime is not None and os.stat(dirpath).st_mtime == mtime:
+          continue
+        names = set(os.listdir(dirpath))
+      except OSError:
+        self._RemoveTree(dirpath)
+        continue
+
+      old_names = self.entries[dirpath]
+      self.entries[dirpath] = names
+      self.links[dirpath] = (self.links[dirpath] & names).union(
+          TreeSnapshot._FindLinks(dirpath, names - old_names))
+      self._RecordMtime(dirpath)
+      for name in old_names - names:
+        self._RemoveTree(os.path.normpath(os.path.join(dirpath, name)))
+      for name in names - old_names:
+        path = os.path.normpath(os.path.join(dirpath, name))
+        if (name not in TreeSnapshot.SKIP_DIRS and os.path.isdir(path) and
+            not os.path.islink(path)):
+          self._ListTree(path)
+
+  def Exists(self, path):
+    """Returns True if path exists, as os.path.exists() would.
+
+    Args:
+      path: path relative to the current directory
+    """
+    if not path:
+      return False
+    if self.entries is None:
+      self.Refresh()
+    path = os.path.normpath(path)
+    if path == os.curdir:
+      return True
+    if (os.path.isabs(path) or path == os.pardir or
+        path.startswith('%s%s' % (os.pardir, os.path.sep))):
+      return os.path.exists(path)
+
+    parent, name = os.path.split(path)
+    parent = parent or os.curdir
+    names = self.entries.get(parent)
+    if names is not None:
+      if name in self.links[parent]:
+        return os.path.exists(path)
+      return name in names
+    # The parent wasn't listed, so it either doesn't exist, or is a file, a
+    # symlink, or a skipped directory.
+    return self.Exists(parent) and os.path.exists(path)
+
+
 class Makefile(object):
   """Representation of all of the variables and targets in a Makefile.
 
@@ -499,40 +1474,68 @@ class Makefile(object):
     common_targets: names of targets that also appear in other Makefiles
     top_vars: names of variables that also appear in top-level Makefiles
     top_targets: names of targets that also appear in top-level Makefiles
+    tree: TreeSnapshot used instead of os.path.exists(), or None
+    depend_span: Span of the makedepend output, from MAKE_DEPEND_LINE to the
+      end of the file, if ParseMakefile() skipped it; otherwise None
   """
 
   class Variable(object):
     """Representation of a Makefile variable.
 
+    Uses __slots__ rather than a per-instance __dict__, since MakefileInfo
+    holds every Variable in the tree.
+
     Attributes:
-      name: variable name
+      name: variable name (interned)
       definition: string containing the variable contents/definition
+      spans: list of the Spans of each definition of the variable in the
+        parsed file, in file order; empty if it wasn't parsed from a file
     """
-    def __init__(self, name, definition):
-      self.name = name
+    __slots__ = ('name', 'definition', 'spans', '_num_lines', '_counted')
+
+    def __init__(self, name, definition, spans=None):
+      self.name = intern(name)
       self.definition = definition
+      self.spans = spans or []
+      self._counted = None
 
     def __str__(self):
       return '%s=%s' % (self.name, self.definition)
 
     @property
     def num_lines(self):
-      """Returns the number of newline characters in the Variable."""
-      return self.definition.count('\n')
+      """Returns the number of newline characters in the Variable.
+
+      The count is cached until definition is replaced.
+      """
+      if self._counted is not self.definition:
+        self._num_lines = self.definition.count('\n')
+        self._counted = self.definition
+      return self._num_lines
 
   class Target(object):
     """Representation of a Makefile target.
 
+    Uses __slots__ rather than a per-instance __dict__, since MakefileInfo
+    holds every Target in the tree.
+
     Attributes:
-      name: target name
+      name: target name (interned)
       prerequisites: string containing the names of targets and variables that
         are a prerequisite of the target
       recipe: string containing the commands used to build the target
+      spans: list of the Spans of each rule for the target in the parsed file,
+        in file order; empty if the target wasn't parsed from a file
     """
-    def __init__(self, name, prerequisites, recipe):
-      self.name = name
+    __slots__ = ('name', 'prerequisites', 'recipe', 'spans', '_num_lines',
+                 '_counted')
+
+    def __init__(self, name, prerequisites, recipe, spans=None):
+      self.name = intern(name)
       self.prerequisites = prerequisites
       self.recipe = recipe
+      self.spans = spans or []
+      self._counted = (None, None, None)
 
     def __str__(self):
       return '%s:%s%s' % (self.name, self.prerequisites, self.recipe)
@@ -542,23 +1545,32 @@ class Makefile(object):
 
     @property
     def num_lines(self):
-      """Returns the number of newline characters in the Target."""
-      return (self.name.count('\n') + self.prerequisites.count('\n') +
-              self.recipe.count('\n'))
+      """Returns the number of newline characters in the Target.
+
+      The count is cached until name, prerequisites, or recipe is replaced.
+      """
+      name, prerequisites, recipe = self._counted
+      if (name is not self.name or prerequisites is not self.prerequisites or
+          recipe is not self.recipe):
+        self._num_lines = (self.name.count('\n') +
+                           self.prerequisites.count('\n') +
+                           self.recipe.count('\n'))
+        self._counted = (self.name, self.prerequisites, self.recipe)
+      return self._num_lines
 
   def __init__(self, makefile):
-    self.makefile = makefile
+    self.makefile = intern(makefile)
     self.mfdir = os.path.dirname(makefile)
     self.suffix = (self.mfdir and
                    '_%s' % self.mfdir.replace(os.path.sep, '_') or '')
     self.variables = {}
     self.targets = {}
-    # We need to update TOP and SRC everywhere, including the
-    # {GNU,BSD}makefiles.
-    self.common_vars = set(['TOP', 'SRC'])
+    self.common_vars = set(ALWAYS_COMMON_VARS)
     self.common_targets = set()
     self.top_vars = set()
     self.top_targets = set()
+    self.tree = None
+    self.depend_span = None
     # Used by IsUpdatableRecipeToken()
     self._updatable_recipe_tokens = set()
 
@@ -573,41 +1585,73 @@ class Makefile(object):
     s.extend(['  %s' % self.targets[i] for i in target_names])
     return '\n'.join(s)
 
-  def add_var(self, name, definition):
+  def add_var(self, name, definition, span=None, strict=True):
     """Adds a new Variable to the Makefile.
 
     Args:
       name: variable name
       definition: string containing the variable contents/definition
+      span: Span of the definition in the Makefile, if known
+      strict: if False, a later definition replaces an earlier one
     Raises:
       AssertionError: if a variable is duplicated in a Makefile, i.e. if name
         is already present in self.variables
     """
-    if name in self.variables:
+    if name not in self.variables:
+      self.variables[name] = Makefile.Variable(
+          name, definition, span and [span])
+    elif strict:
       raise UpdateMakefilesException('variable already exists: %s' % name)
-    self.variables[name] = Makefile.Variable(name, definition)
+    else:
+      var = self.variables[name]
+      var.definition = definition
+      if span:
+        var.spans.append(span)
 
-  def add_target(self, name, prerequisites, recipe):
+  def add_target(self, name, prerequisites, recipe, span=None, strict=True):
     """Adds a new Target to the Makefile.
 
+    If name already has a Target, prerequisites are appended to its own,
+    without the newline ending the earlier rule, so that the merged
+    prerequisites remain a single logical line. In strict mode the Target
+    keeps the recipe of its first rule, even if that recipe is empty.
+
     Args:
       name: target name
       prerequisites: string containing the names of targets and variables that
         are a prerequisite of the target
       recipe: string containing the commands used to build the target
+      span: Span of this rule in the Makefile, if known
+      strict: if False, recipes for the same target in more than one rule
+        (e.g. GNU pattern rules) are permitted; the first recipe is kept, or
+        taken from a later rule if the earlier rules have none
     Raises:
       AssertionError: if a target contains more than one recipe, i.e. if the
         a recipe is defined for both the existing target object and the new
         target
     """
     if name not in self.targets:
-      self.targets[name] = Makefile.Target(name, prerequisites, recipe)
+      self.targets[name] = Makefile.Target(
+          name, prerequisites, recipe, span and [span])
     else:
       target = self.targets[name]
-      target.prerequisites = '%s %s' % (target.prerequisites, prerequisites)
-      if target.recipe and recipe:
+      target.prerequisites = '%s %s' % (target.prerequisites.rstrip('\n'),
+                                        prerequisites)
+      if target.recipe and recipe and strict:
         raise UpdateMakefilesException(
             'duplicate recipes for %s' % target.name)
+      if recipe and not target.recipe and not strict:
+        target.recipe = recipe
+      if span:
+        target.spans.append(span)
+
+  def PathExists(self, path):
+    """Returns True if path exists, consulting self.tree if it is set."""
+    if WORKSPACE is not None and WORKSPACE.IsCreated(path):
+      return True
+    if self.tree is not None:
+      return self.tree.Exists(path)
+    return os.path.exists(path)
 
   def LocalTargetMap(self):
     """Returns a hash of target name -> local name for self.common_targets.
@@ -651,7 +1695,7 @@ class Makefile(object):
 
     mfdir = self.mfdir
     mfdir_slash = '%s%s' % (mfdir, os.path.sep)
-    values = SplitPreservingWhitespace(v.definition)
+    values = SplitPreservingWhitespace(v.definition, SPLIT_MEMO)
 
     if variable.startswith('INCLUDE') and (
       '-I..' in v.definition or '-I$(TOP' in v.definition):
@@ -755,11 +1799,13 @@ class Makefile(object):
             (SRC_OBJ_PATTERN.search(token) and not os.path.dirname(token)))
 
 
-  def UpdateTargetWithDirectoryName(self, target):
+  def UpdateTargetWithDirectoryName(self, target, rule=None):
     """Returns a new target definition based on the Makefile's directory.
 
     Args:
       target: the target to update
+      rule: Target holding only one of the target's rules, as returned by
+        RuleTargets(), to update instead of the whole target
     Returns:
       a Target object with an updated definition where the Makefile's
         directory has been injected everywhere it needs to be
@@ -774,7 +1820,7 @@ class Makefile(object):
     if not target in self.targets:
       raise UpdateMakefilesException('unknown target: %s' % target)
 
-    t = self.targets[target]
+    t = rule or self.targets[target]
 
     if t.name in DEFAULT_RULE_TARGETS:
       # Punt for now
@@ -801,9 +1847,9 @@ class Makefile(object):
     TOP_REL_PATH = '.%s' % os.path.sep
     # We store multiple targets defined in the same recipe as one long name,
     # so we need to split the names apart here.
-    name = SplitPreservingWhitespace(t.name)
-    prereqs = SplitPreservingWhitespace(t.prerequisites)
-    recipe = SplitPreservingWhitespace(t.recipe)
+    name = SplitPreservingWhitespace(t.name, SPLIT_MEMO)
+    prereqs = SplitPreservingWhitespace(t.prerequisites, SPLIT_MEMO)
+    recipe = SplitPreservingWhitespace(t.recipe, SPLIT_MEMO)
 
     def NormalizeTargetToken(s):
       """Adds the directory prefix to token and normalizes the path."""
@@ -816,9 +1862,9 @@ class Makefile(object):
       s_parent = os.path.dirname(s)
       if (s.isspace() or s == '\\' or s.startswith(mfdir_slash) or
           (mfdir_parent and s.startswith(mfdir_parent)) or
-          (s_parent and not os.path.exists(os.path.join(mfdir, s_parent))) or
+          (s_parent and not self.PathExists(os.path.join(mfdir, s_parent))) or
           s.endswith(self.suffix) or s.startswith('$') or
-          os.path.exists(s) or s.startswith(os.path.join('.', 'lib'))):
+          self.PathExists(s) or s.startswith(os.path.join('.', 'lib'))):
         return s
       if s.startswith(TOP_REL_PATH):
         var_sigil_pos = s.find('$')
@@ -914,11 +1960,23 @@ class Makefile(object):
             t.recipe != result.recipe) and result or None
 
 
-def ParseMakefile(infile):
+def ParseMakefile(infile, strict=True, lazy_depend=False):
   """Parses a Makefile object from a Makefile.
 
+  Also records the Span of every variable definition and target rule, so that
+  transforms can splice changes into the original content via SpliceMakefile()
+  rather than matching every line again.
+
+  The makedepend output following MAKE_DEPEND_LINE can make up most of a
+  Makefile, yet its rules are all removed by RemoveOldMakeDependOutput(). If
+  lazy_depend is True, those lines are only counted, and their extent is
+  recorded in Makefile.depend_span instead of as Targets.
+
   Args:
     infile: file object containing Makefile contents
+    strict: if False, don't raise on duplicate variables or recipes; see
+      Makefile.add_var() and Makefile.add_target()
+    lazy_depend: if True, skip the makedepend output
   Returns:
     a Makefile object
   """
@@ -929,12 +1987,27 @@ def ParseMakefile(infile):
   target_name = None
   prerequisites = None
   recipe = None
+  # Line number and offset of the current line, and of the start of the
+  # current definition.
+  line_num = 0
+  offset = 0
+  first_line = None
+  start = None
+  # Where multiline_target_name began, or None if a variable definition has
+  # intervened, in which case the target's Span begins at its own line.
+  name_first_line = None
+  name_start = None
 
   for line in infile:
+    line_start = offset
+    line_num += 1
+    offset += len(line)
+
     if var_name is not None:
       definition.append(line)
       if not Continues(line):
-        makefile.add_var(var_name, ''.join(definition))
+        makefile.add_var(var_name, ''.join(definition),
+                         Span(first_line, line_num, start, offset), strict)
         var_name = None
         definition_name = None
       continue
@@ -950,11 +2023,22 @@ def ParseMakefile(infile):
       if line.startswith('\t'):
         recipe.append(line)
         continue
-      makefile.add_target(target_name, prerequisites, ''.join(recipe))
+      makefile.add_target(target_name, prerequisites, ''.join(recipe),
+                          Span(first_line, line_num - 1, start, line_start),
+                          strict)
       target_name = None
       prerequisites = None
       recipe = None
 
+    if lazy_depend and line == MAKE_DEPEND_LINE:
+      depend_first_line = line_num
+      for line in infile:
+        line_num += 1
+        offset += len(line)
+      makefile.depend_span = Span(depend_first_line, line_num, line_start,
+                                  offset)
+      break
+
     var_match = VAR_DEFINITION_PATTERN.match(line)
     target_match = TARGET_PATTERN.match(line)
 
@@ -966,11 +2050,17 @@ def ParseMakefile(infile):
       '%s:%s\n  var: %s\n  target:%s' %
       (infile.name, line, var_match.group(1), target_match.group(1)))
 
+    first_line = line_num
+    start = line_start
+
     if var_match:
+      name_first_line = None
+      name_start = None
       var_name = var_match.group(1)
       definition = line[var_match.end():]
       if not Continues(line):
-        makefile.add_var(var_name, definition)
+        makefile.add_var(var_name, definition,
+                         Span(first_line, line_num, start, offset), strict)
         var_name = None
         definition = None
       else:
@@ -979,6 +2069,9 @@ def ParseMakefile(infile):
     elif target_match:
       target_name = '%s%s' % (
           ''.join(multiline_target_name), target_match.group(1))
+      if multiline_target_name and name_start is not None:
+        first_line = name_first_line
+        start = name_start
       multiline_target_name = []
       prerequisites = line[target_match.end():]
       # Some recipes begin on the same line as the prerequisites. In OpenSSL,
@@ -994,79 +2087,423 @@ def ParseMakefile(infile):
         prerequisites = [prerequisites]
 
     elif Continues(line) and not line.startswith('#'):
+      if not multiline_target_name:
+        name_first_line = line_num
+        name_start = line_start
       multiline_target_name.append(line)
 
   if recipe is not None:
-    makefile.add_target(target_name, prerequisites, ''.join(recipe))
+    makefile.add_target(target_name, prerequisites, ''.join(recipe),
+                        Span(first_line, line_num, start, offset), strict)
   return makefile
 
 
-def ParseMakefileRecursive(makefiles, dirname, fnames):
-  """Applies ParseMakefile() to dirname/Makefile (if it exists).
+def ParseMakefileContent(content, makefile_path, strict=False,
+                         lazy_depend=False):
+  """Parses a Makefile object from a string rather than a file.
 
-  Passed to os.path.walk() to process all the Makefiles in the OpenSSL source
-  tree.
+  Used by transforms to locate definitions within their input, which may be a
+  {GNU,BSD}makefile or a Makefile partway through being updated; hence strict
+  defaults to False.
 
   Args:
-    makefiles: hash of makefile_path -> Makefile; accumulates the results
-    dirname: current directory path
-    fnames: list of contents in the current directory
+    content: string containing Makefile contents
+    makefile_path: path of the Makefile, used for Makefile.makefile
+    strict: passed through to ParseMakefile()
+    lazy_depend: passed through to ParseMakefile()
+  Returns:
+    a Makefile object
   """
-  if 'Makefile' not in fnames: return
-  makefile_path = os.path.join(dirname, 'Makefile')
-  with open(makefile_path, 'r') as infile:
-    makefiles[makefile_path] = ParseMakefile(infile)
+  infile = StringIO.StringIO(content)
+  infile.name = makefile_path
+  return ParseMakefile(infile, strict, lazy_depend)
 
 
-def MapVarsAndTargetsToFiles(makefiles, all_vars, all_targets):
-  """Transforms a set of Makefile objects to hashes of variables and targets.
-
-  Results are accumulated in all_vars and all_targets.
+def SpliceMakefile(content, edits):
+  """Applies a set of edits to Makefile content in a single pass.
 
   Args:
-    makefiles: a hash of makefile path -> Makefile instance
-    all_vars: a hash of variable name -> [(makefile path, definition)]
-    all_targets: a hash of target name -> [(makefile path, prereqs, recipe)]
+    content: string containing the original Makefile contents
+    edits: list of (Span, replacement string) pairs, usually taken from the
+      output of ParseMakefile() for content; the Spans must not overlap
+  Returns:
+    content with each Span replaced by its replacement string
   """
-  for mf in makefiles:
-    for v in makefiles[mf].variables.values():
-      if v.name not in all_vars:
-        all_vars[v.name] = [(mf, v.definition)]
-      else:
-        all_vars[v.name].append((mf, v.definition))
-    for t in makefiles[mf].targets.values():
-      if t.name not in all_targets:
-        all_targets[t.name] = [(mf, t.prerequisites, t.recipe)]
-      else:
-        all_targets[t.name].append((mf, t.prerequisites, t.recipe))
+  result = []
+  pos = 0
+  for span, replacement in sorted(edits, key=lambda edit: edit[0].start):
+    assert span.start >= pos, 'overlapping edits: %s' % (span,)
+    result.append(content[pos:span.start])
+    result.append(replacement)
+    pos = span.end
+  result.append(content[pos:])
+  return ''.join(result)
 
 
-def PrintVarsAndTargets(items, preamble, common_only=False):
-  """Prints a map of variable or target names to Makefiles and values.
+class MakefileDocument(object):
+  """Lossless, editable representation of a Makefile's content.
 
-  Output goes to standard output. For variable names, the variable defintions
-  are printed. For target names, the prerequisites are printed.
+  The content is held as text, as a list of Nodes, or both. Each form is
+  derived from the other only when it is needed, so a series of line-oriented
+  updates never parses the content, and a series of Node edits never
+  serializes it. Concatenating the text of every Node reproduces the content
+  exactly, including whitespace, comments and line continuations.
 
-  Args:
-    items: hash of {variable or target name} -> [(makefile path, value)]
-    preamble: a string to print before the variable or target information
-    common_only: if True, only print objects appearing in more than one
-      Makefile
+  Attributes:
+    path: path to the Makefile
+    version: incremented by every change to the content
   """
-  if common_only:
-    flattened = [i for i in items.items() if len(i[1]) != 1]
-  else:
-    flattened = [i for i in items.items()]
 
-  def Cmp(lhs, rhs):
-    """Used to sort by decreasing number of Makefiles and increasing name."""
-    return -cmp(len(lhs[1]), len(rhs[1])) or cmp(lhs[0], rhs[0])
-  flattened.sort(cmp=Cmp)
+  VARIABLE = 'variable'
+  RULE = 'rule'
+  OTHER = 'other'
 
-  print preamble
-  print "%d items" % len(flattened)
-  for i in flattened:
-    print '%s: %s files' % (i[0], len(i[1]))
+  class Node(object):
+    """A contiguous piece of a Makefile.
+
+    Attributes:
+      kind: VARIABLE for a variable definition, RULE for a target rule, or
+        OTHER for any other single line, e.g. comments, blank lines, and
+        directives
+      name: variable or target name, or None for OTHER Nodes
+      text: the exact text of the Node, including its final newline
+    """
+    __slots__ = ('kind', 'name', 'text')
+
+    def __init__(self, kind, name, text):
+      self.kind = kind
+      self.name = name
+      self.text = text
+
+  def __init__(self, path, text):
+    self.path = path
+    self.version = 0
+    self._text = text
+    self._nodes = None
+
+  @property
+  def text(self):
+    """The content of the Makefile."""
+    if self._text is None:
+      self._text = ''.join([node.text for node in self._nodes])
+    return self._text
+
+  def SetText(self, text):
+    """Replaces the content of the Makefile."""
+    if text != self.text:
+      self._text = text
+      self._nodes = None
+      self.version += 1
+
+  @property
+  def nodes(self):
+    """List of the Nodes comprising the Makefile, in file order."""
+    if self._nodes is None:
+      self._nodes = self._Parse(self._text)
+    return self._nodes
+
+  def _Parse(self, text):
+    """Splits text into Nodes using the Spans recorded by ParseMakefile()."""
+    makefile = ParseMakefileContent(text, self.path)
+    definitions = [(span, MakefileDocument.VARIABLE, name)
+                   for name, v in makefile.variables.iteritems()
+                   for span in v.spans]
+    definitions.extend([(span, MakefileDocument.RULE, name)
+                        for name, t in makefile.targets.iteritems()
+                        for span in t.spans])
+    definitions.sort()
+
+    Node = MakefileDocument.Node
+    nodes = []
+    pos = 0
+    for span, kind, name in definitions:
+      nodes.extend([Node(MakefileDocument.OTHER, None, line)
+                    for line in text[pos:span.start].splitlines(True)])
+      nodes.append(Node(kind, name, text[span.start:span.end]))
+      pos = span.end
+    nodes.extend([Node(MakefileDocument.OTHER, None, line)
+                  for line in text[pos:].splitlines(True)])
+    return nodes
+
+  def Nodes(self, kind, names=None):
+    """Returns a list of the Nodes of the given kind, in file order.
+
+    Args:
+      kind: VARIABLE, RULE, or OTHER
+      names: if not None, only Nodes whose names are in names are returned
+    """
+    return [node for node in self.nodes if node.kind == kind and
+            (names is None or node.name in names)]
+
+  def Remove(self, node):
+    """Removes node from the Makefile."""
+    self.nodes.remove(node)
+    self._text = None
+    self.version += 1
+
+  def Replace(self, node, text, name=None):
+    """Replaces the text of node.
+
+    Args:
+      node: Node to update
+      text: new text for the Node
+      name: new name for the Node, if it has changed
+    """
+    if name is not None:
+      node.name = name
+    if text != node.text:
+      node.text = text
+      self._text = None
+      self.version += 1
+
+
+def RuleTargets(document, makefile):
+  """Pairs each rule in document with a Target holding only that rule.
+
+  Most targets have a single rule, for which makefile's own Target is used.
+  The rules of a target with several are parsed one at a time, so that each
+  can be updated in place.
+
+  Args:
+    document: MakefileDocument to read
+    makefile: Makefile object corresponding to document
+  Returns:
+    list of (Node, Target) tuples, in file order
+  """
+  nodes = document.Nodes(MakefileDocument.RULE)
+  num_rules = collections.Counter(node.name for node in nodes)
+  rules = []
+  for node in nodes:
+    if num_rules[node.name] == 1:
+      target = makefile.targets[node.name]
+    else:
+      target = ParseMakefileContent(
+          node.text, makefile.makefile).targets[node.name]
+    rules.append((node, target))
+  return rules
+
+
+def ParseMakefileRecursive(info, dirname, fnames):
+  """Parses dirname/Makefile (if it exists) via MakefileInfo.ParseFile().
+
+  Passed to os.path.walk() to process all the Makefiles in the OpenSSL source
+  tree.
+
+  Args:
+    info: MakefileInfo object; accumulates the results in info.all_makefiles
+    dirname: current directory path
+    fnames: list of contents in the current directory
+  """
+  if 'Makefile' not in fnames: return
+  makefile_path = os.path.join(dirname, 'Makefile')
+  info.all_makefiles[makefile_path] = info.ParseFile(makefile_path)
+
+
+def SerializeMakefile(makefile):
+  """Converts a Makefile object into a tuple of builtin types.
+
+  The nested Makefile.Variable and Makefile.Target classes can't be pickled
+  directly, and plain tuples of strings are more compact anyway.
+
+  Args:
+    makefile: Makefile object produced by ParseMakefile()
+  Returns:
+    a tuple that can be passed to DeserializeMakefile()
+  """
+  return (makefile.makefile,
+          [(v.name, v.definition, [tuple(i) for i in v.spans])
+           for v in makefile.variables.itervalues()],
+          [(t.name, t.prerequisites, t.recipe, [tuple(i) for i in t.spans])
+           for t in makefile.targets.itervalues()],
+          makefile.depend_span and tuple(makefile.depend_span))
+
+
+def DeserializeMakefile(data):
+  """Recreates a Makefile object from the output of SerializeMakefile().
+
+  Args:
+    data: tuple produced by SerializeMakefile()
+  Returns:
+    a Makefile object equivalent to the one originally serialized
+  """
+  makefile_path, variables, targets, depend_span = data
+  makefile = Makefile(makefile_path)
+  if depend_span is not None:
+    makefile.depend_span = Span(*depend_span)
+  for name, definition, spans in variables:
+    makefile.variables[name] = Makefile.Variable(
+        name, definition, [Span(*i) for i in spans])
+  for name, prerequisites, recipe, spans in targets:
+    makefile.targets[name] = Makefile.Target(
+        name, prerequisites, recipe, [Span(*i) for i in spans])
+  return makefile
+
+
+class ParseCache(object):
+  """Persistent cache of ParseMakefile() results.
+
+  Each entry is keyed by the path of a Makefile and is only used if the
+  Makefile's size and modification time match those recorded in the entry,
+  or failing that, if the MD5 digest of its content does. Files modified
+  within RACY_SECS of being cached are always checked against the digest,
+  since another write within the same timestamp granularity could go
+  unnoticed otherwise.
+
+  Attributes:
+    path: path to the file in which the cache is stored
+    entries: hash of makefile path -> (size, mtime, digest, serialized
+      Makefile, lazy_depend), where mtime is None if the file was modified
+      too recently to trust, and lazy_depend is the ParseMakefile() argument
+      used to produce the Makefile
+    modified: True if entries has changed since the cache was loaded
+  """
+
+  VERSION = 5
+  RACY_SECS = 2
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}
+    self.modified = False
+
+  def Load(self):
+    """Reads the cache from self.path, if it exists and is valid."""
+    self.entries = {}
+    self.modified = False
+    try:
+      with open(self.path, 'rb') as cache_file:
+        version, entries = cPickle.load(cache_file)
+    except (IOError, EOFError, ValueError, TypeError,
+            cPickle.UnpicklingError):
+      return
+    if version == ParseCache.VERSION:
+      self.entries = entries
+
+  def Save(self):
+    """Writes the cache to self.path if it has changed since Load()."""
+    if not self.modified:
+      return
+    for makefile_path in self.entries.keys():
+      if not os.path.exists(makefile_path):
+        del self.entries[makefile_path]
+    updated_name = '%s.updated' % self.path
+    with open(updated_name, 'wb') as cache_file:
+      cPickle.dump((ParseCache.VERSION, self.entries), cache_file,
+          cPickle.HIGHEST_PROTOCOL)
+    os.rename(updated_name, self.path)
+    self.modified = False
+
+  def Parse(self, makefile_path, lazy_depend=False):
+    """Returns the Makefile parsed from makefile_path, using the cache.
+
+    Args:
+      makefile_path: path to the Makefile to parse
+      lazy_depend: passed through to ParseMakefile(); entries produced with
+        a different value are ignored
+    Returns:
+      a Makefile object
+    """
+    stat = os.stat(makefile_path)
+    entry = self.entries.get(makefile_path)
+    if entry is not None and entry[4] != lazy_depend:
+      entry = None
+    if (entry is not None and entry[0] == stat.st_size and
+        entry[1] == stat.st_mtime):
+      return DeserializeMakefile(entry[3])
+
+    with open(makefile_path, 'rb') as infile:
+      content = infile.read()
+    digest = hashlib.md5(content).digest()
+
+    if entry is not None and entry[2] == digest:
+      data = entry[3]
+      makefile = DeserializeMakefile(data)
+    else:
+      infile = StringIO.StringIO(content)
+      infile.name = makefile_path
+      makefile = ParseMakefile(infile, lazy_depend=lazy_depend)
+      data = SerializeMakefile(makefile)
+
+    mtime = stat.st_mtime
+    if mtime > time.time() - ParseCache.RACY_SECS:
+      mtime = None
+    self.entries[makefile_path] = (stat.st_size, mtime, digest, data,
+                                   lazy_depend)
+    self.modified = True
+    return makefile
+
+
+def MapVarsAndTargetsToFiles(makefiles, all_vars, all_targets):
+  """Transforms a set of Makefile objects to hashes of variables and targets.
+
+  Results are accumulated in all_vars and all_targets.
+
+  Args:
+    makefiles: a hash of makefile path -> Makefile instance
+    all_vars: a hash of variable name -> [(makefile path, definition)]
+    all_targets: a hash of target name -> [(makefile path, prereqs, recipe)]
+  """
+  for mf in makefiles:
+    for v in makefiles[mf].variables.values():
+      if v.name not in all_vars:
+        all_vars[v.name] = [(mf, v.definition)]
+      else:
+        all_vars[v.name].append((mf, v.definition))
+    for t in makefiles[mf].targets.values():
+      if t.name not in all_targets:
+        all_targets[t.name] = [(mf, t.prerequisites, t.recipe)]
+      else:
+        all_targets[t.name].append((mf, t.prerequisites, t.recipe))
+
+
+def RemoveVarsAndTargetsFromFiles(makefiles, all_vars, all_targets):
+  """Removes the entries added by MapVarsAndTargetsToFiles() for makefiles.
+
+  Names that no longer appear in any Makefile are removed from all_vars and
+  all_targets entirely.
+
+  Args:
+    makefiles: a hash of makefile path -> Makefile instance
+    all_vars: a hash of variable name -> [(makefile path, definition)]
+    all_targets: a hash of target name -> [(makefile path, prereqs, recipe)]
+  """
+  for mf in makefiles:
+    for items, names in [(all_vars, makefiles[mf].variables),
+                         (all_targets, makefiles[mf].targets)]:
+      for name in names:
+        remaining = [i for i in items.get(name, []) if i[0] != mf]
+        if remaining:
+          items[name] = remaining
+        elif name in items:
+          del items[name]
+
+
+def PrintVarsAndTargets(items, preamble, common_only=False):
+  """Prints a map of variable or target names to Makefiles and values.
+
+  Output goes to standard output. For variable names, the variable defintions
+  are printed. For target names, the prerequisites are printed.
+
+  Args:
+    items: hash of {variable or target name} -> [(makefile path, value)]
+    preamble: a string to print before the variable or target information
+    common_only: if True, only print objects appearing in more than one
+      Makefile
+  """
+  if common_only:
+    flattened = [i for i in items.items() if len(i[1]) != 1]
+  else:
+    flattened = [i for i in items.items()]
+
+  def Cmp(lhs, rhs):
+    """Used to sort by decreasing number of Makefiles and increasing name."""
+    return -cmp(len(lhs[1]), len(rhs[1])) or cmp(lhs[0], rhs[0])
+  flattened.sort(cmp=Cmp)
+
+  print preamble
+  print "%d items" % len(flattened)
+  for i in flattened:
+    print '%s: %s files' % (i[0], len(i[1]))
     for f in i[1]:
       print '  %s: %s' % (f[0], f[1]),
 
@@ -1081,15 +2518,46 @@ class MakefileInfo(object):
     all_makefiles: hash of makefile_path -> all Makefile objects
     all_vars: hash of vars -> [(makefile path, definition)]
     all_targets: hash of targets -> [(makefile path, prereqs, recipe)]
+    parse_cache: ParseCache object used to avoid reparsing unchanged
+      Makefiles, or None
+    tree: TreeSnapshot shared by all of the Makefile objects
+    lazy_depend: passed to ParseMakefile(); if True, the rules in the
+      makedepend output aren't included
   """
 
-  def __init__(self):
+  def __init__(self, parse_cache=None, lazy_depend=False):
     self.top_makefiles = {}
     self.top_vars = {}
     self.top_targets = {}
     self.all_makefiles = {}
     self.all_vars = {}
     self.all_targets = {}
+    self.parse_cache = parse_cache
+    self.tree = TreeSnapshot()
+    self.lazy_depend = lazy_depend
+
+  def ParseFile(self, makefile_path):
+    """Parses makefile_path, via self.parse_cache if it is set.
+
+    If WORKSPACE holds a changed copy of makefile_path, that copy is parsed
+    instead of the file on disk.
+
+    Args:
+      makefile_path: path to the Makefile to parse
+    Returns:
+      a Makefile object sharing self.tree
+    """
+    if WORKSPACE is not None and WORKSPACE.IsChanged(makefile_path):
+      makefile = ParseMakefileContent(
+          WORKSPACE.Document(makefile_path).text, makefile_path, strict=True,
+          lazy_depend=self.lazy_depend)
+    elif self.parse_cache is not None:
+      makefile = self.parse_cache.Parse(makefile_path, self.lazy_depend)
+    else:
+      with open(makefile_path) as infile:
+        makefile = ParseMakefile(infile, lazy_depend=self.lazy_depend)
+    makefile.tree = self.tree
+    return makefile
 
   def Init(self):
     """Parses the Makefiles and populates the attribute hashes."""
@@ -1097,36 +2565,141 @@ class MakefileInfo(object):
       if not os.path.exists(f):
         print 'MakefileInfo.Init(): Skipping nonexistent file %s' % f
         continue
-      with open(f) as infile:
-        self.top_makefiles[f] = ParseMakefile(infile)
+      self.top_makefiles[f] = self.ParseFile(f)
     self.all_makefiles.update(self.top_makefiles)
 
     for d in os.listdir('.'):
       if os.path.isdir(d):
-        os.path.walk(d, ParseMakefileRecursive, self.all_makefiles)
+        os.path.walk(d, ParseMakefileRecursive, self)
+
+    if self.parse_cache is not None:
+      self.parse_cache.Save()
 
     MapVarsAndTargetsToFiles(
         self.top_makefiles, self.top_vars, self.top_targets)
     MapVarsAndTargetsToFiles(
         self.all_makefiles, self.all_vars, self.all_targets)
 
-    for m in self.all_makefiles.values():
+    self._UpdateTopNames(self.all_makefiles.values())
+    self._UpdateCommonNames(self.all_vars.keys(), self.all_targets.keys())
+
+  def Refresh(self, makefile_paths):
+    """Reparses only the specified Makefiles and updates the attribute hashes.
+
+    Rather than rebuilding every hash from scratch as Init() does, only the
+    entries for the variables and targets defined by the old and new versions
+    of each Makefile are updated.
+
+    Every Makefile is parsed before any of the hashes are changed, so if a
+    parse fails, they are left as they were.
+
+    Args:
+      makefile_paths: paths of the Makefiles that have changed since Init()
+        or the last Refresh(); Makefiles that no longer exist are removed
+    Returns:
+      the set of paths of the Makefiles that were reparsed, plus those of
+        any other Makefiles whose common_vars or common_targets changed as a
+        result
+    Raises:
+      UpdateMakefilesException: if one of the Makefiles can't be parsed
+    """
+    updated_makefiles = {}
+    updated_top_makefiles = {}
+    var_names = set()
+    target_names = set()
+
+    for path in makefile_paths:
+      if os.path.exists(path):
+        updated_makefiles[path] = self.ParseFile(path)
+
+    for path in makefile_paths:
+      if path in self.all_makefiles:
+        old = {path: self.all_makefiles.pop(path)}
+        RemoveVarsAndTargetsFromFiles(old, self.all_vars, self.all_targets)
+        var_names.update(old[path].variables)
+        target_names.update(old[path].targets)
+      is_top = path in self.top_makefiles
+      if is_top:
+        old = {path: self.top_makefiles.pop(path)}
+        RemoveVarsAndTargetsFromFiles(old, self.top_vars, self.top_targets)
+
+      makefile = updated_makefiles.get(path)
+      if makefile is None:
+        continue
+      var_names.update(makefile.variables)
+      target_names.update(makefile.targets)
+      if is_top:
+        updated_top_makefiles[path] = makefile
+
+    if self.parse_cache is not None:
+      self.parse_cache.Save()
+
+    self.all_makefiles.update(updated_makefiles)
+    self.top_makefiles.update(updated_top_makefiles)
+    MapVarsAndTargetsToFiles(
+        updated_top_makefiles, self.top_vars, self.top_targets)
+    MapVarsAndTargetsToFiles(
+        updated_makefiles, self.all_vars, self.all_targets)
+
+    if updated_top_makefiles:
+      self._UpdateTopNames(self.all_makefiles.values())
+    else:
+      self._UpdateTopNames(updated_makefiles.values())
+    changed = self._UpdateCommonNames(var_names, target_names)
+    changed.update(updated_makefiles)
+    return changed
+
+  def _UpdateTopNames(self, makefiles):
+    """Recomputes top_vars and top_targets for each of makefiles.
+
+    Args:
+      makefiles: list of Makefile objects
+    """
+    for m in makefiles:
+      m.top_targets.clear()
       m.top_targets.update([t for t in m.targets if t in self.top_targets])
+      m.top_vars.clear()
       m.top_vars.update([v for v in m.variables if v in self.top_vars])
 
-    for v, files in self.all_vars.iteritems():
-      if len(files) != 1:
-        for f in files:
-          self.all_makefiles[f[0]].common_vars.add(v)
+  def _UpdateCommonNames(self, var_names, target_names):
+    """Updates common_vars and common_targets in the affected Makefiles.
 
-    for t, files in self.all_targets.iteritems():
-      if len(files) != 1:
-        for f in files:
-          mf = self.all_makefiles[f[0]]
-          mfdir = os.path.dirname(mf.makefile)
-          # The 'lib' target actually touches a file called 'lib':
-          if not t == 'lib':
-            mf.common_targets.add(t)
+    Args:
+      var_names: names of variables whose set of defining Makefiles may have
+        changed
+      target_names: names of targets whose set of defining Makefiles may have
+        changed
+    Returns:
+      the set of paths of Makefiles whose common_vars or common_targets
+        changed
+    """
+    changed = set()
+    for v in var_names:
+      files = self.all_vars.get(v, [])
+      for f in files:
+        common_vars = self.all_makefiles[f[0]].common_vars
+        if len(files) != 1 and v not in common_vars:
+          common_vars.add(v)
+          changed.add(f[0])
+        elif (len(files) == 1 and v in common_vars and
+              v not in ALWAYS_COMMON_VARS):
+          common_vars.remove(v)
+          changed.add(f[0])
+
+    for t in target_names:
+      # The 'lib' target actually touches a file called 'lib':
+      if t == 'lib':
+        continue
+      files = self.all_targets.get(t, [])
+      for f in files:
+        common_targets = self.all_makefiles[f[0]].common_targets
+        if len(files) != 1 and t not in common_targets:
+          common_targets.add(t)
+          changed.add(f[0])
+        elif len(files) == 1 and t in common_targets:
+          common_targets.remove(t)
+          changed.add(f[0])
+    return changed
 
   def PrintCommonVarsAndTargets(self):
     """Prints top-level vars and targets, then those in multiple files.
@@ -1188,6 +2761,75 @@ def ReplaceMakefileToken(s, orig_token, new_token):
   return ''.join(l)
 
 
+class MakefileTokenReplacer(object):
+  """Replaces many different Makefile tokens in a single scan of a string.
+
+  Replace() produces the same result as calling ReplaceMakefileToken() once
+  for every entry in replacements, but all of the original tokens are matched
+  at once by a single compiled regular expression, rather than by scanning
+  the string once per token.
+
+  Attributes:
+    replacements: hash of original token -> replacement token
+    pattern: compiled regular expression matching any original token that is
+      bounded by the delimiters required by ReplaceMakefileToken(), or None
+      if replacements is empty
+  """
+
+  SHELL_VAR_PREFIX = '$${'
+
+  def __init__(self, replacements):
+    self.replacements = replacements
+    self.pattern = None
+    if replacements:
+      # Longer tokens come first, so that a token that is a prefix of another
+      # can't prevent the longer token from matching.
+      tokens = sorted(replacements, key=len, reverse=True)
+      self.pattern = re.compile('(?<![^({ ])(?:%s)(?![^ :=})])' %
+          '|'.join([re.escape(t) for t in tokens]))
+
+  def Replace(self, s):
+    """Replaces instances in s of every original token.
+
+    Args:
+      s: string to process
+    Returns:
+      s with every instance of each original token replaced by the
+        corresponding replacement token
+    """
+    if self.pattern is None:
+      return s
+    svp_len = len(MakefileTokenReplacer.SHELL_VAR_PREFIX)
+    is_recipe = s.startswith('\t')
+    l = []
+    begin_unreplaced_segment = 0
+    # ReplaceMakefileToken() checks recipe lines for an open variable
+    # reference between the end of the previous replacement of the same token
+    # and the current instance.
+    last_replacement_end = {}
+    match = self.pattern.search(s)
+
+    while match:
+      i, end_token = match.span()
+      token = match.group()
+      if ((i < svp_len or
+           s[i - svp_len:i] != MakefileTokenReplacer.SHELL_VAR_PREFIX) and
+          (not is_recipe or
+           HasVarOpen(s[last_replacement_end.get(token, 0):i]))):
+        l.append(s[begin_unreplaced_segment:i])
+        l.append(self.replacements[token])
+        begin_unreplaced_segment = end_token
+        last_replacement_end[token] = end_token
+        match = self.pattern.search(s, end_token)
+      else:
+        match = self.pattern.search(s, i + 1)
+
+    if not l:
+      return s
+    l.append(s[begin_unreplaced_segment:])
+    return ''.join(l)
+
+
 def UpdateTargetNames(infile, outfile, targets):
   """Updates names of targets appearing in other Makefiles.
 
@@ -1206,6 +2848,7 @@ def UpdateTargetNames(infile, outfile, targets):
   """
   continued = False
   updated = False
+  replacer = MakefileTokenReplacer(targets)
 
   for line in infile:
     if continued:
@@ -1232,8 +2875,7 @@ def UpdateTargetNames(infile, outfile, targets):
 
     if continued or var_match or target_match:
       orig_line = line
-      for orig_t in targets:
-        line = ReplaceMakefileToken(line, orig_t, targets[orig_t])
+      line = replacer.Replace(line)
       continued = Continues(line)
       updated = updated or line != orig_line
 
@@ -1252,11 +2894,11 @@ def UpdateVariableNames(infile, outfile, variables):
     variables: hash of variable name -> Makefile-specific variable name
   """
   updated = False
+  replacer = MakefileTokenReplacer(variables)
 
   for line in infile:
     orig_line = line
-    for orig_v in variables:
-      line = ReplaceMakefileToken(line, orig_v, variables[orig_v])
+    line = replacer.Replace(line)
     updated = updated or line != orig_line
     print >>outfile, line,
 
@@ -1358,10 +3000,10 @@ def UpdateTargetNamesFixup(infile, outfile):
     print '%s: fixed up target names' % infile.name
 
 
-def UpdateMakefilesStage1(info, dirname, fnames):
+def UpdateMakefilesStage1(config, dirname, fnames):
   """Applies a series of updates to dirname/Makefile (if it exists).
 
-  Passed to os.path.walk() to process all the Makefiles in the OpenSSL source
+  Passed to RunStage() to process all the Makefiles in the OpenSSL source
   tree. Performs heavier-duty changes than UpdateMakefilesStage0.
 
   Args:
@@ -1393,6 +3035,18 @@ def UpdateMakefilesStage1(info, dirname, fnames):
     """Binds the local Makefile suffix to UpdateRecursiveMakeArgs()."""
     UpdateRecursiveMakeArgs(infile, outfile, makefile.suffix)
 
+  cache = config.transform_cache
+  target_context = sorted(target_map.iteritems())
+  variable_context = sorted(variable_map.iteritems())
+  UpdateTargetNamesBinder = CachedUpdate(
+      cache, UpdateTargetNamesBinder, target_context)
+  UpdateVariableNamesBinder = CachedUpdate(
+      cache, UpdateVariableNamesBinder, variable_context)
+  EmitSuffixTargetRulesBinder = CachedUpdate(
+      cache, EmitSuffixTargetRulesBinder, (variable_context, makefile.suffix))
+  UpdateRecursiveMakeArgsBinder = CachedUpdate(
+      cache, UpdateRecursiveMakeArgsBinder, makefile.suffix)
+
   UpdateFile(makefile_name, UpdateTargetNamesBinder)
   UpdateFile(makefile_name, UpdateVariableNamesBinder)
 
@@ -1402,15 +3056,14 @@ def UpdateMakefilesStage1(info, dirname, fnames):
 
   UpdateFile(makefile_name, EmitSuffixTargetRulesBinder)
   UpdateFile(makefile_name, UpdateRecursiveMakeArgsBinder)
-  UpdateFile(makefile_name, UpdateTargetNamesFixup)
+  UpdateFile(makefile_name, CachedUpdate(cache, UpdateTargetNamesFixup))
 
 
-def EliminateVarsAndTargets(infile, outfile, makefile):
+def EliminateVarsAndTargetsInDocument(document, makefile):
   """Deletes specific variables and targets from a Makefile.
 
   Args:
-    infile: Makefile to read
-    outfile: Makefile to write
+    document: MakefileDocument to update
     makefile: Makefile object containing current variable and target info
   """
   vars_to_delete = set([
@@ -1424,114 +3077,82 @@ def EliminateVarsAndTargets(infile, outfile, makefile):
   for s in [vars_to_delete, targets_to_delete]:
     s.update(set(['%s%s' % (i, makefile.suffix) for i in s]))
 
-  skip_lines = 0
-  deleted_vars = []
-  deleted_targets = []
-  for line in infile:
-    if skip_lines:
-      skip_lines -= 1
-      continue
-
-    update = None
-    var_match = VAR_DEFINITION_PATTERN.match(line)
-    target_match = TARGET_PATTERN.match(line)
-    if var_match and target_match:
-      raise UpdateMakefilesException('%s: %s\n  var: %s\n  target:%s' %
-          (infile.name, line, var_match.group(1), target_match.group(1)))
-
-    if var_match and var_match.group(1) in vars_to_delete:
-      var_name = var_match.group(1)
-      if var_name in makefile.variables:
-        v = makefile.variables[var_name]
-        skip_lines = v.num_lines - 1
-      else:
-        # This is a {BSD,GNU}makefile with one-line-only var definitions.
-        pass
-      deleted_vars.append(var_name)
-
-    elif target_match and target_match.group(1) in targets_to_delete:
-      # Note that this doesn't delete multiline target names.
-      t = makefile.targets[target_match.group(1)]
-      skip_lines = t.num_lines - 1
-      assert skip_lines >= 0, '%s: %s' % (infile.name, t)
-      deleted_targets.append(t.name)
-
-    else:
-      print >>outfile, line,
+  deleted_vars = document.Nodes(MakefileDocument.VARIABLE, vars_to_delete)
+  deleted_targets = document.Nodes(MakefileDocument.RULE, targets_to_delete)
+  for node in deleted_vars + deleted_targets:
+    document.Remove(node)
 
   if deleted_vars:
-    print '%s: deleted variables: %s' % (infile.name, ', '.join(deleted_vars))
+    print '%s: deleted variables: %s' % (
+        document.path, ', '.join([node.name for node in deleted_vars]))
   if deleted_targets:
     print '%s: deleted targets: %s' % (
-        infile.name, ', '.join(deleted_targets))
+        document.path, ', '.join([node.name for node in deleted_targets]))
 
 
-def UpdateDirectoryPaths(infile, outfile, makefile):
-  """Updates every file and directory name to be relative to the top level.
+def EliminateVarsAndTargets(infile, outfile, makefile):
+  """Deletes specific variables and targets from a Makefile.
+
+  Text filter version of EliminateVarsAndTargetsInDocument().
 
   Args:
     infile: Makefile to read
     outfile: Makefile to write
     makefile: Makefile object containing current variable and target info
   """
-  skip_lines = 0
-  multiline_target_name = []
-  updated_vars = False
-  updated_targets = False
-  for line in infile:
-    if skip_lines:
-      assert line != '\n', '%s: skipping blank line' % infile.name
-      skip_lines -= 1
-      continue
+  FilterDocument(infile, outfile, EliminateVarsAndTargetsInDocument, makefile)
 
-    update = None
-    var_match = VAR_DEFINITION_PATTERN.match(line)
-    target_match = TARGET_PATTERN.match(line)
 
-    if multiline_target_name and not target_match:
-      target_match = MULTILINE_TARGET_PATTERN.match(line)
+def UpdateDirectoryPathsInDocument(document, makefile):
+  """Updates every file and directory name to be relative to the top level.
 
-    if var_match and target_match:
-      raise UpdateMakefilesException('%s: %s\n  var: %s\n  target:%s' %
-          (infile.name, line, var_match.group(1), target_match.group(1)))
+  Args:
+    document: MakefileDocument to update
+    makefile: Makefile object containing current variable and target info
+  """
+  definitions = {}
+  updated_vars = False
+  updated_targets = False
 
-    if var_match:
-      name = var_match.group(1)
+  for node in document.Nodes(MakefileDocument.VARIABLE):
+    name = node.name
+    if name not in definitions:
       definition = makefile.UpdateVariableWithDirectoryName(name)
       if definition is not None:
         updated_vars = True
       else:
         definition = makefile.variables[name].definition
-      update = '%s%s' % (var_match.group(0), definition)
-
-    elif target_match:
-      name = '%s%s' % (
-            ''.join(multiline_target_name), target_match.group(1))
-      # Make sure not to skip too many lines.
-      skip_lines -= len(multiline_target_name)
-      multiline_target_name = []
-      target = makefile.UpdateTargetWithDirectoryName(name)
-      if target is not None:
-        updated_targets = True
-      else:
-        target = makefile.targets[name]
-      update = '%s:%s%s' % (target.name, target.prerequisites, target.recipe)
-
-    elif Continues(line) and not line.startswith('#'):
-      multiline_target_name.append(line)
-      continue
-
-    if update:
-      print >>outfile, update,
-      skip_lines += update.count('\n') - 1
-      assert skip_lines >= 0, '%s: %s' % (infile.name, update)
+      definitions[name] = definition
+    # Keep the original 'NAME =' text preceding the definition.
+    assignment = VAR_DEFINITION_PATTERN.match(node.text).group(0)
+    document.Replace(node, '%s%s' % (assignment, definitions[name]))
+
+  for node, rule in RuleTargets(document, makefile):
+    target = makefile.UpdateTargetWithDirectoryName(node.name, rule)
+    if target is not None:
+      updated_targets = True
     else:
-      print >>outfile, line,
+      target = rule
+    document.Replace(node, '%s:%s%s' % (
+        target.name, target.prerequisites, target.recipe), target.name)
 
   if updated_vars:
-    print '%s: updated variable directory paths' % infile.name
+    print '%s: updated variable directory paths' % document.path
   if updated_targets:
-    print '%s: updated target directory paths' % infile.name
+    print '%s: updated target directory paths' % document.path
+
+
+def UpdateDirectoryPaths(infile, outfile, makefile):
+  """Updates every file and directory name to be relative to the top level.
+
+  Text filter version of UpdateDirectoryPathsInDocument().
+
+  Args:
+    infile: Makefile to read
+    outfile: Makefile to write
+    makefile: Makefile object containing current variable and target info
+  """
+  FilterDocument(infile, outfile, UpdateDirectoryPathsInDocument, makefile)
 
 
 def UpdateIncludeDirectives(infile, outfile):
@@ -1611,71 +3232,74 @@ def AddDefaultRules(infile, outfile, makefile, transform_rule):
   print '%s: added default rules' % infile.name
 
 
-def RemoveDefaultTargetRules(infile, outfile, makefile):
+def RemoveDefaultTargetRulesInDocument(document, makefile):
   """Removes the default/suffix target rules from a Makefile.
 
   This should be called after AddDefaultRulesToMakefile().
 
+  Args:
+    document: MakefileDocument to update
+    makefile: Makefile object containing current default target rules
+  """
+  rules = document.Nodes(MakefileDocument.RULE, DEFAULT_RULE_TARGETS)
+  for node in rules:
+    document.Remove(node)
+
+  if rules:
+    print '%s: removed default target rules' % document.path
+
+
+def RemoveDefaultTargetRules(infile, outfile, makefile):
+  """Removes the default/suffix target rules from a Makefile.
+
+  Text filter version of RemoveDefaultTargetRulesInDocument().
+
   Args:
     infile: Makefile to read
     outfile: Makefile to write
     makefile: Makefile object containing current default target rules
   """
-  skip_lines = 0
-  target_removed = False
-  for line in infile:
-    if skip_lines:
-      skip_lines -= 1
-      continue
+  FilterDocument(infile, outfile, RemoveDefaultTargetRulesInDocument, makefile)
 
-    # Note that this doesn't handle multiline target names.
-    target_match = TARGET_PATTERN.match(line)
-    if target_match:
-      target_name = target_match.group(1)
-      if target_name in DEFAULT_RULE_TARGETS:
-        skip_lines = makefile.targets[target_name].num_lines - 1
-        target_removed = True
-        continue
-    print >>outfile, line,
 
-  if target_removed:
-    print '%s: removed default target rules' % infile.name
+def RemoveCryptoSubdirIncludeVariableInDocument(document, makefile):
+  """Removes the INCLUDES_crypto_* variables from a Makefile.
+
+  Args:
+    document: MakefileDocument for a GNUmakefile
+    makefile: Makefile object corresponding to document
+  """
+  var_removed = False
+  for node in document.Nodes(MakefileDocument.VARIABLE):
+    if node.name.startswith('INCLUDES_crypto_'):
+      document.Remove(node)
+      var_removed = True
+
+  for node in document.nodes:
+    if 'INCLUDES_crypto_' in node.text:
+      document.Replace(node, node.text.replace(
+          'INCLUDES%s' % makefile.suffix, 'INCLUDES_crypto'))
+      var_removed = True
+
+  if var_removed:
+    print '%s: removed INCLUDES_crypto_* variable' % document.path
 
 
 def RemoveCryptoSubdirIncludeVariable(infile, outfile, makefile):
   """Removes the INCLUDES_crypto_* variables from a Makefile.
 
+  Text filter version of RemoveCryptoSubdirIncludeVariableInDocument().
+
   Args:
     infile: GNUmakefile to read
     outfile: GNUmakefile to write
     makefile: Makefile object corresponding to infile/outfile
   """
-  skip_lines = 0
-  var_removed = False
-  for line in infile:
-    if skip_lines:
-      skip_lines -= 1
-      continue
+  FilterDocument(infile, outfile, RemoveCryptoSubdirIncludeVariableInDocument,
+                 makefile)
 
-    var_match = VAR_DEFINITION_PATTERN.match(line)
-    if var_match:
-      var_name = var_match.group(1)
-      if var_name.startswith('INCLUDES_crypto_'):
-        skip_lines = makefile.variables[var_name].num_lines - 1
-        var_removed = True
-        continue
-
-    if 'INCLUDES_crypto_' in line:
-      line = line.replace('INCLUDES%s' % makefile.suffix, 'INCLUDES_crypto')
-      var_removed = True
-
-    print >>outfile, line,
-
-  if var_removed:
-    print '%s: removed INCLUDES_crypto_* variable' % infile.name
 
-
-def RemoveCryptoSubdirLibTarget(infile, outfile, makefile):
+def RemoveCryptoSubdirLibTargetInDocument(document, makefile):
   """Removes the crypto/*/lib target from a Makefile.
 
   To make for a more accurate dependency graph (and improved parallelism),
@@ -1683,56 +3307,52 @@ def RemoveCryptoSubdirLibTarget(infile, outfile, makefile):
   rather than accumulating objects via 'ar r'.
 
   Args:
-    infile: GNUmakefile to read
-    outfile: GNUmakefile to write
-    makefile: Makefile object corresponding to infile/outfile
+    document: MakefileDocument for a GNUmakefile
+    makefile: Makefile object corresponding to document
   """
-  skip_lines = 0
-  target_removed = False
   lib_target_label = os.path.join(makefile.mfdir, 'lib')
-
   if lib_target_label not in makefile.targets:
-    for line in infile:
-      print >>outfile, line,
     return
 
   target_to_remove = makefile.targets[lib_target_label]
+  target_removed = False
 
-  for line in infile:
-    if skip_lines:
-      skip_lines -= 1
+  for node, target in RuleTargets(document, makefile):
+    if node.name == lib_target_label:
+      document.Remove(node)
+      target_removed = True
       continue
 
-    target_match = TARGET_PATTERN.match(line)
-    if target_match:
-      target_name = target_match.group(1)
-      target = makefile.targets[target_name]
+    if lib_target_label in target.prerequisites:
+      target.prerequisites = re.sub(
+        lib_target_label, target_to_remove.prerequisites,
+        target.prerequisites.strip())
+      document.Replace(node, '%s' % target)
+      target_removed = True
 
-      if target_name == lib_target_label:
-        skip_lines = target_to_remove.num_lines - 1
-        target_removed = True
-        continue
+  if target_removed:
+    print '%s: removed crypto/*/lib target' % document.path
 
-      elif lib_target_label in target.prerequisites:
-        target.prerequisites = re.sub(
-          lib_target_label, target_to_remove.prerequisites,
-          target.prerequisites.strip())
-        print >>outfile, '%s' % target,
-        skip_lines = target.num_lines - 1
-        target_removed = True
-        continue
 
-    print >>outfile, line,
+def RemoveCryptoSubdirLibTarget(infile, outfile, makefile):
+  """Removes the crypto/*/lib target from a Makefile.
 
-  if target_removed:
-    print '%s: removed crypto/*/lib target' % infile.name
+  Text filter version of RemoveCryptoSubdirLibTargetInDocument().
+
+  Args:
+    infile: GNUmakefile to read
+    outfile: GNUmakefile to write
+    makefile: Makefile object corresponding to infile/outfile
+  """
+  FilterDocument(infile, outfile, RemoveCryptoSubdirLibTargetInDocument,
+                 makefile)
 
 
 
-def UpdateMakefilesStage2(info, dirname, fnames):
+def UpdateMakefilesStage2(config, dirname, fnames):
   """Applies a series of updates to dirname/Makefile (if it exists).
 
-  Passed to os.path.walk() to process all the Makefiles in the OpenSSL source
+  Passed to RunStage() to process all the Makefiles in the OpenSSL source
   tree. Performs the final changes needed to "flip the switch" over to a
   nonrecursive make structure.
 
@@ -1747,66 +3367,704 @@ def UpdateMakefilesStage2(info, dirname, fnames):
   gnu_makefile_name = os.path.join(dirname, 'GNUmakefile')
   bsd_makefile_name = os.path.join(dirname, 'BSDmakefile')
 
-  def EliminateVarsAndTargetsBinder(infile, outfile):
-    """Binds the local Makefile to EliminateVarsAndTargets()."""
-    EliminateVarsAndTargets(infile, outfile, makefile)
+  def EliminateVarsAndTargetsBinder(document):
+    """Binds the local Makefile to EliminateVarsAndTargetsInDocument()."""
+    EliminateVarsAndTargetsInDocument(document, makefile)
+
+  # UpdateDirectoryPaths() consults the file system, and
+  # RemoveCryptoSubdirLibTarget() modifies the MakefileInfo, so only the other
+  # updates go through the transform cache.
+  cache = config.transform_cache
+  UpdateIncludeDirectivesCached = CachedUpdate(cache, UpdateIncludeDirectives)
 
-  UpdateFile(makefile_name, EliminateVarsAndTargetsBinder)
+  UpdateDocument(makefile_name, EliminateVarsAndTargetsBinder, cache,
+                 makefile.suffix)
 
   if config.gnu_only:
-    UpdateFile(makefile_name, UpdateIncludeDirectives)
+    UpdateFile(makefile_name, UpdateIncludeDirectivesCached)
   else:
-    UpdateFile(gnu_makefile_name, EliminateVarsAndTargetsBinder)
-    UpdateFile(bsd_makefile_name, EliminateVarsAndTargetsBinder)
-    UpdateFile(gnu_makefile_name, UpdateIncludeDirectives)
-    UpdateFile(bsd_makefile_name, UpdateIncludeDirectives)
+    UpdateDocument(gnu_makefile_name, EliminateVarsAndTargetsBinder, cache,
+                   makefile.suffix)
+    UpdateDocument(bsd_makefile_name, EliminateVarsAndTargetsBinder, cache,
+                   makefile.suffix)
+    UpdateFile(gnu_makefile_name, UpdateIncludeDirectivesCached)
+    UpdateFile(bsd_makefile_name, UpdateIncludeDirectivesCached)
 
-  def UpdateDirectoryPathsBinder(infile, outfile):
-    """Binds the local Makefile to UpdateDirectoryPaths()."""
-    UpdateDirectoryPaths(infile, outfile, makefile)
+  def UpdateDirectoryPathsBinder(document):
+    """Binds the local Makefile to UpdateDirectoryPathsInDocument()."""
+    UpdateDirectoryPathsInDocument(document, makefile)
 
-  UpdateFile(makefile_name, UpdateDirectoryPathsBinder)
+  UpdateDocument(makefile_name, UpdateDirectoryPathsBinder)
 
   def AddDefaultRulesToGnuMakefileBinder(infile, outfile):
     """Binds the local Makefile and GNU transform to AddDefaultRules()."""
     AddDefaultRules(infile, outfile, makefile, TransformDefaultRuleToGnu)
 
-  def RemoveDefaultTargetRulesBinder(infile, outfile):
-    """Binds the local Makefile to RemoveDefaultTargetRules()."""
-    RemoveDefaultTargetRules(infile, outfile, makefile)
+  def RemoveDefaultTargetRulesBinder(document):
+    """Binds the local Makefile to RemoveDefaultTargetRulesInDocument()."""
+    RemoveDefaultTargetRulesInDocument(document, makefile)
+
+  default_rules_context = (makefile.mfdir, [
+      (name, str(makefile.targets[name]))
+      for name in sorted(DEFAULT_RULE_TARGETS) if name in makefile.targets])
+  AddDefaultRulesToGnuMakefileBinder = CachedUpdate(
+      cache, AddDefaultRulesToGnuMakefileBinder, default_rules_context)
 
   if config.gnu_only:
     UpdateFile(makefile_name, AddDefaultRulesToGnuMakefileBinder)
   else:
     UpdateFile(gnu_makefile_name, AddDefaultRulesToGnuMakefileBinder)
-  UpdateFile(makefile_name, RemoveDefaultTargetRulesBinder)
+  UpdateDocument(makefile_name, RemoveDefaultTargetRulesBinder, cache)
 
-  def RemoveCryptoSubdirIncludeVariableBinder(infile, outfile):
-    """Binds the local Makefile to RemoveCryptoSubdirIncludeVariable()."""
-    RemoveCryptoSubdirIncludeVariable(infile, outfile, makefile)
+  def RemoveCryptoSubdirIncludeVariableBinder(document):
+    """Binds the local Makefile to
+    RemoveCryptoSubdirIncludeVariableInDocument()."""
+    RemoveCryptoSubdirIncludeVariableInDocument(document, makefile)
 
-  def RemoveCryptoSubdirLibTargetBinder(infile, outfile):
-    """Binds the local Makefile to RemoveCryptoSubdirLibTarget()."""
-    RemoveCryptoSubdirLibTarget(infile, outfile, makefile)
+  def RemoveCryptoSubdirLibTargetBinder(document):
+    """Binds the local Makefile to RemoveCryptoSubdirLibTargetInDocument()."""
+    RemoveCryptoSubdirLibTargetInDocument(document, makefile)
 
   path_components = dirname.split(os.path.sep)
   if 'crypto' in path_components and path_components[-1] != 'crypto':
-    UpdateFile(makefile_name, RemoveCryptoSubdirIncludeVariableBinder)
-    UpdateFile(makefile_name, RemoveCryptoSubdirLibTargetBinder)
+    UpdateDocument(makefile_name, RemoveCryptoSubdirIncludeVariableBinder,
+                   cache, makefile.suffix)
+    UpdateDocument(makefile_name, RemoveCryptoSubdirLibTargetBinder)
+
+
+def RefreshMakefileInfo(info):
+  """Brings info up to date with the files changed by UpdateFile().
+
+  If info has not been initialized yet, info.Init() parses every Makefile.
+  Otherwise only the Makefiles in MODIFIED_FILES are reparsed. Either way,
+  info.tree is updated to reflect any files created since it was last used.
+
+  Args:
+    info: MakefileInfo object
+  Returns:
+    None if info.Init() was called, otherwise the result of info.Refresh()
+  """
+  refreshed = None
+  if not info.all_makefiles:
+    info.Init()
+  else:
+    refreshed = info.Refresh(
+        [f for f in MODIFIED_FILES if f in info.all_makefiles])
+  # Walk or update the snapshot here, before any RunStage() worker processes
+  # are forked, so that they don't each have to walk the tree themselves.
+  info.tree.Refresh()
+  return refreshed
+
+
+def ListMakefileDirs():
+  """Returns the directories below the top level that contain a Makefile.
+
+  The directories are listed in the same order in which os.path.walk() would
+  visit them.
+  """
+  def CollectMakefileDir(dirs, dirname, fnames):
+    """Appends dirname to dirs if it contains a Makefile."""
+    if 'Makefile' in fnames:
+      dirs.append(dirname)
+
+  dirs = []
+  for d in os.listdir('.'):
+    if os.path.isdir(d):
+      os.path.walk(d, CollectMakefileDir, dirs)
+  return dirs
+
+
+def RunGit(*args):
+  """Runs git with args and returns its output.
+
+  Raises:
+    UpdateMakefilesException if git can't be run or fails
+  """
+  try:
+    return subprocess.check_output(('git',) + args,
+                                   stderr=open(os.devnull, 'w'))
+  except (OSError, subprocess.CalledProcessError), e:
+    raise UpdateMakefilesException('git %s: %s' % (' '.join(args), e))
+
+
+def ListGitChangedFiles(rev):
+  """Returns the set of files that differ between rev and the working tree.
+
+  Includes untracked files that aren't ignored. Paths are relative to the
+  current directory.
+  """
+  changed = RunGit('diff', '--name-only', '--relative', rev, '--')
+  untracked = RunGit('ls-files', '--others', '--exclude-standard')
+  return set(changed.splitlines()) | set(untracked.splitlines())
+
+
+def ParseGitRevision(rev, makefile_path):
+  """Parses a Makefile as of git revision rev.
+
+  Returns:
+    a Makefile object, empty if makefile_path didn't exist in rev
+  """
+  try:
+    content = RunGit('show', '%s:./%s' % (rev, makefile_path))
+  except UpdateMakefilesException:
+    content = ''
+  return ParseMakefileContent(content, makefile_path)
+
+
+def ListMakefileDirsChangedSince(rev, info, makefile_dirs):
+  """Returns the directories whose Makefiles need updating since rev.
+
+  A Makefile needs updating if it, or its {GNU,BSD}makefile, has changed
+  since rev. So does any Makefile which defines a variable or target that a
+  changed Makefile has added or removed, since that name may have become, or
+  stopped being, common to more than one Makefile.
+
+  Args:
+    rev: git revision against which to compare the working tree
+    info: MakefileInfo for the current state of the tree
+    makefile_dirs: output of ListMakefileDirs()
+  Returns:
+    (changed_dirs, affected_dirs) tuple, where changed_dirs lists the
+      directories of the changed Makefiles and affected_dirs also includes
+      those defining added or removed names, both in makefile_dirs order
+      (so the directory of a deleted Makefile appears in neither);
+      or None if a file in GLOBAL_INPUTS has changed, since then every
+      Makefile may need updating
+  """
+  changed = ListGitChangedFiles(rev)
+  if changed & GLOBAL_INPUTS:
+    return None
+
+  changed_makefiles = set()
+  for d in makefile_dirs:
+    if [f for f in MAKEFILE_NAMES if os.path.join(d, f) in changed]:
+      changed_makefiles.add(os.path.join(d, 'Makefile'))
+  # A deleted Makefile's directory is no longer in makefile_dirs, but the
+  # names it defined may have stopped being common to other Makefiles.
+  for path in changed:
+    if os.path.basename(path) == 'Makefile' and not os.path.exists(path):
+      changed_makefiles.add(path)
+
+  affected_makefiles = set(changed_makefiles)
+  for path in changed_makefiles:
+    old = ParseGitRevision(rev, path)
+    new = info.all_makefiles.get(path) or Makefile(path)
+    for name in set(old.variables) ^ set(new.variables):
+      affected_makefiles.update([mf for mf, _ in info.all_vars.get(name, [])])
+    for name in set(old.targets) ^ set(new.targets):
+      affected_makefiles.update(
+          [mf for mf, _, _ in info.all_targets.get(name, [])])
+
+  def Dirs(makefiles):
+    return [d for d in makefile_dirs
+            if os.path.join(d, 'Makefile') in makefiles]
+  return Dirs(changed_makefiles), Dirs(affected_makefiles)
+
+
+def ReadConfigVarsForUpdates(gnu_only):
+  """Returns the CONFIG_VARS for the tree, read from configure.mk.org.
+
+  Args:
+    gnu_only: True if GNU-specific updates are being applied
+  Returns:
+    hash of variable name -> 1, empty if configure.mk.org doesn't exist
+  """
+  if not os.path.exists('configure.mk.org'):
+    return {}
+  config_vars = ReadConfigureVars('configure.mk.org')
+  if not gnu_only:
+    # Adding TOP since it's defined in each Makefile
+    config_vars['TOP'] = 1
+  # MAKEDEPEND is on its way out, too.
+  config_vars['MAKEDEPEND'] = 1
+  return config_vars
+
+
+def UpdateTopLevelFiles(config):
+  """Applies the Stage0 updates to the top-level Makefiles."""
+  if config.gnu_only:
+    UpdateFile('Makefile.org', AddGnuIncludeDirectivesToMakefile)
+    UpdateFile('Makefile.fips', AddGnuIncludeDirectivesToMakefile)
+  else:
+    CreateGnuMakefile('.')
+    CreateBsdMakefile('.')
+  UpdateFile('Makefile.org', RemoveConfigureVars)
+  UpdateFile('Makefile.fips', RemoveConfigureVars)
+  UpdateFile('Makefile.shared', RemoveConfigureVars)
+
+
+def ListWatchedFiles(makefile_dirs):
+  """Returns the files watched by --watch: every file the stages update."""
+  watched = [os.path.join(d, f) for d in makefile_dirs for f in MAKEFILE_NAMES]
+  watched.extend(GLOBAL_INPUTS)
+  return watched
+
+
+class PollingWatcher(object):
+  """Detects changes to a set of files by polling their sizes and mtimes.
+
+  Attributes:
+    paths: files to watch
+    interval: seconds to wait between polls
+    stats: hash of path -> (mtime, size), or None if the path doesn't exist
+  """
+
+  def __init__(self, paths, interval=0.5):
+    self.paths = [os.path.normpath(p) for p in paths]
+    self.interval = interval
+    self.stats = self._Stat()
+
+  def _Stat(self):
+    stats = {}
+    for path in self.paths:
+      try:
+        info = os.stat(path)
+        stats[path] = (info.st_mtime, info.st_size)
+      except OSError:
+        stats[path] = None
+    return stats
+
+  def SetPaths(self, paths):
+    """Replaces the watched files; new paths are compared from now on."""
+    self.paths = [os.path.normpath(p) for p in paths]
+    stats = self.stats
+    self.stats = self._Stat()
+    self.stats.update([(p, stats[p]) for p in self.paths if p in stats])
+
+  def Poll(self):
+    """Returns the set of paths that have changed since the last poll."""
+    stats = self._Stat()
+    changed = set([p for p in self.paths if stats[p] != self.stats[p]])
+    self.stats = stats
+    return changed
+
+  def Wait(self):
+    """Blocks until at least one path changes, then returns all that did."""
+    while True:
+      changed = self.Poll()
+      if changed:
+        return changed
+      time.sleep(self.interval)
+
+
+class InotifyWatcher(object):
+  """Detects changes to a set of files via inotify, using pyinotify.
+
+  A Makefile created in, or below, the directory of a watched file is also
+  reported, so that Watch() can pick up new Makefile directories.
+
+  Attributes:
+    paths: set of files to watch
+    interval: seconds to wait for further changes after the first, so that
+      a burst of writes is handled at once
+  """
+
+  MASK = (getattr(pyinotify, 'IN_CLOSE_WRITE', 0) |
+          getattr(pyinotify, 'IN_MOVED_TO', 0) |
+          getattr(pyinotify, 'IN_DELETE', 0) |
+          getattr(pyinotify, 'IN_CREATE', 0))
+
+  def __init__(self, paths, interval=0.05):
+    self.interval = interval
+    self._changed = set()
+    watcher = self
+
+    class Handler(pyinotify.ProcessEvent):
+      """Records events for watched paths."""
+      def process_default(self, event):
+        path = os.path.normpath(event.pathname)
+        if path in watcher.paths or (os.path.basename(path) == 'Makefile' and
+                                     not event.dir):
+          watcher._changed.add(path)
+
+    self._watch_manager = pyinotify.WatchManager()
+    self._notifier = pyinotify.Notifier(self._watch_manager, Handler())
+    self._watched_dirs = set()
+    self.SetPaths(paths)
+
+  def SetPaths(self, paths):
+    """Replaces the watched files, watching any new directories."""
+    self.paths = set([os.path.normpath(p) for p in paths])
+    for dirname in set([os.path.dirname(p) or os.curdir for p in self.paths]):
+      if dirname not in self._watched_dirs and os.path.isdir(dirname):
+        self._watch_manager.add_watch(dirname, InotifyWatcher.MASK,
+                                      auto_add=True)
+        self._watched_dirs.add(dirname)
+
+  def _ProcessEvents(self, timeout_ms):
+    if self._notifier.check_events(timeout_ms):
+      self._notifier.read_events()
+      self._notifier.process_events()
+
+  def Wait(self):
+    """Blocks until at least one path changes, then returns all that did."""
+    while not self._changed:
+      self._ProcessEvents(None)
+    self._ProcessEvents(int(self.interval * 1000))
+    changed, self._changed = self._changed, set()
+    return changed
+
+
+def MakeWatcher(paths):
+  """Returns an InotifyWatcher if pyinotify is available, else a
+  PollingWatcher."""
+  if pyinotify is not None:
+    return InotifyWatcher(paths)
+  return PollingWatcher(paths)
+
+
+def UpdateChangedMakefiles(config, changed_paths, makefile_dirs, max_stage=2):
+  """Applies the stages to the Makefiles affected by changed files.
+
+  Used by Watch(). Stage0 is applied to the directories of the changed files,
+  then config.makefile_info is refreshed. Stage1 and Stage2 are applied to
+  those directories plus the directories of any Makefiles whose common
+  variables or targets changed as a result. If a file in GLOBAL_INPUTS has
+  changed, every directory is updated.
+
+  Args:
+    config: Config object whose makefile_info reflects the tree before the
+      changes
+    changed_paths: paths of the files that have changed
+    makefile_dirs: output of ListMakefileDirs()
+    max_stage: last stage to apply
+  Returns:
+    the list of directories whose Makefiles were updated
+  """
+  info = config.makefile_info
+  changed_paths = set([os.path.normpath(p) for p in changed_paths])
+  global_change = bool(changed_paths & GLOBAL_INPUTS)
+  if global_change:
+    changed_dirs = list(makefile_dirs)
+  else:
+    changed_dirs = [d for d in makefile_dirs if [
+        f for f in MAKEFILE_NAMES if os.path.join(d, f) in changed_paths]]
+
+  RunStage(UpdateMakefilesStage0, config, changed_dirs)
+  if global_change:
+    UpdateTopLevelFiles(config)
+  if max_stage == 0:
+    return changed_dirs
+
+  makefiles = set([os.path.join(d, 'Makefile') for d in changed_dirs])
+  makefiles.update([p for p in changed_paths | MODIFIED_FILES
+                    if p in info.all_makefiles])
+  affected = info.Refresh(makefiles)
+  info.tree.Refresh()
+  dirs = [d for d in makefile_dirs
+          if d in changed_dirs or os.path.join(d, 'Makefile') in affected]
+
+  RunStage(UpdateMakefilesStage1, config, dirs)
+  if max_stage > 1:
+    RunStage(UpdateMakefilesStage2, config, dirs)
+  return dirs
+
+
+def ReadFileOrNone(path):
+  """Returns the content of path, or None if it can't be read."""
+  try:
+    with open(path) as infile:
+      return infile.read()
+  except IOError:
+    return None
+
+
+def Watch(config, makefile_dirs, watcher, shadow_dir=None, max_stage=2,
+          rounds=None):
+  """Applies UpdateChangedMakefiles() every time watched files change.
+
+  Keeps config.makefile_info up to date with every change, including those
+  made by the updates themselves. Changes that leave a file with the content
+  last written by an update are ignored, so that the updates don't trigger
+  themselves. makefile_dirs is listed again on every change, so that created
+  and removed Makefiles are picked up and watched, or no longer watched.
+
+  A failed update is reported and the watch goes on; since
+  MakefileInfo.Refresh() leaves config.makefile_info unchanged when a
+  Makefile can't be parsed, the failing file is parsed again once it changes.
+
+  Args:
+    config: Config object whose makefile_info reflects the current tree
+    makefile_dirs: output of ListMakefileDirs()
+    watcher: PollingWatcher or InotifyWatcher
+    shadow_dir: passed to Workspace.Commit() if WORKSPACE is set
+    max_stage: last stage to apply
+    rounds: number of changes to handle before returning, or None to run
+      until interrupted
+  """
+  global CONFIG_VARS, WORKSPACE
+  info = config.makefile_info
+  written = {}
+  while rounds is None or rounds > 0:
+    changed = [p for p in watcher.Wait()
+               if ReadFileOrNone(p) != written.get(p, False)]
+    if not changed:
+      continue
+    if rounds is not None:
+      rounds -= 1
+
+    start = time.time()
+    current_dirs = ListMakefileDirs()
+    if current_dirs != makefile_dirs:
+      added_or_removed = set(current_dirs) ^ set(makefile_dirs)
+      changed = sorted(set(changed).union(
+          [os.path.join(d, 'Makefile') for d in added_or_removed]))
+      makefile_dirs = current_dirs
+      watcher.SetPaths(ListWatchedFiles(makefile_dirs))
+    MODIFIED_FILES.clear()
+    if WORKSPACE is not None:
+      WORKSPACE = Workspace()
+    if 'configure.mk.org' in changed:
+      CONFIG_VARS = ReadConfigVarsForUpdates(config.gnu_only)
+
+    try:
+      dirs = UpdateChangedMakefiles(config, changed, makefile_dirs, max_stage)
+      if WORKSPACE is not None:
+        WORKSPACE.Commit(shadow_dir)
+      info.Refresh([f for f in MODIFIED_FILES if f in info.all_makefiles])
+      info.tree.Refresh()
+    except UpdateMakefilesException, e:
+      print >>sys.stderr, 'Update failed: %s' % e
+      continue
+    except Exception:
+      print >>sys.stderr, 'Update failed:'
+      sys.excepthook(*sys.exc_info())
+      continue
+    updated = set([os.path.join(d, f) for d in dirs for f in MAKEFILE_NAMES])
+    for path in updated | MODIFIED_FILES:
+      written[path] = ReadFileOrNone(path)
+    print '%d files changed: %d directories updated, %d files modified ' \
+        'in %.0f ms' % (len(changed), len(dirs), len(MODIFIED_FILES),
+                        (time.time() - start) * 1000)
+    sys.stdout.flush()
+
+
+# The Config object shared by all the stages run by a RunStage() worker.
+_worker_config = None
+# True if a RunStage() worker should profile its updates.
+_worker_profile = False
+# The paths created in the parent's WORKSPACE when a RunStage() began.
+_worker_created_paths = None
+
+
+def _InitStageWorker(config, config_vars, profile, created_paths):
+  """Stores the shared state needed by _RunStageWorker() in a pool process.
+
+  Args:
+    config: Config object
+    config_vars: the contents of CONFIG_VARS in the parent process
+    profile: True if PROFILE is set in the parent process
+    created_paths: Workspace.CreatedPaths() in the parent process when the
+      stage started, or None if the parent process isn't using a Workspace
+  """
+  global _worker_config, _worker_profile, _worker_created_paths, CONFIG_VARS
+  _worker_config = config
+  _worker_profile = profile
+  _worker_created_paths = created_paths
+  CONFIG_VARS = config_vars
+
+
+def _RunStageWorker(args):
+  """Applies a stage function to one directory in a pool process.
+
+  Args:
+    args: (stage_func, dirname, workspace_entries) tuple, where
+      workspace_entries is the output of Workspace.Export() for dirname, or
+      None if the parent process isn't using a Workspace
+  Returns:
+    (output, modified_files, workspace_entries, profile_records) tuple, where
+      output is everything the stage printed to standard output,
+      modified_files lists the files it changed, workspace_entries is the
+      output of Workspace.Export() after the stage, or None, and
+      profile_records holds the TransformProfile records for the stage, or
+      None
+  """
+  global PROFILE, WORKSPACE
+  stage_func, dirname, workspace_entries = args
+  MODIFIED_FILES.clear()
+  WORKSPACE = None
+  if workspace_entries is not None:
+    WORKSPACE = Workspace()
+    WORKSPACE.Import(workspace_entries)
+    WORKSPACE.created_elsewhere = _worker_created_paths.difference(
+        WORKSPACE.documents)
+  PROFILE = None
+  if _worker_profile:
+    PROFILE = TransformProfile()
+    PROFILE.stage = stage_func.__name__
+
+  output = StringIO.StringIO()
+  sys.stdout = output
+  try:
+    stage_func(_worker_config, dirname, ['Makefile'])
+  finally:
+    sys.stdout = sys.__stdout__
+  # Export() returns an empty list for an empty workspace, so the result
+  # can't be chosen with 'and ... or'.
+  workspace_entries = None
+  if WORKSPACE is not None:
+    workspace_entries = WORKSPACE.Export()
+  return (output.getvalue(), list(MODIFIED_FILES), workspace_entries,
+          PROFILE is not None and PROFILE.records or None)
+
+
+def RunStage(stage_func, config, dirs):
+  """Applies stage_func to every directory in dirs.
+
+  If config.jobs is greater than one, the directories are distributed across
+  a pool of that many processes, each of which receives config once when it
+  starts. The output of each directory is printed in the order of dirs,
+  exactly as if the directories had been processed serially. If WORKSPACE is
+  set, each process receives the workspace files for its directory, and the
+  paths of the files created in the workspace before the stage began, and
+  returns its files updated. If PROFILE is set, the stage is recorded in it,
+  along with the updates made by every process.
+
+  Args:
+    stage_func: one of the UpdateMakefilesStage* functions
+    config: Config object
+    dirs: list of directories containing Makefiles
+  """
+  if PROFILE is not None:
+    PROFILE.stage = stage_func.__name__
+  start = time.time()
+  if config.jobs <= 1:
+    for d in dirs:
+      stage_func(config, d, ['Makefile'])
+  else:
+    _RunStageInPool(stage_func, config, dirs)
+  if PROFILE is not None:
+    PROFILE.RecordStage(stage_func.__name__, len(dirs), time.time() - start)
+    PROFILE.stage = None
+
+
+def RunProfiledStep(name, func, *args):
+  """Calls func(*args), recording it in PROFILE as a stage called name.
+
+  Used for the steps run between the RunStage() calls, such as parsing the
+  Makefiles and UpdateTopLevelFiles(), so that their time and updates are
+  reported by --profile_json too.
+
+  Returns:
+    the result of func(*args)
+  """
+  if PROFILE is not None:
+    PROFILE.stage = name
+  start = time.time()
+  try:
+    return func(*args)
+  finally:
+    if PROFILE is not None:
+      PROFILE.RecordStage(name, 0, time.time() - start)
+      PROFILE.stage = None
+
+
+def _RunStageInPool(stage_func, config, dirs):
+  """Implements RunStage() for config.jobs greater than one."""
+  created_paths = None
+  if WORKSPACE is not None:
+    created_paths = WORKSPACE.CreatedPaths()
+  pool = multiprocessing.Pool(
+      config.jobs, _InitStageWorker,
+      (config, CONFIG_VARS, PROFILE is not None, created_paths))
+  # A worker given None instead of an empty list would write to disk.
+  tasks = []
+  for d in dirs:
+    workspace_entries = None
+    if WORKSPACE is not None:
+      workspace_entries = WORKSPACE.Export(d)
+    tasks.append((stage_func, d, workspace_entries))
+  try:
+    for output, modified_files, workspace_entries, profile_records in (
+        pool.imap(_RunStageWorker, tasks)):
+      sys.stdout.write(output)
+      MODIFIED_FILES.update(modified_files)
+      if workspace_entries is not None:
+        WORKSPACE.Import(workspace_entries)
+      if profile_records is not None:
+        PROFILE.Merge(profile_records)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+def PrintModifiedFileCount(dry_run=None):
+  """Prints the number of files actually changed by UpdateFile().
+
+  Args:
+    dry_run: if set, nothing has been written, so the files are reported as
+      ones that would be modified
+  """
+  if dry_run:
+    print '%d files would be modified' % len(MODIFIED_FILES)
+  else:
+    print '%d files modified' % len(MODIFIED_FILES)
+
+
+def FinishRun(dry_run=None, shadow_dir=None, profile_json=None):
+  """Writes any changes held in WORKSPACE and reports the modified files.
+
+  Args:
+    dry_run: if set, passed to Workspace.PrintChanges() instead of writing
+      the changes
+    shadow_dir: passed to Workspace.Commit()
+    profile_json: if set, the file to which to write the PROFILE report
+  """
+  start = time.time()
+  if WORKSPACE is not None:
+    if dry_run:
+      WORKSPACE.PrintChanges(dry_run)
+    else:
+      WORKSPACE.Commit(shadow_dir)
+  PrintModifiedFileCount(dry_run)
+  if PROFILE is not None:
+    PROFILE.RecordStage('FinishRun', 0, time.time() - start)
+    if profile_json:
+      PROFILE.Write(profile_json)
+
+
+def PrintBuildGraphStats(label, info):
+  """Prints the build_graph.py statistics for the Makefiles as they stand.
+
+  The Makefiles are parsed again, via WORKSPACE if it's set, rather than
+  refreshing info, since later stages expect info to be left as it is.
+
+  Args:
+    label: point in the run at which the statistics were taken
+    info: MakefileInfo whose parse_cache and lazy_depend settings to use
+  """
+  # Imported here rather than at the top, since build_graph imports this
+  # module.
+  import build_graph
+  current = MakefileInfo(info.parse_cache, info.lazy_depend)
+  current.Init()
+  stats = build_graph.BuildGraph(current.all_makefiles).Analyze()
+  print 'Build graph %s: %s' % (label, build_graph.FormatStats(stats))
 
 
 class Config(object):
-  """Holds configuration info passed into os.path.walk() during processing.
+  """Holds configuration info passed to the stage functions during processing.
 
   Attributes:
     gnu_only: True if GNU-specific updates should be applied directly to the
       Makefiles
+    pipeline: True if a series of updates to the same Makefile should be
+      applied in memory via ComposeUpdates(), rather than one UpdateFile()
+      call per update
+    jobs: number of processes used to update Makefiles in parallel
     makefile_info: a MakefileInfo instance
+    transform_cache: TransformCache through which to apply updates, or None
   """
 
   def __init__(self):
     self.gnu_only = False
+    self.pipeline = True
+    self.jobs = 1
     self.makefile_info = MakefileInfo()
+    self.transform_cache = None
 
 
 if __name__ == '__main__':
@@ -1821,13 +4079,84 @@ if __name__ == '__main__':
   parser.add_argument('--gnu_only',
         help='Apply updates to convert Makefiles to GNU syntax',
         action='store_true')
+  parser.add_argument('--no_pipeline',
+        help='Read and write each Makefile once per update, rather than once '
+        'per series of updates',
+        dest='pipeline', action='store_false')
+  parser.add_argument('--no_workspace',
+        help='Write each update to disk immediately, rather than holding '
+        'every file in memory and writing it once at the end of the run',
+        dest='workspace', action='store_false')
+  parser.add_argument('--dry_run',
+        help='Apply every update in memory and print a unified diff (the '
+        'default) or per-file change stats, rather than writing any files',
+        nargs='?', const='diff', choices=['diff', 'stat'])
+  parser.add_argument('--transactional',
+        help='Commit every change at once via a shadow tree, leaving the '
+        'tree untouched if anything fails',
+        action='store_true')
+  parser.add_argument('--jobs',
+        help='Number of processes used to update directories in parallel',
+        default=1, type=int)
+  parser.add_argument('--parse_cache',
+        help='File in which to cache parsed Makefiles between runs')
+  parser.add_argument('--transform_cache',
+        help='Directory in which to cache the results of updates, shared '
+        'between runs and working copies')
+  parser.add_argument('--lazy_depend',
+        help='Skip the rules in the makedepend output when parsing '
+        'Makefiles; they are removed by the first stage anyway',
+        action='store_true')
+  parser.add_argument('--since',
+        help='Update only the Makefiles affected by changes since this git '
+        'revision; best combined with --parse_cache',
+        metavar='REV')
+  parser.add_argument('--watch',
+        help='Keep running, updating the affected Makefiles whenever any '
+        'Makefile changes; uses inotify if pyinotify is installed, '
+        'otherwise polling',
+        action='store_true')
+  parser.add_argument('--profile_json',
+        help='Write the time, I/O and result of every update of every file, '
+        'with per-stage and top-N summaries, to this file as JSON',
+        metavar='FILE')
+  parser.add_argument('--build_graph',
+        help='Print the critical path, maximum width and number of recursive '
+        'makes of the build graph before and after each stage',
+        action='store_true')
   parser.add_argument('--max_stage',
         help='Maximum stage of processing to perform',
         default=2, type=int, choices=range(0,3))
   args = parser.parse_args()
+  if args.dry_run and not args.workspace:
+    parser.error('--dry_run requires the workspace; omit --no_workspace')
+  if args.watch and args.dry_run:
+    parser.error('--watch and --dry_run are mutually exclusive')
+  if args.transactional and not args.workspace:
+    parser.error('--transactional requires the workspace; omit '
+                 '--no_workspace')
+  if args.since:
+    try:
+      if RunGit('rev-parse', '--is-inside-work-tree').strip() != 'true':
+        raise UpdateMakefilesException('not inside the work tree')
+    except UpdateMakefilesException:
+      parser.error('--since requires running inside a git work tree')
+    try:
+      RunGit('rev-parse', '--verify', '%s^{commit}' % args.since)
+    except UpdateMakefilesException:
+      parser.error('--since: unknown git revision %s' % args.since)
+  shadow_dir = args.transactional and SHADOW_TREE_DIR or None
+
+  if ShadowTree(SHADOW_TREE_DIR).Recover():
+    print 'Recovered from the incomplete commit in %s' % SHADOW_TREE_DIR
+
+  parse_cache = None
+  if args.parse_cache:
+    parse_cache = ParseCache(args.parse_cache)
+    parse_cache.Load()
 
   if args.print_common or args.print_makefile:
-    info = MakefileInfo()
+    info = MakefileInfo(parse_cache, args.lazy_depend)
     info.Init()
     if args.print_common:
       info.PrintCommonVarsAndTargets()
@@ -1837,51 +4166,97 @@ if __name__ == '__main__':
 
   config = Config()
   config.gnu_only = args.gnu_only
+  config.pipeline = args.pipeline
+  config.jobs = args.jobs
+  config.makefile_info.parse_cache = parse_cache
+  config.makefile_info.lazy_depend = args.lazy_depend
+  if args.transform_cache:
+    config.transform_cache = TransformCache(args.transform_cache)
+  if args.workspace:
+    WORKSPACE = Workspace()
+  if args.profile_json:
+    PROFILE = TransformProfile()
 
   # Read the top-level configure file, if it exists.
-  if os.path.exists('configure.mk.org'):
-    CONFIG_VARS = ReadConfigureVars('configure.mk.org')
-    if not config.gnu_only:
-      # Adding TOP since it's defined in each Makefile
-      CONFIG_VARS['TOP'] = 1
-    # MAKEDEPEND is on its way out, too.
-    CONFIG_VARS['MAKEDEPEND'] = 1
+  CONFIG_VARS = ReadConfigVarsForUpdates(config.gnu_only)
+
+  # With a warm parse cache, parsing the whole tree before Stage0 is cheap,
+  # leaving only the Makefiles that Stage0 changes to be reparsed afterwards.
+  if (parse_cache is not None and parse_cache.entries or args.since or
+      args.watch):
+    RunProfiledStep('MakefileInfo.Init', config.makefile_info.Init)
+
+  if args.watch:
+    makefile_dirs = ListMakefileDirs()
+    config.makefile_info.tree.Refresh()
+    watched = ListWatchedFiles(makefile_dirs)
+    print 'Watching %d files via %s; press Ctrl-C to stop' % (
+        len(watched), pyinotify is not None and 'inotify' or 'polling')
+    sys.stdout.flush()
+    try:
+      Watch(config, makefile_dirs, MakeWatcher(watched), shadow_dir,
+            args.max_stage)
+    except KeyboardInterrupt:
+      pass
+    sys.exit(0)
 
   if args.makefile:
     mfdir = os.path.dirname(args.makefile)
     files = ['Makefile']
-    UpdateMakefilesStage0(config, mfdir, files)
-    config.makefile_info.Init()
-    UpdateMakefilesStage1(config, mfdir, files)
-    UpdateMakefilesStage2(config, mfdir, files)
+    RunProfiledStep('UpdateMakefilesStage0', UpdateMakefilesStage0, config,
+                    mfdir, files)
+    RunProfiledStep('RefreshMakefileInfo', RefreshMakefileInfo,
+                    config.makefile_info)
+    RunProfiledStep('UpdateMakefilesStage1', UpdateMakefilesStage1, config,
+                    mfdir, files)
+    RunProfiledStep('UpdateMakefilesStage2', UpdateMakefilesStage2, config,
+                    mfdir, files)
+    FinishRun(args.dry_run, shadow_dir, args.profile_json)
     sys.exit(0)
 
-  for d in os.listdir('.'):
-    if os.path.isdir(d):
-      os.path.walk(d, UpdateMakefilesStage0, config)
-
-  if args.gnu_only:
-    UpdateFile('Makefile.org', AddGnuIncludeDirectivesToMakefile)
-    UpdateFile('Makefile.fips', AddGnuIncludeDirectivesToMakefile)
-  else:
-    CreateGnuMakefile('.')
-    CreateBsdMakefile('.')
-  UpdateFile('Makefile.org', RemoveConfigureVars)
-  UpdateFile('Makefile.fips', RemoveConfigureVars)
-  UpdateFile('Makefile.shared', RemoveConfigureVars)
+  makefile_dirs = ListMakefileDirs()
+  stage0_dirs = makefile_dirs
+  all_makefile_dirs = None
+  if args.since:
+    since_dirs = ListMakefileDirsChangedSince(
+        args.since, config.makefile_info, makefile_dirs)
+    if since_dirs is None:
+      print 'Top-level files changed since %s; updating every Makefile' % (
+          args.since)
+    else:
+      all_makefile_dirs = makefile_dirs
+      stage0_dirs, makefile_dirs = since_dirs
+      print '%d of %d Makefiles affected by changes since %s' % (
+          len(makefile_dirs), len(all_makefile_dirs), args.since)
+  if args.build_graph:
+    PrintBuildGraphStats('before Stage0', config.makefile_info)
+  RunStage(UpdateMakefilesStage0, config, stage0_dirs)
+
+  RunProfiledStep('UpdateTopLevelFiles', UpdateTopLevelFiles, config)
+  if args.build_graph:
+    PrintBuildGraphStats('after Stage0', config.makefile_info)
 
   if args.max_stage == 0:
+    FinishRun(args.dry_run, shadow_dir, args.profile_json)
     sys.exit(0)
 
-  config.makefile_info.Init()
+  refreshed = RunProfiledStep('RefreshMakefileInfo', RefreshMakefileInfo,
+                              config.makefile_info)
+  if all_makefile_dirs is not None:
+    # Stage0 may have changed which names are common, too.
+    makefile_dirs = [d for d in all_makefile_dirs if d in makefile_dirs or
+                     os.path.join(d, 'Makefile') in (refreshed or ())]
 
-  for d in os.listdir('.'):
-    if os.path.isdir(d):
-      os.path.walk(d, UpdateMakefilesStage1, config)
+  RunStage(UpdateMakefilesStage1, config, makefile_dirs)
+  if args.build_graph:
+    PrintBuildGraphStats('after Stage1', config.makefile_info)
 
   if args.max_stage == 1:
+    FinishRun(args.dry_run, shadow_dir, args.profile_json)
     sys.exit(0)
 
-  for d in os.listdir('.'):
-    if os.path.isdir(d):
-      os.path.walk(d, UpdateMakefilesStage2, config)
+  RunStage(UpdateMakefilesStage2, config, makefile_dirs)
+  if args.build_graph:
+    PrintBuildGraphStats('after Stage2', config.makefile_info)
+
+  FinishRun(args.dry_run, shadow_dir, args.profile_json)
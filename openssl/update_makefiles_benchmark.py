@@ -0,0 +1,376 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Benchmarks for the hot spots of update_makefiles.py.
+
+Run directly to print the results:
+
+  $ python update_makefiles_benchmark.py
+
+The microbenchmarks of the helpers applied to every token in the tree can be
+saved as a baseline, then compared against it to catch regressions:
+
+  $ python update_makefiles_benchmark.py --save_baseline baseline.json
+  $ python update_makefiles_benchmark.py --baseline baseline.json
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import update_makefiles
+
+import argparse
+import json
+import StringIO
+import sys
+import timeit
+
+# Recipe line containing one of each kind of $(TOP) reference handled by
+# EliminateTop(): by itself, followed by a child path, and followed by '/'.
+TOP_RECIPE_LINE = (
+    '\tcat $(TOP_test)/configure.mk $(TOP_test)/Makefile.shared | '
+    '$(MAKE) -f - -I$(TOP_test) -L$(TOP_test)/ \\\n')
+
+
+def BestTime(func, repeat=3, number=1):
+  """Returns the fastest of repeat runs of number calls to func, in seconds."""
+  return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def BenchmarkEliminateTop(sizes=(250, 500, 1000, 2000, 4000, 8000)):
+  """Times EliminateTop() on recipes with increasing numbers of $(TOP)s.
+
+  Each size is double the previous one, so the ratio column should stay
+  close to 2.0 for a linear-time implementation; a quadratic implementation
+  approaches 4.0.
+
+  Args:
+    sizes: numbers of TOP_RECIPE_LINE lines in each successive recipe
+  Returns:
+    list of (number of lines, number of $(TOP) references, seconds) tuples
+  """
+  results = []
+  for size in sizes:
+    recipe = TOP_RECIPE_LINE * size
+    seconds = BestTime(lambda: update_makefiles.EliminateTop(recipe))
+    results.append((size, recipe.count('$(TOP'), seconds))
+  return results
+
+
+class DictVariable(object):
+  """Makefile.Variable as it was before __slots__, for memory comparison."""
+
+  def __init__(self, name, definition):
+    self.name = name
+    self.definition = definition
+    self.num_lines = definition.count('\n')
+
+
+class DictTarget(object):
+  """Makefile.Target as it was before __slots__, for memory comparison."""
+
+  def __init__(self, name, prerequisites, recipe):
+    self.name = name
+    self.prerequisites = prerequisites
+    self.recipe = recipe
+    self.num_lines = (name.count('\n') + prerequisites.count('\n') +
+                      recipe.count('\n'))
+
+
+def SyntheticMakefile(path, num_vars=40, num_targets=40):
+  """Returns a Makefile parsed from generated contents.
+
+  Args:
+    path: name given to the in-memory Makefile
+    num_vars: number of variable definitions to generate
+    num_targets: number of targets to generate
+  Returns:
+    a Makefile object
+  """
+  lines = []
+  for i in range(num_vars):
+    lines.append('VAR_%d=value_%d $(OTHER_%d)\n' % (i, i, i))
+  for i in range(num_targets):
+    lines.append('target_%d: prereq_%d.o $(VAR_%d)\n' % (i, i, i))
+    lines.append('\t$(CC) -o $@ prereq_%d.o\n' % i)
+  infile = StringIO.StringIO(''.join(lines))
+  infile.name = path
+  return update_makefiles.ParseMakefile(infile)
+
+
+def BenchmarkLazyDepend(sizes=(1000, 4000, 16000)):
+  """Times ParseMakefile() with and without lazy_depend on makedepend tails.
+
+  Args:
+    sizes: numbers of lines in each successive makedepend tail
+  Returns:
+    list of (number of lines, full parse seconds, lazy parse seconds) tuples
+  """
+  head = ''.join('VAR_%d=value_%d\n' % (i, i) for i in range(40))
+  results = []
+  for size in sizes:
+    tail = ''.join('obj_%d.o: ../../include/openssl/hdr_%d.h src_%d.c\n' %
+                   (i % 50, i, i % 50) for i in range(size))
+    content = head + update_makefiles.MAKE_DEPEND_LINE + tail
+    def Parse(lazy_depend):
+      return lambda: update_makefiles.ParseMakefileContent(
+          content, 'Makefile', lazy_depend=lazy_depend)
+    results.append((size, BestTime(Parse(False)), BestTime(Parse(True))))
+  return results
+
+
+def PrintLazyDependResults(title, results):
+  """Prints the output of BenchmarkLazyDepend()."""
+  print title
+  print '%10s %12s %12s %8s' % ('lines', 'full', 'lazy', 'speedup')
+  for lines, full, lazy in results:
+    print '%10d %12.6f %12.6f %7.1fx' % (lines, full, lazy, full / lazy)
+
+
+def ObjectBytes(obj):
+  """Returns the size of obj plus its __dict__, if it has one."""
+  size = sys.getsizeof(obj)
+  if hasattr(obj, '__dict__'):
+    size += sys.getsizeof(obj.__dict__)
+  return size
+
+
+def BenchmarkModelMemory(num_makefiles=200):
+  """Compares the memory used by Variable/Target objects for a synthetic tree.
+
+  Args:
+    num_makefiles: number of synthetic Makefiles to parse
+  Returns:
+    list of (model name, number of objects, bytes) tuples
+  """
+  slots = []
+  dicts = []
+  for i in range(num_makefiles):
+    makefile = SyntheticMakefile('dir_%d/Makefile' % i)
+    for var in makefile.variables.itervalues():
+      slots.append(var)
+      dicts.append(DictVariable(var.name, var.definition))
+    for target in makefile.targets.itervalues():
+      slots.append(target)
+      dicts.append(DictTarget(target.name, target.prerequisites,
+                              target.recipe))
+  return [(name, len(objs), sum(ObjectBytes(obj) for obj in objs))
+          for name, objs in (('__slots__', slots), ('__dict__', dicts))]
+
+
+def PrintMemoryResults(title, results):
+  """Prints the output of a memory benchmark.
+
+  Args:
+    title: name of the benchmark
+    results: list of (model name, number of objects, bytes) tuples
+  """
+  print title
+  print '%10s %10s %12s %10s' % ('model', 'objects', 'bytes', 'per obj')
+  for name, count, size in results:
+    print '%10s %10d %12d %10.1f' % (name, count, size, float(size) / count)
+
+
+def MicrobenchmarkCases():
+  """Returns the inputs for each of the helpers applied to every token.
+
+  The inputs follow the patterns in update_makefiles_test.py.
+
+  Returns:
+    list of (name, function, list of argument tuples) tuples
+  """
+  makefile = SyntheticMakefile('crypto/aes/Makefile')
+  # The first call computes the set of updatable tokens for the Makefile.
+  makefile.IsUpdatableRecipeToken('lib')
+
+  split_cases = [
+      ('\tfoo bar\n',),
+      ('\t \nfoo\t \nbar\t \n',),
+      ('-I.. -I../.. -I../modes -I../asn1 -I../evp -I../../include '
+       '$(ZLIB_INCLUDE)\n',),
+      (TOP_RECIPE_LINE,),
+      ]
+  # The stages call SplitPreservingWhitespace() with SPLIT_MEMO, in which
+  # most strings are found; a fresh memo times the cost of each miss.
+  split_memo = {}
+  def SplitMemoHit(s):
+    return update_makefiles.SplitPreservingWhitespace(s, split_memo)
+  def SplitMemoMiss(s):
+    return update_makefiles.SplitPreservingWhitespace(s, {})
+  for args in split_cases:
+    SplitMemoHit(*args)
+
+  return [
+      ('ReplaceMakefileToken', update_makefiles.ReplaceMakefileToken, [
+          ('$(FOO)', 'FOO', 'FOO_new'),
+          ('$(FOOFOOFOO)', 'FOO', 'FOO_new'),
+          ('${FOO:.d=.c}', 'FOO', 'FOO_new'),
+          ('$(origin FOO bar FOO)', 'FOO', 'FOO_new'),
+          ('FOO=$(BAR) baz', 'BAR', 'BAR_new'),
+          ('$(FOO)_suffix: bar baz', 'FOO', 'FOO_new'),
+          ('foo: BAR = baz', 'BAR', 'BAR_new'),
+          ('\tfrob $${FOO} bar', 'FOO', 'FOO_bad'),
+          ('\tfrob FOO=$(FOO) bar', 'FOO', 'FOO_new'),
+          ]),
+      ('SplitPreservingWhitespace/hit', SplitMemoHit, split_cases),
+      ('SplitPreservingWhitespace/miss', SplitMemoMiss, split_cases),
+      ('EliminateTop', update_makefiles.EliminateTop, [
+          ('TOP=$(TOP_foo)/bar',),
+          ('TOP=$(TOP_foo) $(NOT_TOP)/foo/bar',),
+          ('$(TOP)/$(TOP)/foo $(TOP)\tbar',),
+          ('LIBRARIES="$${FIPSLIBDIR:-$(TOP_test)/fips/}fipscanister.o"; \\',),
+          (TOP_RECIPE_LINE,),
+          ]),
+      ('HasVarOpen', update_makefiles.HasVarOpen, [
+          ('FOO',),
+          ('$(FOO',),
+          ('${ FOO } BAR',),
+          ('$(FOO) $(BAR',),
+          ('$( FOO ) $( BAR',),
+          ]),
+      ('NormalizeRelativeDirectory',
+       update_makefiles.NormalizeRelativeDirectory, [
+          ('foo', '', 'foo/Makefile'),
+          ('-I$(TOP_foo)', '-I', 'foo/Makefile'),
+          ('-L$(TOP)/bar/baz', '-L', 'foo/Makefile'),
+          ('./bar', '', 'foo/Makefile'),
+          ('../baz', '', 'foo/bar/Makefile'),
+          ('../..', '', 'foo/bar/Makefile'),
+          ]),
+      ('Makefile.IsUpdatableRecipeToken', makefile.IsUpdatableRecipeToken, [
+          ('target_3',),
+          ('lib',),
+          ('rm',),
+          ('$(CC)',),
+          ('crypto/aes/prereq_3.o',),
+          ('prereq_3.o;',),
+          ]),
+      ]
+
+
+def RunMicrobenchmarks(repeat=9, min_secs=0.1):
+  """Times each of MicrobenchmarkCases().
+
+  Each case list is run enough times to take at least min_secs, and the
+  median of repeat such runs is used. The runs of the different cases are
+  interleaved, so that a burst of load on the machine slows down at most one
+  run of each case rather than every run of one case.
+
+  Returns:
+    list of (name, calls per second) tuples
+  """
+  timers = []
+  for name, func, cases in MicrobenchmarkCases():
+    def RunCases(func=func, cases=cases):
+      for args in cases:
+        func(*args)
+
+    number = 1
+    while timeit.timeit(RunCases, number=number) < min_secs:
+      number *= 2
+    timers.append((name, len(cases), timeit.Timer(RunCases), number))
+
+  times = dict((name, []) for name, _, _, _ in timers)
+  for _ in range(repeat):
+    for name, _, timer, number in timers:
+      times[name].append(timer.timeit(number) / number)
+  results = []
+  for name, num_cases, _, _ in timers:
+    seconds = sorted(times[name])[repeat // 2]
+    results.append((name, num_cases / seconds))
+  return results
+
+
+def FindMicrobenchmarkRegressions(results, baseline, threshold):
+  """Compares the output of RunMicrobenchmarks() against a baseline.
+
+  Args:
+    results: list of (name, calls per second) tuples
+    baseline: hash of name -> calls per second
+    threshold: fraction by which calls per second may drop before it's a
+      regression
+  Returns:
+    list of (name, baseline calls per second, calls per second) tuples
+  """
+  return [(name, baseline[name], ops) for name, ops in results
+          if name in baseline and ops < baseline[name] * (1 - threshold)]
+
+
+def PrintMicrobenchmarkResults(title, results, baseline):
+  """Prints the output of RunMicrobenchmarks() alongside the baseline.
+
+  Args:
+    title: name of the benchmark
+    results: list of (name, calls per second) tuples
+    baseline: hash of name -> calls per second; may be empty
+  """
+  print title
+  print '%-32s %12s %12s %8s' % ('function', 'ops/sec', 'baseline', 'change')
+  for name, ops in results:
+    if name in baseline:
+      print '%-32s %12.0f %12.0f %+7.1f%%' % (
+          name, ops, baseline[name], (ops / baseline[name] - 1) * 100)
+    else:
+      print '%-32s %12.0f %12s %8s' % (name, ops, '-', '-')
+
+
+def PrintScalingResults(title, results):
+  """Prints the output of a scaling benchmark with the growth ratio per row.
+
+  Args:
+    title: name of the benchmark
+    results: list of (number of lines, number of items, seconds) tuples
+  """
+  print title
+  print '%10s %10s %12s %7s' % ('lines', 'items', 'seconds', 'ratio')
+  previous = None
+  for lines, items, seconds in results:
+    ratio = previous and '%7.2f' % (seconds / previous) or '%7s' % '-'
+    print '%10d %10d %12.6f %s' % (lines, items, seconds, ratio)
+    previous = seconds
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--baseline',
+        help='JSON file of microbenchmark results to compare against; exits '
+        'nonzero if any regressed beyond --threshold')
+  parser.add_argument('--save_baseline',
+        help='JSON file to which to write the microbenchmark results')
+  parser.add_argument('--threshold',
+        help='Fraction by which ops/sec may drop before it is flagged as a '
+        'regression; wide enough for run-to-run noise on a shared machine, so '
+        'that only large regressions are flagged',
+        default=0.4, type=float)
+  parser.add_argument('--micro_only',
+        help='Run only the microbenchmarks',
+        action='store_true')
+  args = parser.parse_args()
+
+  if not args.micro_only:
+    PrintScalingResults('EliminateTop()', BenchmarkEliminateTop())
+    print
+    PrintMemoryResults('Makefile.Variable/Target', BenchmarkModelMemory())
+    print
+    PrintLazyDependResults('ParseMakefile(lazy_depend)', BenchmarkLazyDepend())
+    print
+
+  baseline = {}
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      baseline = json.load(baseline_file)
+  results = RunMicrobenchmarks()
+  PrintMicrobenchmarkResults('Microbenchmarks', results, baseline)
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as baseline_file:
+      json.dump(dict(results), baseline_file, indent=2, sort_keys=True)
+      baseline_file.write('\n')
+
+  regressions = FindMicrobenchmarkRegressions(results, baseline,
+                                              args.threshold)
+  for name, baseline_ops, ops in regressions:
+    print >>sys.stderr, 'REGRESSION: %s: %.0f ops/sec; baseline %.0f' % (
+        name, ops, baseline_ops)
+  sys.exit(regressions and 1 or 0)
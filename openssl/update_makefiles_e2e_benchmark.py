@@ -0,0 +1,203 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+End-to-end benchmark of update_makefiles.py on a synthetic tree.
+
+Generates a tree with synthetic_tree.py, then times the two runs needed to
+convert it: --max_stage 1, then all the stages. Each run is a separate
+process, so that the times include everything a real run does. The time
+taken by each stage comes from the run's --profile_json report.
+
+Every result is appended to a history file, one JSON object per line, and
+compared against the most recent earlier result for the same tree
+parameters and script arguments. Any time that grew by more than the
+threshold is reported as a regression, and the exit status is nonzero.
+
+  $ python update_makefiles_e2e_benchmark.py --dirs 200 --repeat 3
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import synthetic_tree
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'update_makefiles.py')
+
+# The runs needed to convert a freshly generated tree, by name.
+RUNS = [
+    ('run1', ['--max_stage', '1']),
+    ('run2', []),
+    ]
+
+# Times below this many seconds are too noisy to flag as regressions.
+MIN_REGRESSION_SECS = 0.05
+
+
+def TimeRun(tree, script_args, profile_path):
+  """Runs update_makefiles.py in tree and returns its timings.
+
+  Args:
+    tree: directory containing the tree to update
+    script_args: arguments for update_makefiles.py
+    profile_path: file to which the run writes its --profile_json report
+  Returns:
+    hash of metric name -> seconds: 'total' for the whole process, plus the
+      wall time of each stage in the report
+  """
+  start = time.time()
+  with open(os.devnull, 'w') as devnull:
+    subprocess.check_call(
+        [sys.executable, SCRIPT, '--profile_json', profile_path] +
+        script_args, cwd=tree, stdout=devnull)
+  results = {'total': time.time() - start}
+  with open(profile_path) as profile:
+    for stage in json.load(profile)['stages']:
+      results[stage['stage']] = stage['wall_secs']
+  return results
+
+
+def RunBenchmark(tree_params, script_args, repeat):
+  """Converts a freshly generated tree repeat times.
+
+  Args:
+    tree_params: keyword arguments for synthetic_tree.GenerateTree()
+    script_args: extra arguments for every update_makefiles.py run
+    repeat: number of times to generate and convert the tree
+  Returns:
+    hash of '<run>.<metric>' -> the fastest time in seconds over all repeats
+  """
+  best = {}
+  tmpdir = tempfile.mkdtemp()
+  try:
+    for i in range(repeat):
+      tree = os.path.join(tmpdir, 'tree%d' % i)
+      synthetic_tree.GenerateTree(tree, **tree_params)
+      for run_name, run_args in RUNS:
+        results = TimeRun(tree, run_args + script_args,
+                          os.path.join(tmpdir, 'profile.json'))
+        for metric, secs in results.iteritems():
+          key = '%s.%s' % (run_name, metric)
+          best[key] = min(secs, best.get(key, secs))
+  finally:
+    shutil.rmtree(tmpdir)
+  return best
+
+
+def GitRevision():
+  """Returns the current git revision of this script, or None."""
+  try:
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.check_output(
+          ['git', 'rev-parse', '--short', 'HEAD'],
+          cwd=os.path.dirname(SCRIPT), stderr=devnull).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def ReadHistory(history_path):
+  """Returns the list of entries in history_path, oldest first."""
+  if not os.path.exists(history_path):
+    return []
+  with open(history_path) as history:
+    return [json.loads(line) for line in history if line.strip()]
+
+
+def FindBaseline(history, tree_params, script_args):
+  """Returns the latest entry in history with the same parameters, or None.
+  """
+  for entry in reversed(history):
+    if (entry['tree_params'] == tree_params and
+        entry['script_args'] == script_args):
+      return entry
+  return None
+
+
+def FindRegressions(results, baseline, threshold):
+  """Compares results to those of a baseline entry.
+
+  Args:
+    results: output of RunBenchmark()
+    baseline: history entry, or None
+    threshold: fraction by which a time may grow before it's a regression
+  Returns:
+    sorted list of (metric, baseline seconds, current seconds) tuples
+  """
+  if baseline is None:
+    return []
+  regressions = []
+  for metric, secs in sorted(results.iteritems()):
+    baseline_secs = baseline['results'].get(metric)
+    if (baseline_secs is not None and secs > MIN_REGRESSION_SECS and
+        secs > baseline_secs * (1 + threshold)):
+      regressions.append((metric, baseline_secs, secs))
+  return regressions
+
+
+def PrintResults(results, baseline):
+  """Prints each result alongside its baseline, if there is one."""
+  print '%-36s %10s %10s %8s' % ('metric', 'seconds', 'baseline', 'change')
+  for metric, secs in sorted(results.iteritems()):
+    baseline_secs = baseline and baseline['results'].get(metric)
+    if baseline_secs:
+      print '%-36s %10.4f %10.4f %+7.1f%%' % (
+          metric, secs, baseline_secs, (secs / baseline_secs - 1) * 100)
+    else:
+      print '%-36s %10.4f %10s %8s' % (metric, secs, '-', '-')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  synthetic_tree.AddTreeArguments(parser)
+  parser.add_argument('--repeat',
+        help='Number of times to convert a fresh tree; the fastest time for '
+        'each metric is recorded',
+        default=3, type=int)
+  parser.add_argument('--script_args',
+        help='Extra arguments for update_makefiles.py, e.g. "--jobs 4"',
+        default='')
+  parser.add_argument('--history',
+        help='File to which results are appended as JSON lines',
+        default='update_makefiles_e2e_history.jsonl')
+  parser.add_argument('--threshold',
+        help='Fraction by which a time may grow before it is flagged as a '
+        'regression',
+        default=0.2, type=float)
+  parser.add_argument('--no_record',
+        help='Compare against the history without appending to it',
+        dest='record', action='store_false')
+  args = parser.parse_args()
+
+  tree_params = synthetic_tree.TreeParams(args)
+  script_args = args.script_args.split()
+  results = RunBenchmark(tree_params, script_args, args.repeat)
+  baseline = FindBaseline(ReadHistory(args.history), tree_params, script_args)
+  PrintResults(results, baseline)
+
+  if args.record:
+    with open(args.history, 'a') as history:
+      json.dump({
+          'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+          'revision': GitRevision(),
+          'tree_params': tree_params,
+          'script_args': script_args,
+          'results': results,
+          }, history, sort_keys=True)
+      history.write('\n')
+
+  regressions = FindRegressions(results, baseline, args.threshold)
+  for metric, baseline_secs, secs in regressions:
+    print >>sys.stderr, 'REGRESSION: %s took %.4fs; baseline %.4fs' % (
+        metric, secs, baseline_secs)
+  sys.exit(regressions and 1 or 0)
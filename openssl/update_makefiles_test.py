@@ -12,7 +12,13 @@ License: Creative Commons Attribution 4.0 International (CC By 4.0)
 
 import update_makefiles
 
+import os
+import os.path
+import shutil
 import StringIO
+import subprocess
+import sys
+import tempfile
 import unittest
 
 
@@ -145,6 +151,59 @@ class ReplaceMakefileTokenTest(unittest.TestCase):
             '\tfrob FOO=$(FOO) bar', 'FOO', 'FOO_new'))
 
 
+class MakefileTokenReplacerTest(unittest.TestCase):
+
+  def Replace(self, s, replacements):
+    return update_makefiles.MakefileTokenReplacer(replacements).Replace(s)
+
+  def testNoReplacements(self):
+    self.assertEqual('$(FOO) $(BAR)', self.Replace('$(FOO) $(BAR)', {}))
+
+  def testMultipleTokens(self):
+    self.assertEqual('FOO_new=$(BAR_new) baz: $(FOO_new)',
+        self.Replace('FOO=$(BAR) baz: $(FOO)',
+            {'FOO': 'FOO_new', 'BAR': 'BAR_new'}))
+
+  def testTokenIsPrefixOfAnotherToken(self):
+    self.assertEqual('$(LIB_new) $(LIBSRC_new) $(LIBOBJ)',
+        self.Replace('$(LIB) $(LIBSRC) $(LIBOBJ)',
+            {'LIB': 'LIB_new', 'LIBSRC': 'LIBSRC_new'}))
+
+  def testIgnoreShellVariables(self):
+    self.assertEqual('\tfrob $${FOO} $(BAR_new) $$BAR',
+        self.Replace('\tfrob $${FOO} $(BAR) $$BAR',
+            {'FOO': 'FOO_bad', 'BAR': 'BAR_new'}))
+
+  def testIgnoreRecipeArgsThatMatchVarNames(self):
+    self.assertEqual('\tfrob FOO=$(FOO_new) BAR=$(BAR_new) bar',
+        self.Replace('\tfrob FOO=$(FOO) BAR=$(BAR) bar',
+            {'FOO': 'FOO_new', 'BAR': 'BAR_new'}))
+
+  def testMatchesReplaceMakefileToken(self):
+    replacements = {
+        'all': 'all_crypto',
+        'lib': 'lib_crypto',
+        'CFLAGS': 'CFLAGS_crypto',
+        'SRC': 'SRC_crypto',
+        'LIBSRC': 'LIBSRC_crypto',
+        'TOP': 'TOP_crypto',
+        }
+    lines = [
+        'all: lib $(SRC)\n',
+        'SRC= $(LIBSRC)\n',
+        'CFLAGS= $(INCLUDES) $(CFLAG) ${CFLAGS}\n',
+        '\t$(CC) $(CFLAGS) -c $(SRC) all lib\n',
+        '\t@target=all; $(RECURSIVE_MAKE) TOP=$(TOP) $${SRC}\n',
+        'lib:\t$(LIBOBJ) $(TOP)/libcrypto.a\n',
+        '# all: lib SRC CFLAGS\n',
+        ]
+    for line in lines:
+      expected = line
+      for orig, new in replacements.iteritems():
+        expected = update_makefiles.ReplaceMakefileToken(expected, orig, new)
+      self.assertEqual(expected, self.Replace(line, replacements))
+
+
 class SplitPreservingWhitespaceTest(unittest.TestCase):
 
   def testEmptyString(self):
@@ -176,6 +235,25 @@ class SplitPreservingWhitespaceTest(unittest.TestCase):
         update_makefiles.SplitPreservingWhitespace(
             '\t \nfoo\t \nbar\t \n'))
 
+  def testMemo(self):
+    memo = {}
+    first = update_makefiles.SplitPreservingWhitespace('\tfoo bar\n', memo)
+    first[1] = 'baz'
+    self.assertEqual({'\tfoo bar\n': ('\t', 'foo', ' ', 'bar', '\n')}, memo)
+    self.assertEqual(['\t', 'foo', ' ', 'bar', '\n'],
+        update_makefiles.SplitPreservingWhitespace('\tfoo bar\n', memo))
+
+  def testMemoIsBounded(self):
+    memo = {}
+    orig_max_entries = update_makefiles.SPLIT_MEMO_MAX_ENTRIES
+    update_makefiles.SPLIT_MEMO_MAX_ENTRIES = 2
+    try:
+      for s in ['a', 'b', 'c']:
+        update_makefiles.SplitPreservingWhitespace(s, memo)
+    finally:
+      update_makefiles.SPLIT_MEMO_MAX_ENTRIES = orig_max_entries
+    self.assertEqual({'c': ('c',)}, memo)
+
 
 class EliminateTopTest(unittest.TestCase):
 
@@ -202,6 +280,15 @@ class EliminateTopTest(unittest.TestCase):
     self.assertEqual('TOP=. foo/bar',
         update_makefiles.EliminateTop('TOP=$(TOP_foo) $(TOP_foo)/foo/bar'))
 
+  def testAdjacentTopInstances(self):
+    self.assertEqual('.', update_makefiles.EliminateTop('$(TOP)$(TOP)'))
+    self.assertEqual('foo .\tbar',
+        update_makefiles.EliminateTop('$(TOP)/$(TOP)/foo $(TOP)\tbar'))
+
+  def testMalformedTop(self):
+    self.assertRaises(update_makefiles.UpdateMakefilesException,
+        update_makefiles.EliminateTop, 'foo $(TOP)/bar $(TOP_foo')
+
 
 class NormalizeRelativeDirectoryTest(unittest.TestCase):
 
@@ -334,6 +421,1231 @@ RM_crypto=             rm -f
       self.ParseAndUpdate('test', orig, expected)
       self.ParseAndUpdate('test', expected, expected)
 
+    def testTargetWithSeveralRulesIsUpdatedInPlace(self):
+      orig = (
+"""lib: aes_core.o
+
+links:
+\t@echo links
+
+lib: aes_cbc.o
+\tar r lib aes_core.o aes_cbc.o
+""")
+      expected = (
+"""crypto/aes/lib: crypto/aes/aes_core.o
+
+crypto/aes/links:
+\t@echo crypto/aes/links
+
+crypto/aes/lib: crypto/aes/aes_cbc.o
+\tar r crypto/aes/lib crypto/aes/aes_core.o crypto/aes/aes_cbc.o
+""")
+      self.ParseAndUpdate('crypto/aes', orig, expected)
+      self.ParseAndUpdate('crypto/aes', expected, expected)
+
+
+class RemoveCryptoSubdirLibTargetTest(unittest.TestCase):
+
+  def testTargetsWithSeveralRules(self):
+    orig = (
+"""crypto/aes/all: crypto/aes/lib
+
+crypto/aes/lib: crypto/aes/aes_core.o
+\tar r crypto/aes/lib crypto/aes/aes_core.o
+
+crypto/aes/install: crypto/aes/lib
+\tcp crypto/aes/aes.h include
+
+crypto/aes/lib: crypto/aes/aes_cbc.o
+
+crypto/aes/install: crypto/aes/all
+""")
+    expected = (
+"""crypto/aes/all: crypto/aes/aes_core.o  crypto/aes/aes_cbc.o
+
+
+crypto/aes/install: crypto/aes/aes_core.o  crypto/aes/aes_cbc.o
+\tcp crypto/aes/aes.h include
+
+
+crypto/aes/install: crypto/aes/all
+""")
+    sys.stdout = StringIO.StringIO()
+    try:
+      infile = StringIO.StringIO(orig)
+      infile.name = 'crypto/aes/GNUmakefile'
+      makefile = update_makefiles.ParseMakefile(infile)
+      infile.seek(0)
+      outfile = StringIO.StringIO()
+      update_makefiles.RemoveCryptoSubdirLibTarget(infile, outfile, makefile)
+    finally:
+      sys.stdout = sys.__stdout__
+    self.assertMultiLineEqual(expected, outfile.getvalue())
+
+
+class MakefileModelTest(unittest.TestCase):
+
+  def testVariableNumLinesFollowsDefinition(self):
+    var = update_makefiles.Makefile.Variable('FOO', ' bar \\\n baz\n')
+    self.assertEqual(2, var.num_lines)
+    var.definition = ' bar\n'
+    self.assertEqual(1, var.num_lines)
+
+  def testTargetNumLinesFollowsUpdates(self):
+    target = update_makefiles.Makefile.Target('all', ' foo\n', '\techo\n')
+    self.assertEqual(2, target.num_lines)
+    target.prerequisites = ' foo \\\n bar\n'
+    self.assertEqual(3, target.num_lines)
+    target.recipe = ''
+    self.assertEqual(2, target.num_lines)
+    target.name = 'all \\\n'
+    self.assertEqual(3, target.num_lines)
+
+  def testTargetWithSeveralRules(self):
+    content = 'all: lib\n\nall: apps\n\techo all\n'
+    for strict, recipe in [(True, ''), (False, '\techo all\n')]:
+      target = update_makefiles.ParseMakefileContent(
+          content, 'Makefile', strict=strict).targets['all']
+      self.assertEqual(' lib  apps\n', target.prerequisites)
+      self.assertEqual(recipe, target.recipe)
+
+  def testNoInstanceDict(self):
+    var = update_makefiles.Makefile.Variable('FOO', ' bar\n')
+    target = update_makefiles.Makefile.Target('all', ' foo\n', '')
+    self.assertFalse(hasattr(var, '__dict__'))
+    self.assertFalse(hasattr(target, '__dict__'))
+
+class ParseMakefileSpansTest(unittest.TestCase):
+
+  CONTENT = (
+      'FOO= foo \\\n'
+      '  bar\n'
+      '\n'
+      'all: FOO\n'
+      '\techo $(FOO)\n'
+      'first \\\n'
+      ' second: all\n'
+      'all: more\n')
+
+  def setUp(self):
+    self.makefile = update_makefiles.ParseMakefileContent(
+        self.CONTENT, 'Makefile')
+
+  def Text(self, span):
+    return self.CONTENT[span.start:span.end]
+
+  def testVariableSpan(self):
+    [span] = self.makefile.variables['FOO'].spans
+    self.assertEqual((1, 2), (span.first_line, span.last_line))
+    self.assertEqual('FOO= foo \\\n  bar\n', self.Text(span))
+
+  def testTargetSpansIncludeEveryRule(self):
+    first, second = self.makefile.targets['all'].spans
+    self.assertEqual((4, 5), (first.first_line, first.last_line))
+    self.assertEqual('all: FOO\n\techo $(FOO)\n', self.Text(first))
+    self.assertEqual((8, 8), (second.first_line, second.last_line))
+    self.assertEqual('all: more\n', self.Text(second))
+
+  def testMultilineTargetNameSpan(self):
+    [span] = self.makefile.targets['first \\\n second'].spans
+    self.assertEqual('first \\\n second: all\n', self.Text(span))
+
+  def testStrictRejectsDuplicates(self):
+    content = 'FOO=1\nFOO=2\n'
+    self.assertRaises(update_makefiles.UpdateMakefilesException,
+                      update_makefiles.ParseMakefileContent,
+                      content, 'Makefile', strict=True)
+    makefile = update_makefiles.ParseMakefileContent(content, 'Makefile')
+    self.assertEqual('2\n', makefile.variables['FOO'].definition)
+    self.assertEqual(2, len(makefile.variables['FOO'].spans))
+
+
+  def testLazyDependRecordsTailSpan(self):
+    tail = (update_makefiles.MAKE_DEPEND_LINE +
+            'aes.o: ../../include/openssl/aes.h\n'
+            'aes.o: aes.c\n')
+    content = self.CONTENT + '\n' + tail
+    lazy = update_makefiles.ParseMakefileContent(
+        content, 'Makefile', lazy_depend=True)
+    self.assertNotIn('aes.o', lazy.targets)
+    self.assertEqual(self.makefile.targets['all'].spans,
+                     lazy.targets['all'].spans)
+    span = lazy.depend_span
+    self.assertEqual((10, 12), (span.first_line, span.last_line))
+    self.assertEqual(tail, content[span.start:span.end])
+
+    full = update_makefiles.ParseMakefileContent(content, 'Makefile')
+    self.assertIn('aes.o', full.targets)
+    self.assertIsNone(full.depend_span)
+
+
+class SpliceMakefileTest(unittest.TestCase):
+
+  def testNoEdits(self):
+    self.assertEqual('foo\n', update_makefiles.SpliceMakefile('foo\n', []))
+
+  def testEditsAppliedInOffsetOrder(self):
+    Span = update_makefiles.Span
+    content = 'a\nb\nc\n'
+    edits = [(Span(3, 3, 4, 6), 'C\n'), (Span(1, 1, 0, 2), '')]
+    self.assertEqual('b\nC\n', update_makefiles.SpliceMakefile(content, edits))
+
+  def testOverlappingEditsRejected(self):
+    Span = update_makefiles.Span
+    edits = [(Span(1, 2, 0, 4), ''), (Span(2, 2, 2, 4), '')]
+    self.assertRaises(AssertionError, update_makefiles.SpliceMakefile,
+                      'a\nb\n', edits)
+
+
+class EliminateVarsAndTargetsTest(unittest.TestCase):
+
+  def testDeletesEveryDefinition(self):
+    makefile = update_makefiles.Makefile('crypto/Makefile')
+    orig = StringIO.StringIO(
+        'DIR_crypto= crypto\n'
+        'TOP_crypto= \\\n'
+        '  ..\n'
+        'top:\n'
+        '\t(cd ..; $(MAKE))\n'
+        'all: lib\n'
+        'top_crypto: all\n')
+    orig.name = 'crypto/Makefile'
+    out = StringIO.StringIO()
+    saved_stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+      update_makefiles.EliminateVarsAndTargets(orig, out, makefile)
+    finally:
+      sys.stdout = saved_stdout
+    self.assertEqual('all: lib\n', out.getvalue())
+
+
+class ComposeUpdatesTest(unittest.TestCase):
+
+  def Update(self, update_func, orig):
+    infile = StringIO.StringIO(orig)
+    infile.name = 'foo/Makefile'
+    outfile = StringIO.StringIO()
+    update_func(infile, outfile)
+    return outfile.getvalue()
+
+  def testSingleUpdate(self):
+    self.assertEqual('TOP=. foo/bar\n',
+        self.Update(update_makefiles.ComposeUpdates(
+            update_makefiles.RemoveConfigureVars),
+            'TOP=. foo/bar\n'))
+
+  def testUpdatesAppliedInOrder(self):
+    def Upcase(infile, outfile):
+      for line in infile:
+        print >>outfile, line.upper(),
+
+    def AppendName(infile, outfile):
+      for line in infile:
+        print >>outfile, line,
+      print >>outfile, infile.name
+
+    composed = update_makefiles.ComposeUpdates(Upcase, AppendName, Upcase)
+    self.assertEqual('FOO\nBAR\nFOO/MAKEFILE\n',
+        self.Update(composed, 'foo\nbar\n'))
+
+  def testMatchesSeparateUpdates(self):
+    orig = (
+"""SRC= foo.c
+depend:
+	$(MAKEDEPEND) -- $(CFLAG) $(INCLUDES) $(DEPFLAG) -- $(PROGS) $(LIBSRC)
+
+clean:
+	rm -f *.s *.o *.obj lib tags core
+	$(MAKE) -f $(TOP)/Makefile.shared -e clean
+
+# DO NOT DELETE THIS LINE -- make depend depends on it.
+
+foo.o: foo.c
+""")
+    updates = [
+        update_makefiles.AddDependencyFilesToCleanTargets,
+        update_makefiles.RemoveOldMakeDependOutput,
+        update_makefiles.RemoveDependTarget,
+        update_makefiles.CatConfigureAndMakefileShared,
+        ]
+    expected = orig
+    for update_func in updates:
+      expected = self.Update(update_func, expected)
+    self.assertEqual(expected,
+        self.Update(update_makefiles.ComposeUpdates(*updates), orig))
+
+class TransformProfileTest(unittest.TestCase):
+
+  def setUp(self):
+    update_makefiles.PROFILE = update_makefiles.TransformProfile()
+    update_makefiles.PROFILE.stage = 'Stage'
+
+  def tearDown(self):
+    update_makefiles.PROFILE = None
+
+  def testRecordsEachComposedUpdate(self):
+    def Upcase(infile, outfile):
+      outfile.write(infile.read().upper())
+
+    def AppendNameBinder(infile, outfile):
+      outfile.write(infile.read())
+      print >>outfile, infile.name
+
+    infile = StringIO.StringIO('foo\nbar\n')
+    infile.name = 'foo/Makefile'
+    outfile = StringIO.StringIO()
+    update_makefiles.ApplyUpdate(
+        update_makefiles.ComposeUpdates(Upcase, AppendNameBinder),
+        infile, outfile)
+    self.assertEqual('FOO\nBAR\nfoo/Makefile\n', outfile.getvalue())
+
+    records = update_makefiles.PROFILE.records
+    self.assertEqual(
+        set([('Stage', 'Upcase', 'foo/Makefile'),
+             ('Stage', 'AppendName', 'foo/Makefile')]),
+        set(records))
+    calls, _, _, read, written, lines_read, lines_written, changed = (
+        records[('Stage', 'AppendName', 'foo/Makefile')])
+    self.assertEqual((1, 8, 21, 2, 3, 1),
+        (calls, read, written, lines_read, lines_written, changed))
+
+  def testMergeAndReport(self):
+    profile = update_makefiles.PROFILE
+    profile.Merge({
+        ('Stage', 'Upcase', 'aes/Makefile'): [1, 3.0, 2.0, 8, 8, 2, 2, 1],
+        ('Stage', 'Upcase', 'sha/Makefile'): [1, 1.0, 1.0, 8, 8, 2, 2, 0],
+        })
+    profile.Merge({
+        ('Stage', 'Upcase', 'sha/Makefile'): [1, 4.0, 3.0, 8, 8, 2, 2, 1],
+        })
+    profile.RecordStage('Stage', 2, 10.0)
+    report = profile.Report(top_n=1)
+
+    self.assertEqual(1, len(report['stages']))
+    stage = report['stages'][0]
+    self.assertEqual(('Stage', 2, 10.0, 8.0, 3, 2),
+        (stage['stage'], stage['dirs'], stage['wall_secs'],
+         stage['transform_wall_secs'], stage['calls'], stage['changed']))
+    self.assertEqual([('Upcase', 8.0)],
+        [(t['transform'], t['wall_secs']) for t in report['transforms']])
+    self.assertEqual([('sha/Makefile', 5.0)],
+        [(f['file'], f['wall_secs']) for f in report['top_files']])
+    self.assertEqual(['sha'],
+        [d['directory'] for d in report['top_directories']])
+    self.assertEqual(2, len(report['records']))
+
+  def testRunProfiledStep(self):
+    def Upcase(infile, outfile):
+      outfile.write(infile.read().upper())
+
+    def UpdateTopLevel(path):
+      infile = StringIO.StringIO('foo\n')
+      infile.name = path
+      update_makefiles.ApplyUpdate(Upcase, infile, StringIO.StringIO())
+      return 'done'
+
+    profile = update_makefiles.PROFILE
+    self.assertEqual('done', update_makefiles.RunProfiledStep(
+        'TopLevel', UpdateTopLevel, 'Makefile.org'))
+    self.assertIsNone(profile.stage)
+    self.assertEqual([('TopLevel', 'Upcase', 'Makefile.org')],
+                     profile.records.keys())
+    self.assertEqual([('TopLevel', 0)],
+                     [(stage, dirs) for stage, dirs, _ in profile.stages])
+
+class UpdateFileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.makefile = os.path.join(self.tmpdir, 'Makefile')
+    with open(self.makefile, 'w') as makefile:
+      makefile.write('FOO=foo\n\nall: foo\n\techo $(FOO)\n')
+    # Backdate the file so that any rewrite would change the mtime.
+    os.utime(self.makefile, (0, 0))
+    update_makefiles.MODIFIED_FILES.clear()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    update_makefiles.MODIFIED_FILES.clear()
+
+  def testUnchangedFileIsNotRewritten(self):
+    def Identity(infile, outfile):
+      for line in infile:
+        print >>outfile, line,
+
+    self.assertFalse(update_makefiles.UpdateFile(self.makefile, Identity))
+    self.assertEqual(0, os.stat(self.makefile).st_mtime)
+    self.assertEqual(['Makefile'], os.listdir(self.tmpdir))
+    self.assertEqual(set(), update_makefiles.MODIFIED_FILES)
+
+  def testTruncatedFileIsRewritten(self):
+    def DropLastLine(infile, outfile):
+      lines = infile.readlines()
+      outfile.write(''.join(lines[:-1]))
+
+    self.assertTrue(update_makefiles.UpdateFile(self.makefile, DropLastLine))
+    with open(self.makefile) as makefile:
+      self.assertEqual('FOO=foo\n\nall: foo\n', makefile.read())
+    self.assertEqual(['Makefile'], os.listdir(self.tmpdir))
+    self.assertEqual(set([self.makefile]), update_makefiles.MODIFIED_FILES)
+
+  def testChangedFileIsRewritten(self):
+    def Upcase(infile, outfile):
+      for line in infile:
+        print >>outfile, line.upper(),
+
+    self.assertTrue(update_makefiles.UpdateFile(self.makefile, Upcase))
+    with open(self.makefile) as makefile:
+      self.assertEqual('FOO=FOO\n\nALL: FOO\n\tECHO $(FOO)\n',
+          makefile.read())
+    self.assertNotEqual(0, os.stat(self.makefile).st_mtime)
+
+class MakefileDocumentTest(unittest.TestCase):
+
+  CONTENT = (
+      '# comment\n'
+      'FOO= foo \\\n'
+      '  bar\n'
+      '\n'
+      'include $(TOP)/configure.mk\n'
+      'all: $(FOO)\n'
+      '\techo $(FOO)\n'
+      'top:\n'
+      '\t(cd ..; $(MAKE))\n'
+      'all: more\n'
+      '\n')
+
+  def setUp(self):
+    self.document = update_makefiles.MakefileDocument(
+        'Makefile', self.CONTENT)
+
+  def testNodesRoundTrip(self):
+    nodes = self.document.nodes
+    self.assertEqual(self.CONTENT, ''.join([node.text for node in nodes]))
+    self.assertEqual(
+        ['other', 'variable', 'other', 'other', 'rule', 'rule', 'rule',
+         'other'],
+        [node.kind for node in nodes])
+
+  def testNodesOfKind(self):
+    rules = self.document.Nodes(update_makefiles.MakefileDocument.RULE,
+                                set(['all']))
+    self.assertEqual(['all: $(FOO)\n\techo $(FOO)\n', 'all: more\n'],
+                     [node.text for node in rules])
+
+  def testRemoveAndReplace(self):
+    MakefileDocument = update_makefiles.MakefileDocument
+    [top] = self.document.Nodes(MakefileDocument.RULE, set(['top']))
+    [foo] = self.document.Nodes(MakefileDocument.VARIABLE)
+    self.document.Remove(top)
+    self.document.Replace(foo, 'FOO= baz\n')
+    self.assertEqual(2, self.document.version)
+    self.assertEqual(
+        '# comment\nFOO= baz\n\ninclude $(TOP)/configure.mk\n'
+        'all: $(FOO)\n\techo $(FOO)\nall: more\n\n',
+        self.document.text)
+
+  def testReplaceWithSameTextIsNotAChange(self):
+    [foo] = self.document.Nodes(update_makefiles.MakefileDocument.VARIABLE)
+    self.document.Replace(foo, foo.text)
+    self.assertEqual(0, self.document.version)
+
+  def testSetTextReparses(self):
+    self.document.SetText('BAR=1\n')
+    self.assertEqual(1, self.document.version)
+    self.assertEqual(['BAR'], [node.name for node in self.document.nodes])
+
+
+class WorkspaceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.makefile = os.path.join(self.tmpdir, 'Makefile')
+    with open(self.makefile, 'w') as makefile:
+      makefile.write('FOO=foo\nTOP=..\n')
+    update_makefiles.MODIFIED_FILES.clear()
+    update_makefiles.WORKSPACE = update_makefiles.Workspace()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    update_makefiles.MODIFIED_FILES.clear()
+    update_makefiles.WORKSPACE = None
+
+  def ReadMakefile(self):
+    with open(self.makefile) as makefile:
+      return makefile.read()
+
+  def testUpdatesAreHeldUntilCommit(self):
+    def Upcase(infile, outfile):
+      outfile.write(infile.read().upper())
+
+    def RemoveTop(document):
+      [node] = document.Nodes(update_makefiles.MakefileDocument.VARIABLE,
+                              set(['TOP']))
+      document.Remove(node)
+
+    self.assertTrue(update_makefiles.UpdateFile(self.makefile, Upcase))
+    self.assertTrue(update_makefiles.UpdateDocument(self.makefile, RemoveTop))
+    self.assertEqual('FOO=foo\nTOP=..\n', self.ReadMakefile())
+    self.assertEqual(set([self.makefile]), update_makefiles.MODIFIED_FILES)
+
+    update_makefiles.WORKSPACE.Commit()
+    self.assertEqual('FOO=FOO\n', self.ReadMakefile())
+    self.assertEqual([], update_makefiles.WORKSPACE.ChangedPaths())
+    self.assertEqual(['Makefile'], os.listdir(self.tmpdir))
+
+  def testUnchangedFileIsNotWritten(self):
+    def Identity(infile, outfile):
+      outfile.write(infile.read())
+
+    os.utime(self.makefile, (0, 0))
+    self.assertFalse(update_makefiles.UpdateFile(self.makefile, Identity))
+    update_makefiles.WORKSPACE.Commit()
+    self.assertEqual(0, os.stat(self.makefile).st_mtime)
+    self.assertEqual(set(), update_makefiles.MODIFIED_FILES)
+
+  def testParseFileReadsWorkspace(self):
+    def AddBar(infile, outfile):
+      outfile.write('%sBAR=bar\n' % infile.read())
+
+    update_makefiles.UpdateFile(self.makefile, AddBar)
+    makefile = update_makefiles.MakefileInfo().ParseFile(self.makefile)
+    self.assertEqual(['BAR', 'FOO', 'TOP'], sorted(makefile.variables))
+
+  def testUnifiedDiff(self):
+    def Upcase(infile, outfile):
+      outfile.write(infile.read().upper())
+
+    workspace = update_makefiles.WORKSPACE
+    update_makefiles.UpdateFile(self.makefile, Upcase)
+    gnu_makefile = os.path.join(self.tmpdir, 'GNUmakefile')
+    workspace.Create(gnu_makefile, 'TOP=..')
+
+    diff = workspace.UnifiedDiff(self.makefile)
+    self.assertEqual('--- a/%s\n' % self.makefile, diff[0])
+    self.assertEqual(['-FOO=foo\n', '+FOO=FOO\n', ' TOP=..\n'], diff[3:])
+    self.assertEqual((1, 1), workspace.DiffStat(self.makefile))
+
+    diff = workspace.UnifiedDiff(gnu_makefile)
+    self.assertEqual('--- /dev/null\n', diff[0])
+    self.assertEqual('+TOP=..\n\\ No newline at end of file\n', diff[-1])
+    self.assertEqual((1, 0), workspace.DiffStat(gnu_makefile))
+
+    # Nothing is written by a dry run.
+    self.assertEqual('FOO=foo\nTOP=..\n', self.ReadMakefile())
+    self.assertEqual(['Makefile'], os.listdir(self.tmpdir))
+
+  def testFinishRunReportsDryRun(self):
+    def Upcase(infile, outfile):
+      outfile.write(infile.read().upper())
+
+    update_makefiles.UpdateFile(self.makefile, Upcase)
+    sys.stdout = StringIO.StringIO()
+    try:
+      update_makefiles.FinishRun(dry_run='stat')
+      dry_run_output = sys.stdout.getvalue()
+      sys.stdout = StringIO.StringIO()
+      update_makefiles.FinishRun()
+      output = sys.stdout.getvalue()
+    finally:
+      sys.stdout = sys.__stdout__
+    self.assertTrue(dry_run_output.endswith('1 files would be modified\n'),
+                    dry_run_output)
+    self.assertEqual('1 files modified\n', output)
+    self.assertEqual('FOO=FOO\nTOP=..\n', self.ReadMakefile())
+
+  def testExistsNormalizesPath(self):
+    workspace = update_makefiles.WORKSPACE
+    workspace.Create(os.path.join(self.tmpdir, 'GNUmakefile'), 'TOP=..\n')
+    self.assertTrue(workspace.Exists(
+        os.path.join(self.tmpdir, 'crypto', '..', 'GNUmakefile')))
+    self.assertTrue(workspace.Exists(
+        os.path.join(self.tmpdir, '.', 'GNUmakefile')))
+    self.assertFalse(workspace.Exists(
+        os.path.join(self.tmpdir, 'crypto', '..', 'Makefile.in')))
+
+  def testExportAndImport(self):
+    workspace = update_makefiles.WORKSPACE
+    workspace.Create(os.path.join(self.tmpdir, 'GNUmakefile'), 'TOP=..\n')
+    copy = update_makefiles.Workspace()
+    copy.Import(workspace.Export(self.tmpdir))
+    self.assertTrue(copy.IsCreated(os.path.join(self.tmpdir, 'GNUmakefile')))
+    self.assertEqual(workspace.ChangedPaths(), copy.ChangedPaths())
+
+
+class ShadowTreeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.orig_cwd = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    os.mkdir('crypto')
+    for path in ['Makefile', 'crypto/Makefile']:
+      with open(path, 'w') as makefile:
+        makefile.write('old %s\n' % path)
+    self.files = [
+        ('Makefile', 'old Makefile\n', 'new Makefile\n'),
+        ('crypto/Makefile', 'old crypto/Makefile\n',
+         'new crypto/Makefile\n'),
+        ('crypto/GNUmakefile', None, 'new crypto/GNUmakefile\n'),
+        ]
+    self.shadow = update_makefiles.ShadowTree('shadow')
+
+  def tearDown(self):
+    os.chdir(self.orig_cwd)
+    shutil.rmtree(self.tmpdir)
+
+  def Contents(self):
+    contents = {}
+    for dirname, _, fnames in os.walk('.'):
+      for fname in fnames:
+        path = os.path.normpath(os.path.join(dirname, fname))
+        with open(path) as infile:
+          contents[path] = infile.read()
+    return contents
+
+  def testCommit(self):
+    self.shadow.Commit(self.files)
+    self.assertEqual({
+        'Makefile': 'new Makefile\n',
+        'crypto/Makefile': 'new crypto/Makefile\n',
+        'crypto/GNUmakefile': 'new crypto/GNUmakefile\n',
+        }, self.Contents())
+
+  def testValidationFailureLeavesTreeUntouched(self):
+    with open('crypto/Makefile', 'w') as makefile:
+      makefile.write('changed by someone else\n')
+    before = self.Contents()
+    self.assertRaises(update_makefiles.UpdateMakefilesException,
+                      self.shadow.Commit, self.files)
+    self.assertEqual(before, self.Contents())
+
+  def testFailedSwapIsRolledBack(self):
+    before = self.Contents()
+    renames = []
+    orig_rename = os.rename
+
+    def FailingRename(src, dst):
+      # Fail the third rename of the swap, but none made by the rollback.
+      renames.append(dst)
+      if len(renames) == 3:
+        raise OSError('injected failure')
+      orig_rename(src, dst)
+
+    os.rename = FailingRename
+    try:
+      self.assertRaises(OSError, self.shadow.Commit, self.files)
+    finally:
+      os.rename = orig_rename
+    self.assertEqual(before, self.Contents())
+
+  def testRecoverInterruptedCommit(self):
+    before = self.Contents()
+    os.mkdir('shadow')
+    self.shadow.Prepare(self.files)
+    with open(os.path.join('shadow', 'committing'), 'w'):
+      pass
+    os.rename(os.path.join('shadow', 'new', 'crypto', 'GNUmakefile'),
+              'crypto/GNUmakefile')
+    os.rename(os.path.join('shadow', 'new', 'Makefile'), 'Makefile')
+
+    self.assertTrue(self.shadow.Recover())
+    self.assertEqual(before, self.Contents())
+    self.assertFalse(self.shadow.Recover())
+
+
+class TransformCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cache = update_makefiles.TransformCache(self.tmpdir)
+    self.calls = []
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def Apply(self, content, path='crypto/Makefile', context=()):
+    def AddSuffix(infile, outfile):
+      self.calls.append(infile.name)
+      print '%s: adding suffix' % infile.name
+      for line in infile:
+        print >>outfile, '%s_suffix' % line.rstrip('\n')
+
+    infile = StringIO.StringIO(content)
+    infile.name = path
+    outfile = StringIO.StringIO()
+    saved_stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+      update_makefiles.CachedUpdate(self.cache, AddSuffix, context)(
+          infile, outfile)
+      messages = sys.stdout.getvalue()
+    finally:
+      sys.stdout = saved_stdout
+    return outfile.getvalue(), messages
+
+  def testHitSkipsUpdateAndReplaysMessages(self):
+    expected = ('FOO_suffix\n', 'crypto/Makefile: adding suffix\n')
+    self.assertEqual(expected, self.Apply('FOO\n'))
+    self.assertEqual(expected, self.Apply('FOO\n'))
+    self.assertEqual(['crypto/Makefile'], self.calls)
+    self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+  def testSharedAcrossInstances(self):
+    self.Apply('FOO\n')
+    self.cache = update_makefiles.TransformCache(self.tmpdir)
+    self.Apply('FOO\n')
+    self.assertEqual(1, len(self.calls))
+    self.assertEqual(1, self.cache.hits)
+
+  def testKeyCoversContentPathAndContext(self):
+    self.Apply('FOO\n')
+    self.Apply('BAR\n')
+    self.Apply('FOO\n', path='ssl/Makefile')
+    self.Apply('FOO\n', context=('_crypto',))
+    self.assertEqual(4, len(self.calls))
+    self.assertEqual(0, self.cache.hits)
+
+  def testNoCache(self):
+    def Update(infile, outfile):
+      pass
+    self.assertTrue(update_makefiles.CachedUpdate(None, Update) is Update)
+
+
+def FakeStage(config, dirname, fnames):
+  """Stands in for an UpdateMakefilesStage* function in RunStageTest."""
+  print '%s/Makefile: %s' % (dirname, config.gnu_only)
+  update_makefiles.MODIFIED_FILES.add('%s/Makefile' % dirname)
+
+
+def WorkspaceStage(config, dirname, fnames):
+  """Creates a GNUmakefile in dirname and reports what the workspace holds."""
+  update_makefiles.CreateGnuMakefile(dirname)
+  workspace = update_makefiles.WORKSPACE
+  print '%s: top GNUmakefile %s %s' % (
+      dirname, workspace.IsCreated('GNUmakefile'),
+      workspace.Exists('GNUmakefile'))
+
+
+class RunStageTest(unittest.TestCase):
+
+  def setUp(self):
+    update_makefiles.MODIFIED_FILES.clear()
+    self.config = update_makefiles.Config()
+    self.config.gnu_only = 'shared'
+    self.dirs = ['crypto', 'crypto/aes', 'crypto/sha', 'ssl', 'test']
+    self.expected_output = ''.join(
+        ['%s/Makefile: shared\n' % d for d in self.dirs])
+
+  def tearDown(self):
+    update_makefiles.MODIFIED_FILES.clear()
+
+  def RunStage(self):
+    sys.stdout = StringIO.StringIO()
+    try:
+      update_makefiles.RunStage(FakeStage, self.config, self.dirs)
+      return sys.stdout.getvalue()
+    finally:
+      sys.stdout = sys.__stdout__
+
+  def testSerial(self):
+    self.assertEqual(self.expected_output, self.RunStage())
+    self.assertEqual(set(['%s/Makefile' % d for d in self.dirs]),
+        update_makefiles.MODIFIED_FILES)
+
+  def testParallelOutputIsInDirectoryOrder(self):
+    self.config.jobs = 3
+    self.assertEqual(self.expected_output, self.RunStage())
+    self.assertEqual(set(['%s/Makefile' % d for d in self.dirs]),
+        update_makefiles.MODIFIED_FILES)
+
+  def testParallelStagesUseTheWorkspace(self):
+    tmpdir = tempfile.mkdtemp()
+    orig_dir = os.getcwd()
+    os.chdir(tmpdir)
+    try:
+      for d in self.dirs:
+        os.makedirs(d)
+      outputs = []
+      for jobs in [1, 3]:
+        self.config.jobs = jobs
+        update_makefiles.WORKSPACE = update_makefiles.Workspace()
+        update_makefiles.WORKSPACE.Create('GNUmakefile', 'TOP= .\n')
+        sys.stdout = StringIO.StringIO()
+        try:
+          update_makefiles.RunStage(WorkspaceStage, self.config, self.dirs)
+          outputs.append(sys.stdout.getvalue())
+        finally:
+          sys.stdout = sys.__stdout__
+        self.assertEqual(
+            sorted(['GNUmakefile'] +
+                   ['%s/GNUmakefile' % d for d in self.dirs]),
+            update_makefiles.WORKSPACE.ChangedPaths())
+        self.assertEqual([], [os.path.join(d, f)
+                              for d, _, files in os.walk('.') for f in files])
+      self.assertIn('crypto/aes: top GNUmakefile True True', outputs[0])
+      self.assertEqual(outputs[0], outputs[1])
+    finally:
+      update_makefiles.WORKSPACE = None
+      os.chdir(orig_dir)
+      shutil.rmtree(tmpdir)
+
+class ParseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cache_path = os.path.join(self.tmpdir, 'parse.cache')
+    self.makefile = os.path.join(self.tmpdir, 'Makefile')
+    self.WriteMakefile('FOO=foo\n\nall: $(FOO)\n\techo $(FOO)\n', 0)
+    self.orig_parse_makefile = update_makefiles.ParseMakefile
+    self.num_parses = 0
+
+    def CountingParseMakefile(infile, **kwargs):
+      self.num_parses += 1
+      return self.orig_parse_makefile(infile, **kwargs)
+    update_makefiles.ParseMakefile = CountingParseMakefile
+
+  def tearDown(self):
+    update_makefiles.ParseMakefile = self.orig_parse_makefile
+    shutil.rmtree(self.tmpdir)
+
+  def WriteMakefile(self, content, mtime):
+    with open(self.makefile, 'w') as makefile:
+      makefile.write(content)
+    os.utime(self.makefile, (mtime, mtime))
+
+  def Parse(self, lazy_depend=False):
+    cache = update_makefiles.ParseCache(self.cache_path)
+    cache.Load()
+    makefile = cache.Parse(self.makefile, lazy_depend=lazy_depend)
+    cache.Save()
+    return makefile
+
+  def testWarmStartSkipsParsing(self):
+    cold = self.Parse()
+    warm = self.Parse()
+    self.assertEqual(1, self.num_parses)
+    self.assertEqual(str(cold), str(warm))
+    self.assertEqual('foo\n', warm.variables['FOO'].definition)
+    self.assertEqual(' $(FOO)\n', warm.targets['all'].prerequisites)
+    self.assertEqual('\techo $(FOO)\n', warm.targets['all'].recipe)
+
+  def testTouchedFileWithSameContentSkipsParsing(self):
+    self.Parse()
+    os.utime(self.makefile, (1, 1))
+    self.Parse()
+    self.assertEqual(1, self.num_parses)
+
+  def testChangedFileIsReparsed(self):
+    self.Parse()
+    self.WriteMakefile('FOO=bar\n\nall: $(FOO)\n\techo $(FOO)\n', 1)
+    makefile = self.Parse()
+    self.assertEqual(2, self.num_parses)
+    self.assertEqual('bar\n', makefile.variables['FOO'].definition)
+
+  def testLazyAndFullParsesAreCachedSeparately(self):
+    self.Parse()
+    self.Parse(lazy_depend=True)
+    self.Parse(lazy_depend=True)
+    self.assertEqual(2, self.num_parses)
+
+  def testCorruptCacheIsIgnored(self):
+    with open(self.cache_path, 'w') as cache_file:
+      cache_file.write('garbage')
+    self.assertEqual('foo\n', self.Parse().variables['FOO'].definition)
+    self.assertEqual(1, self.num_parses)
+
+class MakefileInfoRefreshTest(unittest.TestCase):
+
+  def setUp(self):
+    self.orig_dir = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    os.makedirs(os.path.join('crypto', 'aes'))
+    os.makedirs('ssl')
+    self.WriteFile('Makefile', 'DIRS= crypto ssl\n\nall: build_all\n')
+    self.WriteFile('crypto/Makefile',
+        'DIR= crypto\nCFLAGS= -g\n\nall: lib\n\nlib: cryptlib.o\n')
+    self.WriteFile('crypto/aes/Makefile',
+        'DIR= aes\nAES_ENC= aes_core.o\n\nall: lib\n\nlinks:\n')
+    self.WriteFile('ssl/Makefile', 'DIR= ssl\n\nall: lib\n\ntags:\n')
+    sys.stdout = StringIO.StringIO()
+    self.info = update_makefiles.MakefileInfo()
+    self.info.Init()
+
+  def tearDown(self):
+    sys.stdout = sys.__stdout__
+    os.chdir(self.orig_dir)
+    shutil.rmtree(self.tmpdir)
+
+  def WriteFile(self, path, content):
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def AssertMatchesFreshInit(self):
+    fresh = update_makefiles.MakefileInfo()
+    fresh.Init()
+    for attr in ['top_vars', 'top_targets', 'all_vars', 'all_targets']:
+      expected = dict([(k, sorted(v))
+                       for k, v in getattr(fresh, attr).iteritems()])
+      actual = dict([(k, sorted(v))
+                     for k, v in getattr(self.info, attr).iteritems()])
+      self.assertEqual(expected, actual, attr)
+    self.assertEqual(sorted(fresh.all_makefiles),
+        sorted(self.info.all_makefiles))
+    for path, expected in fresh.all_makefiles.iteritems():
+      actual = self.info.all_makefiles[path]
+      self.assertEqual(expected.common_vars, actual.common_vars, path)
+      self.assertEqual(expected.common_targets, actual.common_targets, path)
+      self.assertEqual(expected.top_vars, actual.top_vars, path)
+      self.assertEqual(expected.top_targets, actual.top_targets, path)
+
+  def testRefreshWithoutChanges(self):
+    self.assertEqual(set(['ssl/Makefile']),
+        self.info.Refresh(['ssl/Makefile']))
+    self.AssertMatchesFreshInit()
+
+  def testNewCommonNames(self):
+    self.WriteFile('ssl/Makefile',
+        'DIR= ssl\nCFLAGS= -O\n\nall: lib\n\ntags:\n\nlinks:\n')
+    self.assertEqual(
+        set(['ssl/Makefile', 'crypto/Makefile', 'crypto/aes/Makefile']),
+        self.info.Refresh(['ssl/Makefile']))
+    self.assertIn('CFLAGS',
+        self.info.all_makefiles['crypto/Makefile'].common_vars)
+    self.assertIn('links',
+        self.info.all_makefiles['crypto/aes/Makefile'].common_targets)
+    self.AssertMatchesFreshInit()
+
+  def testNamesNoLongerCommon(self):
+    self.WriteFile('crypto/aes/Makefile', 'AES_ENC= aes_core.o\n')
+    self.info.Refresh(['crypto/aes/Makefile'])
+    self.assertNotIn('DIR',
+        self.info.all_makefiles['crypto/aes/Makefile'].common_vars)
+    self.assertIn('TOP',
+        self.info.all_makefiles['crypto/aes/Makefile'].common_vars)
+    self.AssertMatchesFreshInit()
+
+  def testRemovedAndTopLevelMakefiles(self):
+    os.remove('ssl/Makefile')
+    self.WriteFile('Makefile', 'DIRS= crypto\nDIR= .\n\nall: build_all\n')
+    self.info.Refresh(['ssl/Makefile', 'Makefile'])
+    self.assertNotIn('ssl/Makefile', self.info.all_makefiles)
+    self.assertEqual(set(['DIR']),
+        self.info.all_makefiles['crypto/Makefile'].top_vars)
+    self.AssertMatchesFreshInit()
+
+  def testFailedRefreshLeavesStateUnchanged(self):
+    def State():
+      return (dict(self.info.all_makefiles), dict(self.info.top_makefiles),
+              dict([(k, sorted(v)) for k, v in self.info.all_vars.iteritems()]),
+              dict([(k, sorted(v))
+                    for k, v in self.info.all_targets.iteritems()]))
+    before = State()
+    self.WriteFile('crypto/aes/Makefile', 'DIR= aes\n\nall: lib\n')
+    self.WriteFile('ssl/Makefile', 'DIR= ssl\n\ntags:\n\techo\ntags:\n\techo\n')
+    self.assertRaises(update_makefiles.UpdateMakefilesException,
+        self.info.Refresh, ['crypto/aes/Makefile', 'ssl/Makefile', 'Makefile'])
+    self.assertEqual(before, State())
+
+    self.WriteFile('ssl/Makefile', 'DIR= ssl\n\nall: lib\n\ntags:\n')
+    self.info.Refresh(['crypto/aes/Makefile', 'ssl/Makefile', 'Makefile'])
+    self.AssertMatchesFreshInit()
+
+class ListMakefileDirsChangedSinceTest(unittest.TestCase):
+
+  def setUp(self):
+    self.orig_dir = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    for d in ['aes', 'sha', 'ssl']:
+      os.mkdir(d)
+    self.WriteFile('Makefile.org', 'DIRS= aes sha ssl\n')
+    self.WriteFile('aes/Makefile', 'AES= aes_core.o\n\nall: lib\n')
+    self.WriteFile('sha/Makefile', 'SHA= sha1.o\n\nall: lib\n')
+    self.WriteFile('ssl/Makefile', 'SSL= s3_lib.o\n\ntags:\n')
+    self.Git('init', '-q')
+    self.Git('add', '.')
+    self.Git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+             'commit', '-q', '-m', 'initial')
+    self.dirs = ['aes', 'sha', 'ssl']
+    sys.stdout = StringIO.StringIO()
+
+  def tearDown(self):
+    sys.stdout = sys.__stdout__
+    os.chdir(self.orig_dir)
+    shutil.rmtree(self.tmpdir)
+
+  def Git(self, *args):
+    with open(os.devnull, 'w') as devnull:
+      subprocess.check_call(('git',) + args, stdout=devnull)
+
+  def WriteFile(self, path, content):
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def ChangedSince(self):
+    info = update_makefiles.MakefileInfo()
+    info.Init()
+    return update_makefiles.ListMakefileDirsChangedSince(
+        'HEAD', info, self.dirs)
+
+  def testNoChanges(self):
+    self.assertEqual(([], []), self.ChangedSince())
+
+  def testChangedRecipeAffectsOnlyItsMakefile(self):
+    self.WriteFile('aes/Makefile', 'AES= aes_core.o aes_misc.o\n\nall: lib\n')
+    self.assertEqual((['aes'], ['aes']), self.ChangedSince())
+
+  def testNewNameAffectsMakefilesDefiningIt(self):
+    self.WriteFile('ssl/Makefile', 'SSL= s3_lib.o\n\ntags:\n\nall: lib\n')
+    self.assertEqual((['ssl'], ['aes', 'sha', 'ssl']), self.ChangedSince())
+
+  def testDeletedMakefileAffectsMakefilesDefiningItsNames(self):
+    os.remove('ssl/Makefile')
+    self.Git('rm', '-q', '--cached', 'sha/Makefile')
+    os.remove('sha/Makefile')
+    self.dirs = ['aes']
+    self.assertEqual(([], ['aes']), self.ChangedSince())
+
+  def testGlobalInputChangeAffectsEverything(self):
+    self.WriteFile('Makefile.org', 'DIRS= aes ssl\n')
+    self.assertEqual(None, self.ChangedSince())
+
+
+class TreeSnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.orig_dir = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    os.makedirs(os.path.join('crypto', 'aes'))
+    os.makedirs(os.path.join('.git', 'objects'))
+    self.WriteFile('crypto/aes/aes_core.c')
+    self.WriteFile('.git/objects/deadbeef')
+    os.symlink('crypto', 'linked')
+    self.tree = update_makefiles.TreeSnapshot()
+
+  def tearDown(self):
+    os.chdir(self.orig_dir)
+    shutil.rmtree(self.tmpdir)
+
+  def WriteFile(self, path):
+    with open(path, 'w') as f:
+      f.write('/* %s */\n' % path)
+
+  def AssertMatchesOsPath(self, paths):
+    for path in paths:
+      self.assertEqual(os.path.exists(path), self.tree.Exists(path), path)
+
+  def testMatchesOsPathExists(self):
+    self.AssertMatchesOsPath([
+        '', '.', './', '..', self.tmpdir, 'crypto', 'crypto/', './crypto',
+        'crypto/aes', 'crypto/aes/aes_core.c', 'crypto/aes/aes_core.o',
+        'crypto/aes/../aes/aes_core.c', 'crypto/sha', 'crypto/sha/sha1.c',
+        'crypto/aes/aes_core.c/foo', '.git/objects/deadbeef', '.git/foo',
+        'linked', 'linked/aes/aes_core.c', 'linked/sha',
+        ])
+
+  def testSymlinksToFiles(self):
+    os.symlink('aes_core.c', 'crypto/aes/core.c')
+    os.symlink('aes_cbc.c', 'crypto/aes/cbc.c')
+    os.symlink('missing', 'broken')
+    os.makedirs('crypto/sha')
+    os.symlink('../sha', 'crypto/aes/sha')
+    paths = ['crypto/aes/core.c', 'crypto/aes/cbc.c', 'broken', 'broken/foo',
+             'crypto/aes/sha']
+    self.AssertMatchesOsPath(paths)
+    self.assertFalse(self.tree.Exists('crypto/aes/cbc.c'))
+
+    # Whether a symlink exists depends on its target, even though the
+    # directory containing the symlink hasn't changed.
+    self.WriteFile('crypto/aes/aes_cbc.c')
+    os.remove('crypto/aes/aes_core.c')
+    os.rmdir('crypto/sha')
+    self.tree.Refresh()
+    self.AssertMatchesOsPath(paths)
+    self.assertTrue(self.tree.Exists('crypto/aes/cbc.c'))
+
+  def testRefreshFindsCreatedAndRemovedFiles(self):
+    self.assertFalse(self.tree.Exists('crypto/aes/GNUmakefile'))
+    os.makedirs(os.path.join('crypto', 'sha'))
+    self.WriteFile('crypto/aes/GNUmakefile')
+    self.WriteFile('crypto/sha/sha1.c')
+    shutil.rmtree(os.path.join('crypto', 'aes'))
+    os.makedirs(os.path.join('crypto', 'aes'))
+    self.WriteFile('crypto/aes/GNUmakefile')
+    self.tree.Refresh()
+    self.AssertMatchesOsPath([
+        'crypto/aes/GNUmakefile', 'crypto/aes/aes_core.c', 'crypto/sha',
+        'crypto/sha/sha1.c',
+        ])
+
+  def testMakefilePathExists(self):
+    makefile = update_makefiles.Makefile('crypto/aes/Makefile')
+    self.assertTrue(makefile.PathExists('crypto/aes/aes_core.c'))
+    makefile.tree = self.tree
+    self.assertTrue(makefile.PathExists('crypto/aes/aes_core.c'))
+    self.assertFalse(makefile.PathExists('crypto/aes/aes_core.o'))
+
+
+class PollingWatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.orig_dir = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    os.mkdir('aes')
+    self.WriteFile('aes/Makefile', 'AES= aes_core.o\n')
+    self.watcher = update_makefiles.PollingWatcher(
+        ['aes/Makefile', 'aes/GNUmakefile'], interval=0)
+
+  def tearDown(self):
+    os.chdir(self.orig_dir)
+    shutil.rmtree(self.tmpdir)
+
+  def WriteFile(self, path, content):
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def testNoChanges(self):
+    self.assertEqual(set(), self.watcher.Poll())
+
+  def testDetectsModifiedCreatedAndRemovedFiles(self):
+    self.WriteFile('aes/Makefile', 'AES= aes_core.o aes_misc.o\n')
+    self.WriteFile('aes/GNUmakefile', 'include aes/Makefile\n')
+    self.assertEqual(set(['aes/Makefile', 'aes/GNUmakefile']),
+                     self.watcher.Wait())
+    self.assertEqual(set(), self.watcher.Poll())
+    os.remove('aes/GNUmakefile')
+    self.assertEqual(set(['aes/GNUmakefile']), self.watcher.Poll())
+
+  def testSetPaths(self):
+    os.mkdir('sha')
+    self.WriteFile('sha/Makefile', 'SHA= sha1.o\n')
+    self.watcher.SetPaths(['aes/Makefile', 'sha/Makefile'])
+    self.assertEqual(set(), self.watcher.Poll())
+    self.WriteFile('sha/Makefile', 'SHA= sha1.o sha256.o\n')
+    self.WriteFile('aes/GNUmakefile', 'include aes/Makefile\n')
+    self.assertEqual(set(['sha/Makefile']), self.watcher.Poll())
+
+
+class ScriptedWatcher(object):
+  """Reports each of a series of changes from successive Wait() calls.
+
+  Each change is a hash of path -> content to write before reporting the
+  path as changed, None to report it without writing it, or False to remove
+  it.
+  """
+
+  def __init__(self, *changes):
+    self.changes = list(changes)
+    self.paths = None
+
+  def SetPaths(self, paths):
+    self.paths = sorted(paths)
+
+  def Wait(self):
+    change = self.changes.pop(0)
+    for path, content in change.iteritems():
+      if content is False:
+        os.remove(path)
+      elif content is not None:
+        with open(path, 'w') as f:
+          f.write(content)
+    return set(change)
+
+
+class WatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.orig_dir = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    os.mkdir('aes')
+    self.WriteFile('Makefile.org', 'DIRS= aes\n')
+    self.WriteFile('aes/Makefile', 'AES= aes_core.o\n\nall: lib\n')
+    update_makefiles.MODIFIED_FILES.clear()
+    self.config = update_makefiles.Config()
+    self.config.makefile_info.Init()
+    sys.stdout = StringIO.StringIO()
+
+  def tearDown(self):
+    sys.stdout = sys.__stdout__
+    update_makefiles.MODIFIED_FILES.clear()
+    os.chdir(self.orig_dir)
+    shutil.rmtree(self.tmpdir)
+
+  def WriteFile(self, path, content):
+    with open(path, 'w') as f:
+      f.write(content)
+
+  def testUpdatesChangedMakefilesAndIgnoresItsOwnWrites(self):
+    watcher = ScriptedWatcher(
+        {'aes/Makefile': 'AES= aes_core.o aes_misc.o\n\nall: lib\n'},
+        {'aes/GNUmakefile': None, 'aes/BSDmakefile': None},
+        {'aes/Makefile': 'AES= aes_core.o\n\nall: lib\n'})
+    update_makefiles.Watch(self.config, ['aes'], watcher, max_stage=0,
+                           rounds=2)
+    self.assertEqual([], watcher.changes)
+    self.assertTrue(os.path.exists('aes/GNUmakefile'))
+    self.assertTrue(os.path.exists('aes/BSDmakefile'))
+    self.assertEqual(2, sys.stdout.getvalue().count('1 files changed: '))
+
+  def testPicksUpCreatedAndRemovedMakefiles(self):
+    os.mkdir('sha')
+    update_makefiles.UpdateMakefilesStage0(self.config, 'aes', ['Makefile'])
+    info = self.config.makefile_info
+    watcher = ScriptedWatcher(
+        {'sha/Makefile': 'SHA= sha1.o\n\nall: lib\n'},
+        {'aes/Makefile': False})
+    sys.stderr = StringIO.StringIO()
+    try:
+      update_makefiles.Watch(self.config, ['aes'], watcher, max_stage=1,
+                             rounds=1)
+      self.assertEqual('', sys.stderr.getvalue())
+    finally:
+      sys.stderr = sys.__stderr__
+    self.assertIn('sha/Makefile', info.all_makefiles)
+    self.assertTrue(os.path.exists('sha/GNUmakefile'))
+    self.assertIn('sha/BSDmakefile', watcher.paths)
+
+    update_makefiles.Watch(self.config, ['aes', 'sha'], watcher, max_stage=1,
+                           rounds=1)
+    self.assertNotIn('aes/Makefile', info.all_makefiles)
+    self.assertEqual(['sha/Makefile'],
+                     [mf for mf, _, _ in info.all_targets['all']])
+    self.assertNotIn('aes/Makefile', watcher.paths)
+
+  def testFailedUpdatesDoNotEndTheWatch(self):
+    info = self.config.makefile_info
+    watcher = ScriptedWatcher(
+        {'aes/Makefile': 'all: lib\n\techo\nall: lib\n\techo\n'},
+        {'aes/GNUmakefile': None},
+        {'aes/Makefile': 'AES= aes_core.o aes_misc.o\n\nall: lib\n'})
+    orig_update = update_makefiles.UpdateChangedMakefiles
+    def FailOnGNUmakefile(config, changed_paths, *args):
+      if 'aes/GNUmakefile' in changed_paths:
+        raise KeyError('aes/GNUmakefile')
+      return orig_update(config, changed_paths, *args)
+
+    sys.stderr = StringIO.StringIO()
+    update_makefiles.UpdateChangedMakefiles = FailOnGNUmakefile
+    try:
+      update_makefiles.Watch(self.config, ['aes'], watcher, max_stage=1,
+                             rounds=3)
+      errors = sys.stderr.getvalue()
+    finally:
+      update_makefiles.UpdateChangedMakefiles = orig_update
+      sys.stderr = sys.__stderr__
+    self.assertIn('duplicate recipes for all', errors)
+    self.assertIn('KeyError', errors)
+    self.assertEqual([], watcher.changes)
+    self.assertEqual(' aes_core.o aes_misc.o\n',
+                     info.all_makefiles['aes/Makefile'].variables[
+                         'AES'].definition)
+
 
 if __name__ == '__main__':
   unittest.main()
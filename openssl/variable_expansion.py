@@ -0,0 +1,492 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Expands the variables of the parsed OpenSSL Makefiles without running make.
+
+Makefile.variables holds each definition as written. VariableExpander expands
+them the way GNU make would: $(VAR) and ${VAR} references, computed names
+such as $($(DIR)_SRC), substitution references such as $(SRC:.c=.o), and the
+common text and file name functions. The definitions in configure.mk, whose
+names UpdateMakefilesStage0() strips from every Makefile as CONFIG_VARS, are
+consulted after the Makefile's own.
+
+Every variable is expanded once per Makefile and memoized, so the whole tree
+can be expanded in a single pass. To print the expanded variables of one
+Makefile, run from the top of the OpenSSL source tree:
+
+  $ python variable_expansion.py crypto/Makefile LIBOBJ INCLUDES
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import update_makefiles
+
+import argparse
+import os.path
+import re
+
+CONTINUATION_PATTERN = re.compile(r'[ \t]*\\\n[ \t]*')
+COMMENT_PATTERN = re.compile(r'(?<!\\)#')
+FUNCTION_NAME_PATTERN = re.compile(r'([a-z-]+)[ \t]+')
+
+# Functions that depend on the environment, the file system or side effects.
+# References to them are left unexpanded.
+UNSUPPORTED_FUNCTIONS = frozenset([
+    'abspath', 'error', 'eval', 'file', 'flavor', 'info', 'origin',
+    'realpath', 'shell', 'warning', 'wildcard',
+])
+
+
+def VariableValue(definition):
+  """Returns the text make assigns to a variable from a Variable.definition.
+
+  Continuation lines are joined with a single space, the comment is removed,
+  and leading and trailing whitespace is stripped.
+  """
+  value = CONTINUATION_PATTERN.sub(' ', definition)
+  comment = COMMENT_PATTERN.search(value)
+  if comment is not None:
+    value = value[:comment.start()]
+  return value.replace('\\#', '#').strip()
+
+
+def FindClosingDelimiter(s, open_index):
+  """Returns the index of the delimiter closing the one at s[open_index].
+
+  Like make, counts only delimiters of the same kind as the opening one.
+
+  Returns:
+    index of the closing ')' or '}', or -1 if there isn't one
+  """
+  open_char = s[open_index]
+  close_char = open_char == '(' and ')' or '}'
+  depth = 0
+  for i in xrange(open_index, len(s)):
+    if s[i] == open_char:
+      depth += 1
+    elif s[i] == close_char:
+      depth -= 1
+      if depth == 0:
+        return i
+  return -1
+
+
+def SplitTopLevel(s, separator, maxsplit=-1):
+  """Splits s on separator, except inside variable references.
+
+  Args:
+    s: string to split
+    separator: single character on which to split
+    maxsplit: if not negative, the maximum number of splits
+  """
+  parts = []
+  start = 0
+  i = 0
+  while i < len(s) and maxsplit != len(parts):
+    if s[i] == '$' and i + 1 < len(s) and s[i + 1] in '({':
+      end = FindClosingDelimiter(s, i + 1)
+      i = end == -1 and len(s) or end + 1
+      continue
+    if s[i] == separator:
+      parts.append(s[start:i])
+      start = i + 1
+    i += 1
+  parts.append(s[start:])
+  return parts
+
+
+def MatchPattern(pattern, word):
+  """Matches word against a make pattern, in which '%' matches any stem.
+
+  Returns:
+    the stem matched by '%', '' if pattern contains no '%' and equals word,
+      or None if word doesn't match
+  """
+  if '%' not in pattern:
+    if word == pattern:
+      return ''
+    return None
+  prefix, suffix = pattern.split('%', 1)
+  if (len(word) >= len(prefix) + len(suffix) and word.startswith(prefix) and
+      word.endswith(suffix)):
+    return word[len(prefix):len(word) - len(suffix)]
+  return None
+
+
+def PatternSubstitute(pattern, replacement, text):
+  """Implements $(patsubst pattern,replacement,text)."""
+  words = []
+  for word in text.split():
+    stem = MatchPattern(pattern, word)
+    if stem is not None and '%' in pattern:
+      word = replacement.replace('%', stem, 1)
+    elif stem is not None:
+      word = replacement
+    words.append(word)
+  return ' '.join(words)
+
+
+def _Suffix(word):
+  """Returns the suffix of the last component of word, including the '.'."""
+  dot = word.rfind('.')
+  return dot > word.rfind('/') and word[dot:] or ''
+
+
+def _WordList(text, start, end):
+  """Implements $(wordlist start,end,text) for 1-based indexes."""
+  return ' '.join(text.split()[int(start) - 1:int(end)])
+
+
+def _Join(a, b):
+  """Implements $(join a,b), joining the words of a and b pairwise."""
+  words_a, words_b = a.split(), b.split()
+  return ' '.join('%s%s' % (x or '', y or '') for x, y in map(None, words_a,
+                                                                words_b))
+
+
+# Functions whose arguments are all expanded before the function is called.
+# Each takes the expanded arguments and returns the result.
+TEXT_FUNCTIONS = {
+    'subst': lambda a, b, text: text.replace(a, b),
+    'patsubst': PatternSubstitute,
+    'strip': lambda text: ' '.join(text.split()),
+    'findstring': lambda find, text: find in text and find or '',
+    'filter': lambda patterns, text: ' '.join(
+        w for w in text.split()
+        if any(MatchPattern(p, w) is not None for p in patterns.split())),
+    'filter-out': lambda patterns, text: ' '.join(
+        w for w in text.split()
+        if all(MatchPattern(p, w) is None for p in patterns.split())),
+    'sort': lambda text: ' '.join(sorted(set(text.split()))),
+    'word': lambda n, text: ' '.join(text.split()[int(n) - 1:int(n)]),
+    'wordlist': lambda start, end, text: _WordList(text, start, end),
+    'words': lambda text: str(len(text.split())),
+    'firstword': lambda text: ' '.join(text.split()[:1]),
+    'lastword': lambda text: ' '.join(text.split()[-1:]),
+    'dir': lambda text: ' '.join(
+        w[:w.rfind('/') + 1] or './' for w in text.split()),
+    'notdir': lambda text: ' '.join(
+        w[w.rfind('/') + 1:] for w in text.split()),
+    'suffix': lambda text: ' '.join(
+        _Suffix(w) for w in text.split() if _Suffix(w)),
+    'basename': lambda text: ' '.join(
+        w[:len(w) - len(_Suffix(w))] for w in text.split()),
+    'addsuffix': lambda suffix, text: ' '.join(
+        w + suffix for w in text.split()),
+    'addprefix': lambda prefix, text: ' '.join(
+        prefix + w for w in text.split()),
+    'join': _Join,
+}
+
+
+class VariableExpander(object):
+  """Expands variable references in the context of a Makefile.
+
+  Variables are looked up in each of Scopes() in turn. References to
+  undefined variables, such as $(MAKE), $(CC) and automatic variables like
+  $@, and to UNSUPPORTED_FUNCTIONS, are left as written; so is '$$', so that
+  the result is still valid Makefile text.
+
+  The expansion of every variable is memoized by (Makefile path, variable
+  name), since a variable's definition may refer to others defined
+  differently in each Makefile. Call Clear() after changing a definition.
+
+  Attributes:
+    config_variables: hash of variable name -> Makefile.Variable for the
+      definitions in the parsed configure.mk or configure.mk.org, if any
+  """
+
+  def __init__(self, config_variables=None):
+    self.config_variables = config_variables or {}
+    self._memo = {}
+    self._expanding = set()
+
+  @staticmethod
+  def ForMakefiles(all_makefiles):
+    """Returns a VariableExpander using the configure.mk.org definitions.
+
+    Args:
+      all_makefiles: MakefileInfo.all_makefiles
+    """
+    config = all_makefiles.get('configure.mk.org')
+    return VariableExpander(config and config.variables)
+
+  def Scopes(self, makefile):
+    """Returns the hashes of name -> Variable to search, in order."""
+    return [makefile.variables, self.config_variables]
+
+  def Clear(self, makefile_path=None):
+    """Discards the memoized expansions for one Makefile, or for all of them.
+    """
+    if makefile_path is None:
+      self._memo.clear()
+      return
+    for key in [k for k in self._memo if k[0] == makefile_path]:
+      del self._memo[key]
+
+  def Expand(self, makefile, s):
+    """Returns s with every variable reference that can be expanded expanded.
+
+    Args:
+      makefile: Makefile whose variables are referenced
+      s: text to expand
+    Raises:
+      UpdateMakefilesException: if a variable refers to itself
+    """
+    return self._Expand(makefile, s, None)[0]
+
+  def ExpandFully(self, makefile, s):
+    """Like Expand(), but returns None unless every reference was expanded."""
+    expansion, complete = self._Expand(makefile, s, None)
+    if not complete:
+      return None
+    return expansion
+
+  def ExpandVariable(self, makefile, name):
+    """Returns the expanded value of a variable, or None if it's undefined."""
+    value = self._Value(makefile, name, None)
+    return value and value[0]
+
+  def ExpandAll(self, all_makefiles):
+    """Expands every variable in every Makefile.
+
+    Args:
+      all_makefiles: MakefileInfo.all_makefiles
+    Returns:
+      hash of Makefile path -> hash of variable name -> expanded value
+    """
+    return dict((path, dict((name, self.ExpandVariable(makefile, name))
+                            for name in makefile.variables))
+                for path, makefile in all_makefiles.iteritems())
+
+  def _Definition(self, makefile, name):
+    """Returns the VariableValue() of a variable, or None if it's undefined.
+    """
+    for scope in self.Scopes(makefile):
+      if name in scope:
+        return VariableValue(scope[name].definition)
+    return None
+
+  def _Value(self, makefile, name, local_vars):
+    """Returns (expanded value, complete) for a variable, or None.
+
+    Values depending on foreach and call arguments aren't memoized.
+
+    Args:
+      makefile: Makefile in which to look up the variable
+      name: name of the variable
+      local_vars: hash of name -> value of the foreach and call arguments in
+        effect, or None
+    """
+    if local_vars and name in local_vars:
+      return local_vars[name], True
+    key = (makefile.makefile, name)
+    if not local_vars and key in self._memo:
+      return self._memo[key]
+    definition = self._Definition(makefile, name)
+    if definition is None:
+      return None
+    if key in self._expanding:
+      raise update_makefiles.UpdateMakefilesException(
+          '%s: variable %s references itself' % (makefile.makefile, name))
+    self._expanding.add(key)
+    try:
+      value = self._Expand(makefile, definition, local_vars)
+    finally:
+      self._expanding.remove(key)
+    if not local_vars:
+      self._memo[key] = value
+    return value
+
+  def _Expand(self, makefile, s, local_vars):
+    """Returns (expansion of s, True if every reference was expanded)."""
+    result = []
+    complete = True
+    i = 0
+    while True:
+      start = s.find('$', i)
+      if start == -1 or start + 1 == len(s):
+        result.append(s[i:])
+        break
+      result.append(s[i:start])
+      c = s[start + 1]
+      if c == '$':
+        result.append('$$')
+        i = start + 2
+        continue
+      if c in '({':
+        end = FindClosingDelimiter(s, start + 1)
+        if end == -1:
+          result.append(s[start:])
+          complete = False
+          break
+        i = end + 1
+        inner = s[start + 2:end]
+      else:
+        i = start + 2
+        inner = c
+      expansion, expanded = self._ExpandReference(
+          makefile, inner, local_vars)
+      if expansion is None:
+        expansion = s[start:i]
+      result.append(expansion)
+      complete = complete and expanded
+    return ''.join(result), complete
+
+  def _ExpandReference(self, makefile, inner, local_vars):
+    """Expands a variable reference or function call.
+
+    Args:
+      makefile: Makefile whose variables are referenced
+      inner: text between the parentheses or braces of the reference
+      local_vars: passed to _Value()
+    Returns:
+      (expansion, complete), where complete is False if the expansion still
+        contains references that couldn't be expanded; expansion is None if
+        the reference itself couldn't be, in which case it's left as written
+    """
+    function = FUNCTION_NAME_PATTERN.match(inner)
+    if function is not None:
+      return self._CallFunction(makefile, function.group(1),
+                                inner[function.end():], local_vars)
+
+    parts = SplitTopLevel(inner, ':', 1)
+    if len(parts) == 2 and '=' in parts[1]:
+      return self._SubstitutionReference(makefile, parts[0], parts[1],
+                                         local_vars)
+
+    name, complete = self._Expand(makefile, inner, local_vars)
+    if not complete:
+      return None, False
+    value = self._Value(makefile, name, local_vars)
+    if value is None:
+      return None, False
+    return value
+
+  def _SubstitutionReference(self, makefile, name, substitution, local_vars):
+    """Expands $(name:pattern=replacement)."""
+    expansion, complete = self._ExpandReference(makefile, name, local_vars)
+    substitution, substitution_complete = self._Expand(
+        makefile, substitution, local_vars)
+    if not (complete and substitution_complete):
+      return None, False
+    pattern, replacement = substitution.split('=', 1)
+    if '%' not in pattern:
+      pattern = '%%%s' % pattern
+      replacement = '%%%s' % replacement
+    return PatternSubstitute(pattern, replacement, expansion), True
+
+  def _CallFunction(self, makefile, name, args, local_vars):
+    """Expands a call to the make function name.
+
+    Args:
+      makefile: Makefile whose variables are referenced
+      name: name of the function
+      args: unexpanded text of the arguments
+      local_vars: passed to _Value()
+    Returns:
+      (expansion, complete), as for _ExpandReference()
+    """
+    if name in UNSUPPORTED_FUNCTIONS:
+      return None, False
+
+    def ExpandArg(arg):
+      return self._Expand(makefile, arg, local_vars)
+
+    if name == 'foreach':
+      parts = SplitTopLevel(args, ',', 2)
+      if len(parts) != 3:
+        return None, False
+      var, words, text = parts
+      (var, var_complete), (words, words_complete) = (ExpandArg(var),
+                                                      ExpandArg(words))
+      if not (var_complete and words_complete):
+        return None, False
+      results = []
+      for word in words.split():
+        loop_vars = dict(local_vars or {})
+        loop_vars[var.strip()] = word
+        result, complete = self._Expand(makefile, text, loop_vars)
+        if not complete:
+          return None, False
+        results.append(result)
+      return ' '.join(results), True
+
+    if name == 'call':
+      call_args = [ExpandArg(a) for a in SplitTopLevel(args, ',')]
+      if not all(complete for _, complete in call_args):
+        return None, False
+      var = call_args[0][0].strip()
+      call_vars = dict((str(i), value)
+                       for i, (value, _) in enumerate(call_args))
+      definition = self._Definition(makefile, var)
+      if definition is None:
+        return None, False
+      return self._Expand(makefile, definition, call_vars)
+
+    if name == 'value':
+      definition = self._Definition(makefile, ExpandArg(args)[0].strip())
+      return definition, definition is not None
+
+    if name in ('if', 'or', 'and'):
+      # The arguments are only expanded as far as necessary.
+      branches = SplitTopLevel(args, ',', name == 'if' and 2 or -1)
+      if name == 'if':
+        if len(branches) < 2:
+          return None, False
+        condition, complete = ExpandArg(branches[0])
+        if not complete:
+          return None, False
+        if condition.strip():
+          return ExpandArg(branches[1])
+        return len(branches) == 3 and ExpandArg(branches[2]) or ('', True)
+      result = ('', True)
+      for branch in branches:
+        result = ExpandArg(branch)
+        if not result[1]:
+          return None, False
+        if bool(result[0].strip()) == (name == 'or'):
+          return name == 'or' and result or ('', True)
+      return result
+
+    if name not in TEXT_FUNCTIONS:
+      return None, False
+    function = TEXT_FUNCTIONS[name]
+    num_args = function.func_code.co_argcount
+    expanded = [ExpandArg(a) for a in SplitTopLevel(args, ',', num_args - 1)]
+    if len(expanded) != num_args or not all(c for _, c in expanded):
+      return None, False
+    try:
+      return function(*[value for value, _ in expanded]), True
+    except ValueError:
+      # A word index that isn't a number.
+      return None, False
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('makefile',
+        help='Path of the Makefile, relative to the top of the tree')
+  parser.add_argument('variables',
+        help='Variables to print; defaults to every variable in the Makefile',
+        nargs='*')
+  parser.add_argument('--parse_cache',
+        help='See update_makefiles.py --parse_cache')
+  args = parser.parse_args()
+
+  parse_cache = None
+  if args.parse_cache:
+    parse_cache = update_makefiles.ParseCache(args.parse_cache)
+    parse_cache.Load()
+  info = update_makefiles.MakefileInfo(parse_cache)
+  info.Init()
+  makefile_path = os.path.normpath(args.makefile)
+  if makefile_path not in info.all_makefiles:
+    parser.error('not a Makefile in this tree: %s' % args.makefile)
+  makefile = info.all_makefiles[makefile_path]
+  expander = VariableExpander.ForMakefiles(info.all_makefiles)
+  for name in args.variables or sorted(makefile.variables):
+    value = expander.ExpandVariable(makefile, name)
+    print '%s=%s' % (name, value is None and '<undefined>' or value)
@@ -0,0 +1,151 @@
+#! /usr/bin/python2.7
+# coding=UTF-8
+"""
+Unit tests for variable_expansion.py.
+
+Date:    2026-10-17
+License: Creative Commons Attribution 4.0 International (CC By 4.0)
+         http://creativecommons.org/licenses/by/4.0/deed.en_US
+"""
+
+import update_makefiles
+import variable_expansion
+
+import unittest
+
+CONFIGURE_MK = """CC= gcc
+CFLAG= -DOPENSSL_THREADS -O3 # -Wall
+"""
+
+CRYPTO_MAKEFILE = """TOP= ..
+INCLUDES= -I. -I$(TOP) -I../include
+CFLAGS= $(INCLUDE) $(CFLAG)
+INCLUDE= $(INCLUDES)
+SDIRS= aes \\
+\tsha modes
+LIBSRC= cryptlib.c mem.c \\
+\tex_data.c
+LIBOBJ= $(LIBSRC:.c=.o)
+DEPFILES= $(patsubst %.c,$(DEPDIR)/%.d,$(LIBSRC))
+DEPDIR= deps
+SUBDIR_LIBS= $(addprefix $(TOP)/,$(foreach d,$(SDIRS),$(call LIB_PATH,$(d))))
+LIB_PATH= crypto/$(1)/lib$(1).a
+aes_SRC= aes_core.c
+DIR_SRC= $($(firstword $(SDIRS))_SRC)
+CMD= cd $$dir && $(MAKE) CC='$(CC)' $@
+SELF= x $(SELF)
+"""
+
+
+class VariableValueTest(unittest.TestCase):
+
+  def testJoinsContinuationLinesAndStripsComments(self):
+    self.assertEqual('aes sha modes',
+                     variable_expansion.VariableValue(' aes \\\n\tsha modes\n'))
+    self.assertEqual('-O3', variable_expansion.VariableValue(' -O3 # -g\n'))
+    self.assertEqual('a#b', variable_expansion.VariableValue(' a\\#b\n'))
+
+
+class VariableExpanderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.config = update_makefiles.ParseMakefileContent(
+        CONFIGURE_MK, 'configure.mk.org')
+    self.makefile = update_makefiles.ParseMakefileContent(
+        CRYPTO_MAKEFILE, 'crypto/Makefile')
+    self.expander = variable_expansion.VariableExpander.ForMakefiles({
+        'configure.mk.org': self.config,
+        'crypto/Makefile': self.makefile,
+        })
+
+  def Expand(self, s):
+    return self.expander.Expand(self.makefile, s)
+
+  def testVariableReferences(self):
+    self.assertEqual('-I. -I.. -I../include -DOPENSSL_THREADS -O3',
+                     self.expander.ExpandVariable(self.makefile, 'CFLAGS'))
+    self.assertEqual('.. gcc', self.Expand('${TOP} $(CC)'))
+    self.assertEqual(None,
+                     self.expander.ExpandVariable(self.makefile, 'UNDEFINED'))
+
+  def testSubstitutionReferences(self):
+    self.assertEqual('cryptlib.o mem.o ex_data.o',
+                     self.expander.ExpandVariable(self.makefile, 'LIBOBJ'))
+    self.assertEqual('cryptlib.h mem.h ex_data.h',
+                     self.Expand('$(LIBSRC:%.c=%.h)'))
+    self.assertEqual('deps/cryptlib.d deps/mem.d deps/ex_data.d',
+                     self.expander.ExpandVariable(self.makefile, 'DEPFILES'))
+
+  def testFunctions(self):
+    self.assertEqual(
+        '../crypto/aes/libaes.a ../crypto/sha/libsha.a '
+        '../crypto/modes/libmodes.a',
+        self.expander.ExpandVariable(self.makefile, 'SUBDIR_LIBS'))
+    self.assertEqual('aes_core.c',
+                     self.expander.ExpandVariable(self.makefile, 'DIR_SRC'))
+    for function, expected in [
+        ('$(subst .c,.s,$(LIBSRC))', 'cryptlib.s mem.s ex_data.s'),
+        ('$(filter-out mem.c,$(LIBSRC))', 'cryptlib.c ex_data.c'),
+        ('$(filter %.c %.h,a.c b.o c.h)', 'a.c c.h'),
+        ('$(sort $(SDIRS) aes)', 'aes modes sha'),
+        ('$(words $(SDIRS))', '3'),
+        ('$(word 2,$(SDIRS))', 'sha'),
+        ('$(wordlist 2,3,$(SDIRS))', 'sha modes'),
+        ('$(lastword $(SDIRS))', 'modes'),
+        ('$(dir a/b.c c.c)', 'a/ ./'),
+        ('$(notdir a/b.c c.c)', 'b.c c.c'),
+        ('$(basename a/b.c c)', 'a/b c'),
+        ('$(suffix a/b.c c)', '.c'),
+        ('$(addsuffix .o,a b)', 'a.o b.o'),
+        ('$(join a b c,.o .s)', 'a.o b.s c'),
+        ('$(strip  a   b )', 'a b'),
+        ('$(findstring sha,$(SDIRS))', 'sha'),
+        ('$(if $(DEPDIR),yes,no) $(if $(NONE_SET:x=y),yes,no)', 'yes $(if '
+         '$(NONE_SET:x=y),yes,no)'),
+        ('$(if ,yes,no) $(or ,$(DEPDIR),x) $(and a,,b)', 'no deps '),
+        ('$(value LIBOBJ)', '$(LIBSRC:.c=.o)'),
+        ]:
+      self.assertEqual(expected, self.Expand(function), function)
+
+  def testUnexpandableReferencesAreLeftAsWritten(self):
+    self.assertEqual("cd $$dir && $(MAKE) CC='gcc' $@",
+                     self.expander.ExpandVariable(self.makefile, 'CMD'))
+    self.assertEqual("@cd $$dir && $(MAKE) CC='gcc' $@",
+                     self.Expand('@$(CMD)'))
+    self.assertEqual('$(shell ls $(TOP)) $(UNKNOWN:.c=.o) $(word x,a)',
+                     self.Expand('$(shell ls $(TOP)) $(UNKNOWN:.c=.o) '
+                                 '$(word x,a)'))
+    self.assertEqual(None, self.expander.ExpandFully(self.makefile, '$(MAKE)'))
+    self.assertEqual('$$i ..',
+                     self.expander.ExpandFully(self.makefile, '$$i $(TOP)'))
+    self.assertEqual('', self.expander.ExpandFully(self.makefile, '$(if ,x)'))
+    for malformed in ['$(foreach d,$(SDIRS))', '$(foreach d)', '$(if x)']:
+      self.assertEqual(malformed, self.Expand(malformed))
+
+  def testSelfReferenceRaises(self):
+    self.assertRaises(update_makefiles.UpdateMakefilesException,
+                      self.expander.ExpandVariable, self.makefile, 'SELF')
+
+  def testMemoizesPerMakefile(self):
+    other = update_makefiles.ParseMakefileContent(
+        'TOP= ../..\nINCLUDES= -I$(TOP)\n', 'crypto/aes/Makefile')
+    self.assertEqual('-I. -I.. -I../include',
+                     self.expander.ExpandVariable(self.makefile, 'INCLUDE'))
+    self.assertEqual('-I../..', self.expander.ExpandVariable(other, 'INCLUDES'))
+
+    self.makefile.variables['TOP'].definition = ' ../..\n'
+    self.assertEqual('-I. -I.. -I../include',
+                     self.expander.ExpandVariable(self.makefile, 'INCLUDE'))
+    self.expander.Clear('crypto/Makefile')
+    self.assertEqual('-I. -I../.. -I../include',
+                     self.expander.ExpandVariable(self.makefile, 'INCLUDE'))
+
+  def testExpandAll(self):
+    values = self.expander.ExpandAll({'configure.mk.org': self.config})
+    self.assertEqual({'configure.mk.org': {'CC': 'gcc',
+                                           'CFLAG': '-DOPENSSL_THREADS -O3'}},
+                     values)
+
+
+if __name__ == '__main__':
+  unittest.main()